@@ -2,7 +2,9 @@
 import subprocess
 import logging
 import re
+import threading
 from .adapter import Adapter
+from .adb_session import ADBSessionException, ADBSessionLostException, ADBShellSession
 import time
 try:
     from shlex import quote # Python 3
@@ -31,6 +33,8 @@ class ADB(Adapter):
     VERSION_RELEASE_PROPERTY = 'ro.build.version.release'
     RO_SECURE_PROPERTY = 'ro.secure'
     RO_DEBUGGABLE_PROPERTY = 'ro.debuggable'
+    # the shell session is given up for `adb shell` processes after this many failures in a row
+    MAX_SESSION_FAILURES = 3
 
     def __init__(self, device=None):
         """
@@ -46,6 +50,11 @@ class ADB(Adapter):
         self.device = device
 
         self.cmd_prefix = ['adb', "-s", device.serial]
+        # shell commands go through one persistent session rather than an adb process each
+        self.session = ADBShellSession(device.serial)
+        self.session_failures = 0
+        # the shell commands and screenshots of a state are run from several capture threads
+        self.session_lock = threading.Lock()
 
     def run_cmd(self, extra_args):
         """
@@ -85,9 +94,72 @@ class ADB(Adapter):
             self.logger.warning(msg)
             raise ADBException(msg)
 
-        shell_extra_args = ['shell'] + [ quote(arg) for arg in extra_args ]
+        quoted_args = [quote(arg) for arg in extra_args]
+        if self.__is_session_usable():
+            try:
+                return self.__run_in_session([" ".join(quoted_args)])[0]
+            except ADBSessionException:
+                pass
+        shell_extra_args = ['shell'] + quoted_args
         return self.run_cmd(shell_extra_args)
 
+    def shell_many(self, commands):
+        """
+        run several `adb shell` commands, sent together to the shell session
+        @param commands: list of str, command lines of the device shell
+        @return: list of str, the outputs of the commands
+        """
+        if self.__is_session_usable():
+            try:
+                return self.__run_in_session(commands)
+            except ADBSessionException:
+                pass
+        return [self.run_cmd(['shell', command]) for command in commands]
+
+    def __is_session_usable(self):
+        with self.session_lock:
+            return self.session_failures < ADB.MAX_SESSION_FAILURES
+
+    def __run_in_session(self, commands):
+        """
+        raises ADBSessionException if the commands were not sent and can be run with `adb shell` instead,
+        ADBSessionLostException if the session failed after sending them, they are not run again
+        """
+        self.logger.debug('session commands:')
+        self.logger.debug(commands)
+        try:
+            outputs = self.session.run_many(commands)
+        except ADBSessionException as e:
+            with self.session_lock:
+                self.session_failures += 1
+            self.logger.warning("adb shell session failed (%s), using adb shell" % e)
+            raise
+        except ADBSessionLostException as e:
+            with self.session_lock:
+                self.session_failures += 1
+            self.logger.warning("adb shell session lost while running %s: %s" % (commands, e))
+            raise
+        with self.session_lock:
+            self.session_failures = 0
+        self.logger.debug('return:')
+        self.logger.debug(outputs)
+        return outputs
+
+    def exec_out(self, command):
+        """
+        run an `adb exec-out` command, for a binary output such as `screencap -p`
+        @param command: str, a command line of the device shell
+        @return: bytes, the output of the command
+        """
+        self.logger.debug('exec-out command:')
+        self.logger.debug(command)
+        if self.__is_session_usable():
+            try:
+                return self.session.exec_out(command)
+            except ADBSessionException as e:
+                self.logger.warning("adb exec through the adb server failed (%s), using adb exec-out" % e)
+        return subprocess.check_output(self.cmd_prefix + ['exec-out', command])
+
     def check_connectivity(self):
         """
         check if adb is connected
@@ -106,6 +178,7 @@ class ADB(Adapter):
         """
         disconnect adb
         """
+        self.session.close()
         print("[CONNECTION] %s is disconnected" % self.__class__.__name__)
 
     def get_property(self, property_name):
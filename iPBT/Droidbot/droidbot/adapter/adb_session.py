@@ -0,0 +1,190 @@
+# A persistent `adb shell` session, talking to the adb server over its socket
+import logging
+import os
+import socket
+import subprocess
+import threading
+
+ADB_SERVER_HOST = "127.0.0.1"
+ADB_SERVER_PORT = int(os.environ.get("ANDROID_ADB_SERVER_PORT", 5037))
+# seconds to wait for the output of a command before giving up the session
+SESSION_TIMEOUT = 120
+
+
+class ADBSessionException(Exception):
+    """
+    The session is not usable and nothing was sent to it, the command should be run without it
+    """
+    pass
+
+
+class ADBSessionLostException(Exception):
+    """
+    The session failed after the commands were sent, they may have run, so they must not be run again
+    """
+    pass
+
+
+class ADBShellSession(object):
+    """
+    one long-lived `sh` on the device, fed with commands through the adb server socket,
+    so that a shell command costs a round trip instead of starting an adb client and a new adb connection
+    the output of each command is followed by a sentinel line carrying its exit status,
+    several commands can be written at once and their outputs are read back in order
+    """
+
+    def __init__(self, serial, host=ADB_SERVER_HOST, port=ADB_SERVER_PORT, timeout=SESSION_TIMEOUT):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.serial = serial
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.sock = None
+        self.buffer = bytearray()
+        self.command_count = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def __recv_exactly(sock, size):
+        data = b""
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                raise ADBSessionException("adb server closed the connection")
+            data += chunk
+        return data
+
+    def __request(self, sock, request):
+        """
+        send a request of the adb server protocol: 4 hex digits of length, then the request
+        """
+        data = request.encode("utf-8")
+        sock.sendall(b"%04x" % len(data) + data)
+        status = self.__recv_exactly(sock, 4)
+        if status != b"OKAY":
+            length = int(self.__recv_exactly(sock, 4), 16)
+            raise ADBSessionException("%s: %s" % (request, self.__recv_exactly(sock, length).decode("utf-8",
+                                                                                                     "replace")))
+
+    def __connect(self, service):
+        """
+        :return: a socket to a service of the device, e.g. shell:sh
+        """
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        try:
+            # the commands are small writes waiting for an answer, they must not be delayed
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.__request(sock, "host:transport:%s" % self.serial)
+            self.__request(sock, service)
+        except (OSError, ADBSessionException):
+            sock.close()
+            raise
+        return sock
+
+    def open(self):
+        try:
+            # with a command, the shell service runs it without a pty, its stdin is the socket
+            self.sock = self.__connect("shell:sh")
+        except (OSError, ADBSessionException) as e:
+            self.close()
+            raise ADBSessionException("cannot open a shell session on %s: %s" % (self.serial, e))
+        self.buffer = bytearray()
+        self.logger.debug("shell session opened on %s" % self.serial)
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+
+    def exec_out(self, command):
+        """
+        run a command with the exec service, as `adb exec-out`, on a connection of its own
+        the output is binary safe (no pty, no newline translation), e.g. the png of `screencap -p`
+        :param command: str, a command line of the device shell
+        :return: bytes, the output of the command
+        """
+        try:
+            sock = self.__connect("exec:%s" % command)
+        except (OSError, ADBSessionException) as e:
+            raise ADBSessionException("cannot run %s on %s: %s" % (command, self.serial, e))
+        chunks = []
+        try:
+            while True:
+                chunk = sock.recv(262144)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        except OSError as e:
+            raise ADBSessionException("%s: %s" % (command, e))
+        finally:
+            sock.close()
+        return b"".join(chunks)
+
+    def run(self, command):
+        """
+        run a shell command in the session
+        :param command: str, a command line of the device shell
+        :return: str, the output of the command, stripped
+        """
+        return self.run_many([command])[0]
+
+    def run_many(self, commands):
+        """
+        run shell commands in the session, all sent before reading the first output
+        :param commands: list of str
+        :return: list of str, the outputs of the commands
+        raises ADBSessionException if the session cannot be opened, ADBSessionLostException if it fails later
+        """
+        with self.lock:
+            if self.sock is None:
+                self.open()
+            sentinels = []
+            script = b""
+            for command in commands:
+                self.command_count += 1
+                sentinel = "__droidbot_%d__" % self.command_count
+                sentinels.append(sentinel)
+                # stdin is detached so that a command cannot read the next ones, stderr is dropped as the adb
+                # client prints it apart, the sentinel is on a line of its own even after an output not ending
+                # with a newline
+                script += ("(%s) </dev/null 2>/dev/null; printf '\\n%s %%d\\n' $?\n" %
+                           (command, sentinel)).encode("utf-8")
+            try:
+                self.sock.sendall(script)
+                results = [self.__read_output(sentinel) for sentinel in sentinels]
+            except (OSError, ADBSessionException) as e:
+                # the state of the shell is unknown, the next command opens a new session
+                self.close()
+                raise ADBSessionLostException(str(e))
+        for command, (output, exit_status) in zip(commands, results):
+            if exit_status != 0:
+                # as subprocess.check_output raises for the adb client, which exits with the status of the command
+                raise subprocess.CalledProcessError(exit_status, command, output)
+        return [output for output, _ in results]
+
+    def __read_output(self, sentinel):
+        """
+        :return: (output, exit status) of the command followed by the sentinel
+        """
+        marker = ("\n%s " % sentinel).encode("utf-8")
+        # only the new data (and the end of the previous one) is searched, outputs of dumpsys can be large
+        search_from = 0
+        while True:
+            start = self.buffer.find(marker, search_from)
+            if start != -1:
+                end = self.buffer.find(b"\n", start + len(marker))
+                if end != -1:
+                    break
+            else:
+                search_from = max(0, len(self.buffer) - len(marker))
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                raise ADBSessionException("shell session closed")
+            self.buffer += chunk
+        output = bytes(self.buffer[:start])
+        exit_status = int(self.buffer[start + len(marker):end])
+        del self.buffer[:end + 1]
+        return output.decode("utf-8", "replace").strip(), exit_status
@@ -2,6 +2,10 @@
 # The hash algorithm is copied from:
 # https://github.com/hjaurum/DHash/blob/master/dHash.py
 
+# the two hex digits of each byte value in calculate_dhash, as the original per-bit loop wrote them
+# (it drops the last digit of hex(), a python 2 "L" suffix, the strings are kept as they were)
+_DHASH_BYTE_STRINGS = [str(hex(value)[2:-1].rjust(2, "0")) for value in range(256)]
+
 
 def _intersect(rect1, rect2):
     """
@@ -121,23 +125,42 @@ def calculate_dhash(img):
     :param img: numpy.ndarray, representing an image in opencv
     :return:
     """
+    import numpy
     difference = _calculate_pixel_difference(img)
-    # convert to hex
-    decimal_value = 0
-    hash_string = ""
-    for index, value in enumerate(difference):
-        if value:
-            decimal_value += value * (2 ** (index % 8))
-        if index % 8 == 7:  # every eight binary bit to one hex number
-            hash_string += str(hex(decimal_value)[2:-1].rjust(2, "0"))  # 0xf=>0x0f
-            decimal_value = 0
-    return hash_string
+    # every eight bits to one byte, the first bit is the lowest
+    return "".join([_DHASH_BYTE_STRINGS[value] for value in numpy.packbits(difference, bitorder="little")])
+
+
+def calculate_dhash_value(img):
+    """
+    Calculate the dhash of an image as an int, for comparing many hashes with bit operations.
+    :param img: numpy.ndarray, representing an image in opencv
+    :return: int, the bits of the pixel differences
+    """
+    import numpy
+    return int.from_bytes(numpy.packbits(_calculate_pixel_difference(img), bitorder="little").tobytes(), "little")
+
+
+def calculate_dhash_value_from_buf(img_bytes):
+    """
+    Calculate the dhash of an encoded image, e.g. a png screenshot, as calculate_dhash_value does.
+    :param img_bytes: bytes, the encoded image
+    :return: int, None if the image cannot be decoded
+    """
+    import cv2
+    import numpy
+    # the hash only needs the gray levels, decoding to one channel is faster
+    img = cv2.imdecode(numpy.frombuffer(img_bytes, dtype=numpy.uint8), cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        return None
+    return calculate_dhash_value(img)
 
 
 def _calculate_pixel_difference(img):
     """
     Calculate difference between pixels
-    :param img: numpy.ndarray, representing an image in opencv
+    :param img: numpy.ndarray, representing an image in opencv, BGR, BGRA or grayscale
+    :return: numpy.ndarray of bool, row by row
     """
     import cv2
     resize_width = 18
@@ -146,14 +169,15 @@ def _calculate_pixel_difference(img):
     smaller_image = cv2.resize(img, (resize_width, resize_height))
 
     # 2. calculate grayscale
-    grayscale_image = cv2.cvtColor(smaller_image, cv2.COLOR_BGR2GRAY)
+    if smaller_image.ndim == 2:
+        grayscale_image = smaller_image
+    elif smaller_image.shape[2] == 4:
+        grayscale_image = cv2.cvtColor(smaller_image, cv2.COLOR_BGRA2GRAY)
+    else:
+        grayscale_image = cv2.cvtColor(smaller_image, cv2.COLOR_BGR2GRAY)
 
     # 3. calculate difference between pixels
-    difference = []
-    for row in range(resize_height):
-        for col in range(resize_width - 1):
-            difference.append(grayscale_image[row][col] > grayscale_image[row][col + 1])
-    return difference
+    return (grayscale_image[:, :-1] > grayscale_image[:, 1:]).reshape(-1)
 
 
 def img_hamming_distance(img1, img2):
@@ -168,14 +192,8 @@ def img_hamming_distance(img1, img2):
         return dhash_hamming_distance(img1, img2)
 
     # B. use numpy.ndarray to calculate hamming distance
-    _hamming_distance = 0
-    image1_difference = _calculate_pixel_difference(img1)
-    image2_difference = _calculate_pixel_difference(img2)
-    for index, img1_pix in enumerate(image1_difference):
-        img2_pix = image2_difference[index]
-        if img1_pix != img2_pix:
-            _hamming_distance += 1
-    return _hamming_distance
+    import numpy
+    return int(numpy.count_nonzero(_calculate_pixel_difference(img1) != _calculate_pixel_difference(img2)))
 
 
 def dhash_hamming_distance(dhash1, dhash2):
@@ -22,6 +22,8 @@ class Uiautomator2_Helper:
             self.__all_cap_re = re.compile("([a-z0-9])([A-Z])")
 
         self.package_name: str = package_name
+        # screen rotation reported with the last dumped hierarchy, None if unknown
+        self.rotation = None
 
     def __id_convert(self, name):
         name = name.replace(".", "_").replace(":", "_").replace("/", "_")
@@ -124,6 +126,8 @@ class Uiautomator2_Helper:
         exlude_package = ["com.android.systemui","com.github.uiautomator"]
         # iterate all the root nodes from the xml node, and select the one we want
         root = ET.fromstring(xml)
+        rotation = root.get("rotation")
+        self.rotation = int(rotation) if rotation is not None and rotation.isdigit() else None
         packages = {child.get("package") : child for child in root if child.tag == "node"}
         if self.package_name in packages:
             return packages[self.package_name]
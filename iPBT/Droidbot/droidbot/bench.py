@@ -0,0 +1,189 @@
+# microbenchmark of DeviceState construction and event extraction on recorded states
+# usage: python -m droidbot.bench <states_dir> [--repeat N]
+import argparse
+import copy
+import hashlib
+import sys
+import time
+
+from .device_state import DeviceState, VIEW_DERIVED_KEYS
+from .state_store import list_state_files, load_state_file
+
+
+class BenchDevice(object):
+    """
+    the part of Device used by DeviceState, for building states offline
+    """
+
+    def __init__(self, width, height):
+        self.humanoid = None
+        self.output_dir = None
+        self.width = width
+        self.height = height
+        self.display_info = {"width": width, "height": height}
+
+    def get_display_info_for_rotation(self, rotation):
+        return self.display_info
+
+
+def load_states(states_dir):
+    """
+    load the recorded states of a droidbot output states directory, in any state file format
+    :return: list of dict, the state json dicts, without the keys DeviceState caches on the views
+    """
+    states = []
+    for state_path in list_state_files(states_dir):
+        try:
+            state = load_state_file(state_path)
+        except ValueError:
+            continue
+        state["views"] = [{key: value for key, value in view.items() if key not in VIEW_DERIVED_KEYS}
+                          for view in state["views"]]
+        states.append(state)
+    return states
+
+
+def legacy_hash_views(views, foreground_activity):
+    """
+    the md5 string hashing DeviceState used before the single pass hashing, for comparison
+    :return: (state_str, structure_str, list of view_str)
+    """
+    def get(view, key):
+        return "None" if view.get(key) is None else view[key]
+
+    def signature(view):
+        text = view.get("text")
+        if text is None or len(text) > 50:
+            text = "None"
+        return "[class]%s[resource_id]%s[text]%s[%s,%s,%s]" % (
+            get(view, "class"), get(view, "resource_id"), text,
+            "enabled" if view.get("enabled") else "", "checked" if view.get("checked") else "",
+            "selected" if view.get("selected") else "")
+
+    def content_free_signature(view):
+        return "[class]%s[resource_id]%s" % (get(view, "class"), get(view, "resource_id"))
+
+    def ancestors(view):
+        parent_id = view.get("parent", -1)
+        if parent_id is not None and 0 <= parent_id < len(views):
+            return [parent_id] + ancestors(views[parent_id])
+        return []
+
+    def md5(text):
+        return hashlib.md5(text.encode("utf-8")).hexdigest()
+
+    view_strs = []
+    for view in views:
+        parent_strs = [signature(views[parent_id]) for parent_id in ancestors(view)]
+        parent_strs.reverse()
+        child_strs = sorted(signature(views[child_id]) for child_id in set(view.get("children") or []))
+        view_strs.append(md5("Activity:%s\nSelf:%s\nParents:%s\nChildren:%s" % (
+            foreground_activity, signature(view), "//".join(parent_strs), "||".join(child_strs))))
+    state_str = md5("%s{%s}" % (foreground_activity, ",".join(sorted(set(signature(view) for view in views)))))
+    structure_str = md5("%s{%s}" % (foreground_activity,
+                                    ",".join(sorted(set(content_free_signature(view) for view in views)))))
+    return state_str, structure_str, view_strs
+
+
+def deep_getsizeof(obj, seen=None):
+    """
+    size of an object and everything it holds, in bytes, each object counted once
+    strings are left out as in ViewTable.nbytes, they are interned and shared between states
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen or isinstance(obj, str):
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(deep_getsizeof(value, seen) for value in obj.values())
+    if isinstance(obj, (list, tuple, set)):
+        return sys.getsizeof(obj) + sum(deep_getsizeof(item, seen) for item in obj)
+    return sys.getsizeof(obj)
+
+
+def time_call(func, repeat, setup=None):
+    """
+    :param setup: if given, called before each timed call, without being timed, and its result is passed to func
+    :return: the best time of repeat calls, in milliseconds
+    """
+    best = None
+    for _ in range(repeat):
+        args = (setup(),) if setup else ()
+        start = time.perf_counter()
+        func(*args)
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def bench_state(state, repeat):
+    device = BenchDevice(state.get("width", 1080), state.get("height", 1920))
+    views = state["views"]
+    activity = state["foreground_activity"]
+
+    def copy_views():
+        return copy.deepcopy(views)
+
+    def build_state(state_views):
+        return DeviceState(device, state_views, activity, state.get("activity_stack", []),
+                           state.get("background_services", []), tag=state.get("tag"))
+
+    def reset_state():
+        # views without any cached signature or index, as in a new state
+        device_state.views = copy_views()
+        if hasattr(device_state, "_lazy_view_index"):
+            del device_state._lazy_view_index
+
+    def hash_views(_):
+        device_state._hash_views()
+
+    def reset_events():
+        device_state.possible_events = None
+
+    def get_events(_):
+        device_state.get_possible_input()
+
+    device_state = build_state(copy_views())
+    return {
+        "views": len(views),
+        "kb": device_state.get_memory_size() / 1024.0,
+        "dict_kb": deep_getsizeof(views) / 1024.0,
+        "construction": time_call(build_state, repeat, copy_views),
+        "legacy_hashing": time_call(lambda: legacy_hash_views(views, activity), repeat),
+        "hashing": time_call(hash_views, repeat, reset_state),
+        "events": time_call(get_events, repeat, reset_events),
+    }
+
+
+def run(states_dir, repeat):
+    states = load_states(states_dir)
+    if not states:
+        print("no state files in %s" % states_dir)
+        return
+    results = [bench_state(state, repeat) for state in states]
+    print("%-12s %8s %14s %14s %14s %10s %10s %10s" % ("", "views", "construct ms", "legacy hash ms", "hash ms",
+                                                        "events ms", "dicts KB", "table KB"))
+    for state, result in sorted(zip(states, results), key=lambda item: -item[1]["views"])[:10]:
+        print("%-12s %8d %14.2f %14.2f %14.2f %10.2f %10.1f %10.1f" % (
+            state.get("tag", "")[-12:], result["views"], result["construction"], result["legacy_hashing"],
+            result["hashing"], result["events"], result["dict_kb"], result["kb"]))
+    total = {key: sum(result[key] for result in results) for key in results[0]}
+    print("%d states, %d views" % (len(results), total["views"]))
+    print("memory of the views: %.1f KB as dicts, %.1f KB as view tables" % (total["dict_kb"], total["kb"]))
+    print("mean per state: construction %.2f ms, legacy hashing %.2f ms, hashing %.2f ms (%.1fx faster)" % (
+        total["construction"] / len(results), total["legacy_hashing"] / len(results),
+        total["hashing"] / len(results), total["legacy_hashing"] / max(total["hashing"], 1e-9)))
+    print("mean per state: possible events extraction %.2f ms" % (total["events"] / len(results)))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark DeviceState construction on recorded states")
+    parser.add_argument("states_dir", help="the states directory of a droidbot output")
+    parser.add_argument("--repeat", type=int, default=5, help="number of timed runs per state, the best is kept")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    run(args.states_dir, args.repeat)
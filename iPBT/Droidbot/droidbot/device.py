@@ -4,6 +4,8 @@ import re
 import subprocess
 import sys
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import uiautomator2
 
@@ -19,10 +21,63 @@ from .adapter.user_input_monitor import UserInputMonitor
 from .adapter.droidbot_ime import DroidBotIme
 from .app import App
 from .intent import Intent
+from .state_store import STATE_FORMAT_JSON, STATE_FORMAT_STORE, SCREENSHOT_FORMAT_JPG, SCREENSHOT_FORMAT_PNG, \
+    SCREENSHOT_DEDUP_DHASH, SCREENSHOT_DEDUP_EXACT, StateWriter, get_image_format
+from .run_store import RUN_STORE_DIR, RunStore
+from .utils import fast_digest
 
 DEFAULT_NUM = '1234567890'
 DEFAULT_CONTENT = 'Hello world!'
 
+# the stages of Device.get_current_state, run concurrently as they are independent round trips to the device
+CAPTURE_STAGES = ["views", "activities", "screenshot"]
+# the screenshots of the last captured states are kept in memory, for the view images and the state index
+SCREENSHOTS_IN_MEMORY = 4
+# `adb exec-out` needs android 5.0
+EXEC_OUT_MIN_SDK_VERSION = 21
+
+ACTIVITY_LINE_RE = re.compile(r'\*\s*Hist\s*#\d+:\s*ActivityRecord\{[^ ]+\s*[^ ]+\s*([^ ]+)\s*t(\d+)}')
+TASK_LINE_RE = re.compile(r'^\s*Task\s*id\s*#(\d+)|^\s*Task\{\w+\s*#(\d+)')
+SERVICE_LINE_RE = re.compile(r'^.+ServiceRecord{.+ ([A-Za-z0-9_.]+)/([A-Za-z0-9_.]+)')
+# printed between the two dumps of Device.get_activity_snapshot
+DUMPSYS_SEPARATOR = "__droidbot_dumpsys_services__"
+
+
+def parse_activities_dump(dump):
+    """
+    parse the output of `dumpsys activity activities`
+    :return: (top activity name or None, dict mapping each task id to a list of activities, from top to down)
+    """
+    top_activity = None
+    task_to_activities = {}
+    for line in dump.splitlines():
+        line = line.strip()
+        task_m = TASK_LINE_RE.match(line)
+        if task_m:
+            task_id = task_m.group(1) or task_m.group(2)
+            task_to_activities[task_id] = []
+            continue
+        activity_m = ACTIVITY_LINE_RE.match(line)
+        if activity_m:
+            activity, task_id = activity_m.group(1), activity_m.group(2)
+            if top_activity is None:
+                top_activity = activity
+            task_to_activities.setdefault(task_id, []).append(activity)
+    return top_activity, task_to_activities
+
+
+def parse_services_dump(dump):
+    """
+    parse the output of `dumpsys activity services`
+    :return: list of str, the running services, as package/service
+    """
+    services = []
+    for line in dump.splitlines():
+        m = SERVICE_LINE_RE.search(line)
+        if m:
+            services.append("%s/%s" % (m.group(1), m.group(2)))
+    return services
+
 
 class Device(object):
     """
@@ -31,11 +86,20 @@ class Device(object):
 
     def __init__(self, device_serial=None, is_emulator=False, output_dir=None,
                  cv_mode=False, grant_perm=False, telnet_auth_token=None,
-                 enable_accessibility_hard=False, humanoid=None, app_package_name=None, ignore_ad=False):
+                 enable_accessibility_hard=False, humanoid=None, app_package_name=None, ignore_ad=False,
+                 state_format=STATE_FORMAT_JSON, screenshot_format=None, screenshot_scale=1.0,
+                 screenshot_dedup=SCREENSHOT_DEDUP_EXACT, reuse_unchanged_views=False):
         """
         initialize a device connection
         :param device_serial: serial number of target device
         :param is_emulator: boolean, type of device, True for emulator, False for real device
+        :param state_format: str, format of the state files, json or msgpack, or store for a RunStore
+        :param screenshot_format: str, format of the saved screenshots, png, jpg or webp, None to keep them as captured
+        :param screenshot_scale: float, size of the saved screenshots relative to the screen, e.g. 0.5
+        :param screenshot_dedup: str, exact to save a screenshot identical to a saved one as a link to it,
+                                 dhash to do so for screenshots with the same dHash too
+        :param reuse_unchanged_views: bool, take the screenshot before dumping the views, and keep the views of the
+                                      previous state if the screen is unchanged
         :return:
         """
         self.logger = logging.getLogger(self.__class__.__name__)
@@ -61,10 +125,33 @@ class Device(object):
         self.enable_accessibility_hard = enable_accessibility_hard
         self.humanoid = humanoid
         self.ignore_ad = ignore_ad
+        self.state_format = state_format
+        # writes the state files in the background
+        self.state_writer = StateWriter()
+        # the states, events and images go to one store instead of many small files
+        self.run_store = None
+        if state_format == STATE_FORMAT_STORE and output_dir is not None:
+            self.run_store = RunStore(os.path.join(output_dir, RUN_STORE_DIR), writable=True)
+        # runs the stages of the state capture, created on the first capture
+        self.capture_executor = None
+        # stage -> ms, of the last captured state, and summed over the captured states
+        self.capture_timings = {}
+        self.capture_timing_totals = {}
+        self.capture_count = 0
+        self.screenshot_format = screenshot_format
+        self.screenshot_scale = screenshot_scale
+        # the states whose screenshot is in memory, oldest first
+        self.screenshot_states = deque()
+        self.screenshot_dedup = screenshot_dedup
+        # digest or (activity, dHash) of a saved screenshot -> its path, or its name in the run store
+        self.saved_screenshots = {}
+        self.reuse_unchanged_views = reuse_unchanged_views
 
         # basic device information
         self.settings = {}
         self.display_info = None
+        # display info of each screen rotation seen, so that states do not refresh it from adb
+        self.display_info_by_rotation = {}
         self.model_number = None
         self.sdk_version = None
         self.release_version = None
@@ -188,6 +275,13 @@ class Device(object):
             if not adapter_enabled:
                 continue
             adapter.disconnect()
+        if self.capture_executor is not None:
+            self.capture_executor.shutdown(wait=True)
+            self.capture_executor = None
+            self.__report_capture_timings()
+        self.state_writer.close()
+        if self.run_store is not None:
+            self.run_store.close()
 
         if self.output_dir is not None:
             temp_dir = os.path.join(self.output_dir, "temp")
@@ -264,6 +358,20 @@ class Device(object):
             self.display_info = self.adb.get_display_info()
         return self.display_info
 
+    def get_display_info_for_rotation(self, rotation):
+        """
+        get the display information for a screen rotation, refreshed from adb only the first time the rotation is seen
+        :param rotation: int, the rotation of the screen, None if unknown to always refresh
+        :return: dict, display_info
+        """
+        if rotation is not None and rotation in self.display_info_by_rotation:
+            self.display_info = self.display_info_by_rotation[rotation]
+            return self.display_info
+        display_info = self.get_display_info(refresh=True)
+        if rotation is not None and "width" in display_info and "height" in display_info:
+            self.display_info_by_rotation[rotation] = display_info
+        return display_info
+
     def get_width(self, refresh=False):
         display_info = self.get_display_info(refresh=refresh)
         width = 0
@@ -517,11 +625,9 @@ class Device(object):
         """
         Get current activity
         """
-        r = self.adb.shell("dumpsys activity activities")
-        activity_line_re = re.compile(r'\*\s*Hist\s*#\d+:\s*ActivityRecord\{[^ ]+\s*[^ ]+\s*([^ ]+)\s*t(\d+)}')
-        m = activity_line_re.search(r)
-        if m:
-            return m.group(1)
+        top_activity, _ = parse_activities_dump(self.adb.shell("dumpsys activity activities"))
+        if top_activity:
+            return top_activity
         # data = self.adb.shell("dumpsys activity top").splitlines()
         # regex = re.compile("\s*ACTIVITY ([A-Za-z0-9_.]+)/([A-Za-z0-9_.]+)")
         # m = regex.search(data[1])
@@ -535,8 +641,10 @@ class Device(object):
         Get current activity stack
         :return: a list of str, each str is an activity name, the first is the top activity name
         """
-        task_to_activities = self.get_task_activities()
-        top_activity = self.get_top_activity_name()
+        top_activity, task_to_activities = parse_activities_dump(self.adb.shell("dumpsys activity activities"))
+        return self.__get_activity_stack(top_activity, task_to_activities)
+
+    def __get_activity_stack(self, top_activity, task_to_activities):
         if top_activity:
             for task_id in task_to_activities:
                 activities = task_to_activities[task_id]
@@ -552,30 +660,7 @@ class Device(object):
         Get current tasks and corresponding activities.
         :return: a dict mapping each task id to a list of activities, from top to down.
         """
-        task_to_activities = {}
-
-        lines = self.adb.shell("dumpsys activity activities").splitlines()
-        activity_line_re = re.compile(r'\*\s*Hist\s*#\d+:\s*ActivityRecord\{[^ ]+\s*[^ ]+\s*([^ ]+)\s*t(\d+)}')
-
-        for line in lines:
-            line = line.strip()
-            activity_line_task_re = re.compile(r'^\s*Task\s*id\s*#(\d+)|^\s*Task\{\w+\s*#(\d+)')
-            activity_line_task_m = activity_line_task_re.match(line)
-            if activity_line_task_m:
-                if activity_line_task_m.group(1):
-                    task_id = activity_line_task_m.group(1)
-                else:
-                    task_id = activity_line_task_m.group(2)
-                task_to_activities[task_id] = []
-            elif re.match(r'\*\s*Hist\s*#', line):
-                m = activity_line_re.match(line)
-                if m:
-                    activity = m.group(1)
-                    task_id = m.group(2)
-                    if task_id not in task_to_activities:
-                        task_to_activities[task_id] = []
-                    task_to_activities[task_id].append(activity)
-
+        _, task_to_activities = parse_activities_dump(self.adb.shell("dumpsys activity activities"))
         return task_to_activities
 
     def get_service_names(self):
@@ -583,18 +668,23 @@ class Device(object):
         get current running services
         :return: list of services
         """
-        services = []
-        dat = self.adb.shell('dumpsys activity services')
-        lines = dat.splitlines()
-        service_re = re.compile('^.+ServiceRecord{.+ ([A-Za-z0-9_.]+)/([A-Za-z0-9_.]+)')
+        return parse_services_dump(self.adb.shell('dumpsys activity services'))
 
-        for line in lines:
-            m = service_re.search(line)
-            if m:
-                package = m.group(1)
-                service = m.group(2)
-                services.append("%s/%s" % (package, service))
-        return services
+    def get_activity_snapshot(self):
+        """
+        get the top activity, the activity stack and the running services with a single shell command,
+        both dumps are parsed in one pass
+        :return: (top activity name, activity stack, list of services), as returned by get_top_activity_name,
+                 get_current_activity_stack and get_service_names
+        """
+        output = self.adb.shell(["sh", "-c", "dumpsys activity activities; echo %s; dumpsys activity services"
+                                 % DUMPSYS_SEPARATOR])
+        activities_dump, _, services_dump = output.partition(DUMPSYS_SEPARATOR)
+        top_activity, task_to_activities = parse_activities_dump(activities_dump)
+        if not top_activity:
+            self.logger.warning("Unable to get top activity name.")
+        activity_stack = self.__get_activity_stack(top_activity, task_to_activities)
+        return top_activity, activity_stack, parse_services_dump(services_dump)
 
     def get_package_path(self, package_name):
         """
@@ -778,60 +868,160 @@ class Device(object):
         self.adb.run_cmd(["pull", remote_file, local_file])
 
     def take_screenshot(self):
-        # image = None
-        #
-        # received = self.adb.shell("screencap -p").replace("\r\n", "\n")
-        # import StringIO
-        # stream = StringIO.StringIO(received)
-        #
-        # try:
-        #     from PIL import Image
-        #     image = Image.open(stream)
-        # except IOError as e:
-        #     self.logger.warning("exception in take_screenshot: %s" % e)
-        # return image
+        """
+        take a screenshot to the temp dir of the output
+        :return: str, the path of the screenshot, None if failed
+        """
         if self.output_dir is None:
             return None
+        data = self.take_screenshot_data()
+        if data is None:
+            return None
 
         from datetime import datetime
         tag = datetime.now().strftime("%Y-%m-%d_%H%M%S")
         local_image_dir = os.path.join(self.output_dir, "temp")
         if not os.path.exists(local_image_dir):
             os.makedirs(local_image_dir)
+        local_image_path = os.path.join(local_image_dir, "screen_%s.%s" % (tag, get_image_format(data) or SCREENSHOT_FORMAT_PNG))
+        with open(local_image_path, 'wb') as local_image_file:
+            local_image_file.write(data)
+        return local_image_path
 
+    def take_screenshot_data(self):
+        """
+        take a screenshot in memory: the last frame of minicap, or the output of `screencap -p` through adb exec-out,
+        which writes no file on the device
+        :return: bytes, the jpg of minicap or the png of screencap, None if failed
+        """
         if self.adapters[self.minicap] and self.minicap.last_screen:
-            # minicap use jpg format
-            local_image_path = os.path.join(local_image_dir, "screen_%s.jpg" % tag)
-            with open(local_image_path, 'wb') as local_image_file:
-                local_image_file.write(self.minicap.last_screen)
-            return local_image_path
-        else:
-            # screencap use png format
-            local_image_path = os.path.join(local_image_dir, "screen_%s.png" % tag)
-            remote_image_path = "/sdcard/screen_%s.png" % tag
+            return bytes(self.minicap.last_screen)
+        if self.get_sdk_version() >= EXEC_OUT_MIN_SDK_VERSION:
+            try:
+                data = self.adb.exec_out("screencap -p")
+                if get_image_format(data) == SCREENSHOT_FORMAT_PNG:
+                    return data
+                self.logger.warning("screencap did not output a png through exec-out, using the sdcard")
+            except subprocess.CalledProcessError as e:
+                self.logger.warning("exec-out screencap failed, using the sdcard: %s" % e)
+        return self.__pull_screenshot()
+
+    def __pull_screenshot(self):
+        """
+        take a screenshot with screencap to the sdcard, for the devices without exec-out
+        """
+        import tempfile
+        from datetime import datetime
+        tag = datetime.now().strftime("%Y-%m-%d_%H%M%S")
+        remote_image_path = "/sdcard/screen_%s.png" % tag
+        local_image_fd, local_image_path = tempfile.mkstemp(suffix=".png")
+        os.close(local_image_fd)
+        try:
             self.adb.shell("screencap -p %s" % remote_image_path)
             self.pull_file(remote_image_path, local_image_path)
             self.adb.shell("rm %s" % remote_image_path)
+            with open(local_image_path, "rb") as local_image_file:
+                data = local_image_file.read()
+        finally:
+            os.remove(local_image_path)
+        return data or None
 
-        return local_image_path
+    def get_screenshot_format(self):
+        """
+        :return: str, the format of the saved screenshots, jpg with minicap or png if none is chosen
+        """
+        if self.screenshot_format:
+            return self.screenshot_format
+        if self.adapters[self.minicap]:
+            return SCREENSHOT_FORMAT_JPG
+        return SCREENSHOT_FORMAT_PNG
+
+    def __get_state_screenshot(self):
+        if self.output_dir is None:
+            return None
+        return self.take_screenshot_data()
+
+    def find_saved_screenshot(self, state):
+        """
+        :return: str, the saved screenshot of the same screen as the one of a state, a path or a name in the run
+                 store, None if there is none
+        """
+        for key in self.__get_screenshot_keys(state):
+            if key in self.saved_screenshots:
+                return self.saved_screenshots[key]
+        return None
+
+    def add_saved_screenshot(self, state, location):
+        """
+        :param location: str, where the screenshot of a state is saved, a path or a name in the run store
+        """
+        for key in self.__get_screenshot_keys(state):
+            self.saved_screenshots.setdefault(key, location)
+
+    def __get_screenshot_keys(self, state):
+        if state.screenshot_digest is None:
+            return []
+        keys = [state.screenshot_digest]
+        if self.screenshot_dedup == SCREENSHOT_DEDUP_DHASH:
+            try:
+                dhash = state.screenshot_dhash
+            except ImportError:
+                self.logger.warning("opencv is not installed, only identical screenshots are deduplicated")
+                self.screenshot_dedup = SCREENSHOT_DEDUP_EXACT
+                dhash = None
+            if dhash is not None:
+                keys.append((state.foreground_activity, dhash))
+        return keys
+
+    def __keep_screenshot(self, state):
+        """
+        keep the screenshot of a state in memory, dropping the one of the oldest state kept, which is saved by now
+        """
+        if state.screenshot_data is None:
+            return
+        self.screenshot_states.append(state)
+        while len(self.screenshot_states) > SCREENSHOTS_IN_MEMORY:
+            self.screenshot_states.popleft().screenshot_data = None
 
     def get_current_state(self):
         self.logger.debug("getting current device state...")
         current_state = None
+        capture_start = time.perf_counter()
+        self.capture_timings = dict.fromkeys(CAPTURE_STAGES, 0.0)
         try:
-            views = self.get_views()
-            foreground_activity = self.get_top_activity_name()
-            activity_stack = self.get_current_activity_stack()
-            background_services = self.get_service_names()
-            screenshot_path = self.take_screenshot()
-            self.logger.debug("finish getting current device state...")
+            last_state = self.last_know_state
+            screen_unchanged = False
+            if self.reuse_unchanged_views and last_state is not None and last_state.screenshot_digest is not None:
+                # the screenshot tells whether the screen changed, the views are dumped only if it did
+                (foreground_activity, activity_stack, background_services), screenshot_data = self.__capture(
+                    {"activities": self.get_activity_snapshot, "screenshot": self.__get_state_screenshot})
+                screen_unchanged = screenshot_data is not None \
+                    and foreground_activity == last_state.foreground_activity \
+                    and fast_digest(screenshot_data) == last_state.screenshot_digest
+                if screen_unchanged:
+                    views = last_state.views
+                else:
+                    views, = self.__capture({"views": self.get_views})
+            else:
+                views, (foreground_activity, activity_stack, background_services), screenshot_data = \
+                    self.__capture({"views": self.get_views, "activities": self.get_activity_snapshot,
+                                    "screenshot": self.__get_state_screenshot})
             from .device_state import DeviceState
             current_state = DeviceState(self,
                                         views=views,
                                         foreground_activity=foreground_activity,
                                         activity_stack=activity_stack,
                                         background_services=background_services,
-                                        screenshot_path=screenshot_path)
+                                        rotation=self.get_views_rotation(),
+                                        screenshot_data=screenshot_data)
+            current_state.screen_unchanged = screen_unchanged
+            self.__keep_screenshot(current_state)
+            self.__record_capture_timings(capture_start)
+            self.logger.info("state %s: %d views, %.1f KB, captured in %.0f ms (%s)%s" % (
+                current_state.tag, len(current_state.views), current_state.get_memory_size() / 1024.0,
+                self.capture_timings["total"],
+                ", ".join("%s %.0f" % (stage, self.capture_timings[stage]) for stage in CAPTURE_STAGES),
+                ", screen unchanged" if screen_unchanged else ""))
         except Exception as e:
             self.logger.warning("exception in get_current_state: %s" % e)
             import traceback
@@ -842,6 +1032,50 @@ class Device(object):
             self.logger.warning("Failed to get current state!")
         return current_state
 
+    def __capture(self, stages):
+        """
+        run stages of a state capture concurrently, they take as long as the slowest one
+        :param stages: dict, a stage of CAPTURE_STAGES -> its function
+        :return: list, the results of the functions, the exception of a failed stage is raised
+        """
+        if self.capture_executor is None:
+            self.capture_executor = ThreadPoolExecutor(max_workers=len(CAPTURE_STAGES),
+                                                       thread_name_prefix="StateCapture")
+        futures = [self.capture_executor.submit(self.__run_stage, func) for func in stages.values()]
+        # every stage is waited for, even if one fails, so that no stage of this capture overlaps the next one
+        outcomes = [future.result() for future in futures]
+        for stage, (_, elapsed, _) in zip(stages, outcomes):
+            self.capture_timings[stage] = elapsed
+        for _, _, error in outcomes:
+            if error is not None:
+                raise error
+        return [result for result, _, _ in outcomes]
+
+    @staticmethod
+    def __run_stage(func):
+        """
+        :return: (result, ms, exception or None)
+        """
+        start = time.perf_counter()
+        try:
+            result, error = func(), None
+        except Exception as e:
+            result, error = None, e
+        return result, (time.perf_counter() - start) * 1000, error
+
+    def __record_capture_timings(self, capture_start):
+        self.capture_timings["total"] = (time.perf_counter() - capture_start) * 1000
+        for stage, elapsed in self.capture_timings.items():
+            self.capture_timing_totals[stage] = self.capture_timing_totals.get(stage, 0) + elapsed
+        self.capture_count += 1
+
+    def __report_capture_timings(self):
+        if not self.capture_count:
+            return
+        self.logger.info("%d states captured, mean ms per stage: %s" % (self.capture_count, ", ".join(
+            "%s %.0f" % (stage, self.capture_timing_totals[stage] / self.capture_count)
+            for stage in CAPTURE_STAGES + ["total"])))
+
     def get_last_known_state(self):
         return self.last_know_state
 
@@ -905,6 +1139,17 @@ class Device(object):
         self.logger.warning("failed to get current views!")
         return None
 
+    def get_views_rotation(self):
+        """
+        get the screen rotation the last views were dumped in
+        :return: int, None if unknown
+        """
+        if self.cv_mode and self.adapters[self.minicap]:
+            return None
+        if self.uiautomator_helper:
+            return self.uiautomator_helper.rotation
+        return None
+
     def get_random_port(self):
         """
         get a random port on host machine to establish connection
@@ -1,19 +1,206 @@
-import copy
 import math
 import os
 import random
+import string
 
-from .utils import md5
+from .utils import StringTable, fast_digest, lazy_property
+from .view_table import ViewTable, view_to_json
+from .state_store import get_state_file_name, link_screenshot_file, write_screenshot_file
+from .run_store import KIND_SCREENSHOT, KIND_VIEW, put_state
 from .input_event import SearchEvent, SetTextAndSearchEvent, TouchEvent, LongTouchEvent, ScrollEvent, SetTextEvent, KeyEvent
 
 
+# views never sent any event
+NAVIGATION_BAR_IDS = ('android:id/navigationBarBackground', 'android:id/statusBarBackground')
+
+
+def random_text(alphabet, min_size, max_size):
+    """
+    random text for SetTextEvent, drawn with the random module so that it follows its seed
+    :param alphabet: str, the characters to draw from
+    """
+    return "".join(random.choice(alphabet) for _ in range(random.randint(min_size, max_size)))
+
+
+class SignatureTable(StringTable):
+    """
+    the view signatures seen in the run, shared by all its states
+    the near-identical states of a run repeat the same signatures, each is formatted and hashed once
+    the signatures include the texts of the views, so a long run with changing texts (clocks, feeds) would grow the
+    table without bound: it is emptied when it holds more than max_size signatures, see trim
+    a signature seen again afterwards is only formatted and hashed again, its digest is the same
+    """
+
+    def __init__(self, signature_format, max_size=100000):
+        """
+        :param signature_format: str, the format of the signatures, filled with the attributes of a view
+        :param max_size: int, the number of signatures kept at most between two states
+        """
+        super(SignatureTable, self).__init__()
+        self.signature_format = signature_format
+        self.max_size = max_size
+        # the digest of each signature, by id
+        self.digests = []
+        # the id of the signature of every combination of attributes seen
+        self.ids_by_attributes = {}
+
+    def get_id(self, string):
+        string_id = self.ids.get(string)
+        if string_id is None:
+            string_id = super(SignatureTable, self).get_id(string)
+            self.digests.append(fast_digest(string.encode('utf-8')))
+        return string_id
+
+    def get_id_for_attributes(self, attributes):
+        """
+        :param attributes: tuple, the attributes filling the signature format
+        :return: int, the id of the signature
+        """
+        string_id = self.ids_by_attributes.get(attributes)
+        if string_id is None:
+            string_id = self.ids_by_attributes[attributes] = self.get_id(self.signature_format % attributes)
+        return string_id
+
+    def clear(self):
+        super(SignatureTable, self).clear()
+        del self.digests[:]
+        self.ids_by_attributes.clear()
+
+    def trim(self):
+        """
+        empty the table if it holds more than max_size signatures
+        only called before a state is hashed, as the ids taken while hashing a state must stay valid until it is done
+        """
+        if len(self) > self.max_size:
+            self.clear()
+
+
+VIEW_SIGNATURES = SignatureTable("[class]%s[resource_id]%s[text]%s[%s,%s,%s]")
+CONTENT_FREE_VIEW_SIGNATURES = SignatureTable("[class]%s[resource_id]%s")
+
+
+# keys DeviceState caches on the view dicts, not part of the views dumped from the device
+VIEW_DERIVED_KEYS = frozenset(['signature', 'content_free_signature', 'view_str', 'view_structure',
+                               'allowed_actions', 'special_attrs', 'local_id', 'desc'])
+
+
+class ViewIndex(object):
+    """
+    parent array, depth and Euler tour numbering of the views of a state, built in one pass,
+    so that ancestor and descendant queries do not walk the tree again and again
+    """
+
+    def __init__(self, views):
+        """
+        :param views: list of dict, DeviceState.views, the children and parent of a view are indexes in it
+        """
+        self.views = views
+        count = len(views)
+        self.parents = [-1] * count
+        self.depths = [0] * count
+        # the descendants of view i are order[tin[i] + 1:tout[i]]
+        self.order = []
+        self.tin = [0] * count
+        self.tout = [0] * count
+        for view_id, view in enumerate(views):
+            parent_id = view.get('parent')
+            if parent_id is not None and 0 <= parent_id < count:
+                self.parents[view_id] = parent_id
+
+        visited = [False] * count
+        for root_id in range(count):
+            if visited[root_id] or self.parents[root_id] != -1:
+                continue
+            self.__visit(root_id, visited)
+        # views not reachable from a root, e.g. in a parent cycle, are numbered on their own
+        for view_id in range(count):
+            if not visited[view_id]:
+                self.__visit(view_id, visited)
+        self.__top_down = None
+        self.__inherited = {}
+
+    def __visit(self, root_id, visited):
+        visited[root_id] = True
+        self.tin[root_id] = len(self.order)
+        self.order.append(root_id)
+        stack = [(root_id, iter(self.views[root_id].get('children') or []))]
+        while stack:
+            view_id, children = stack[-1]
+            for child_id in children:
+                if 0 <= child_id < len(self.views) and not visited[child_id]:
+                    visited[child_id] = True
+                    self.depths[child_id] = self.depths[view_id] + 1
+                    self.tin[child_id] = len(self.order)
+                    self.order.append(child_id)
+                    stack.append((child_id, iter(self.views[child_id].get('children') or [])))
+                    break
+            else:
+                self.tout[view_id] = len(self.order)
+                stack.pop()
+
+    def top_down_order(self):
+        """
+        :return: list of int, all the view ids, each after its parent (following the parent array)
+        """
+        if self.__top_down is None:
+            order = []
+            placed = [False] * len(self.views)
+            for view_id in range(len(self.views)):
+                chain = []
+                in_chain = set()
+                while view_id != -1 and not placed[view_id] and view_id not in in_chain:
+                    chain.append(view_id)
+                    in_chain.add(view_id)
+                    view_id = self.parents[view_id]
+                for chain_id in reversed(chain):
+                    placed[chain_id] = True
+                    order.append(chain_id)
+            self.__top_down = order
+        return self.__top_down
+
+    def ancestors(self, parent_id):
+        """
+        :param parent_id: the parent of a view
+        :return: list of int, the ids of the view's ancestors, from the parent up to the root
+        """
+        result = []
+        while 0 <= parent_id < len(self.parents) and len(result) < len(self.parents):
+            result.append(parent_id)
+            parent_id = self.parents[parent_id]
+        return result
+
+    def descendants(self, view_id):
+        """
+        :return: list of int, the ids of all the views in the subtree of view_id, without itself
+        """
+        return self.order[self.tin[view_id] + 1:self.tout[view_id]]
+
+    def is_ancestor(self, ancestor_id, view_id):
+        return self.tin[ancestor_id] < self.tin[view_id] and self.tout[view_id] <= self.tout[ancestor_id]
+
+    def inherited(self, key):
+        """
+        for each view, the first truthy value of key on the view or its ancestors, None if there is none
+        :return: list indexed by view id
+        """
+        if key not in self.__inherited:
+            values = [None] * len(self.views)
+            for view_id in self.top_down_order():
+                value = self.views[view_id].get(key)
+                if not value and self.parents[view_id] != -1 and values[self.parents[view_id]]:
+                    value = values[self.parents[view_id]]
+                values[view_id] = value if value else None
+            self.__inherited[key] = values
+        return self.__inherited[key]
+
+
 class DeviceState(object):
     """
     the state of the current device
     """
 
     def __init__(self, device, views, foreground_activity, activity_stack, background_services,
-                 tag=None, screenshot_path=None):
+                 tag=None, screenshot_path=None, rotation=None, screenshot_data=None):
         self.device = device
         self.foreground_activity = foreground_activity
         self.activity_stack = activity_stack if isinstance(activity_stack, list) else []
@@ -23,17 +210,31 @@ class DeviceState(object):
             tag = datetime.now().strftime("%Y-%m-%d_%H%M%S")
         self.tag = tag
         self.screenshot_path = screenshot_path
+        # the screenshot as captured, kept in memory until it is saved and a few more states are captured
+        self.screenshot_data = screenshot_data
+        # the size of the saved screenshot relative to the screen
+        self.screenshot_scale = device.screenshot_scale if screenshot_data else 1.0
+        # identifies the screenshots of an identical screen
+        self.screenshot_digest = fast_digest(screenshot_data) if screenshot_data else None
+        # set by Device.get_current_state if the screen is the one of the previous state, whose views are reused
+        self.screen_unchanged = False
         self.views = self.__parse_views(views)
-        self.view_tree = {}
-        self.__assemble_view_tree(self.view_tree, self.views)
-        self.__generate_view_strs()
-        self.state_str = self.__get_state_str()
-        self.structure_str = self.__get_content_free_state_str()
-        self.search_content = self.__get_search_content()
-        self.text_representation = self.get_text_representation()
+        self.state_str, self.structure_str = self._hash_views()
+        if self.device.humanoid is not None:
+            self.state_str = self.__get_humanoid_state_str("render_view_tree")
+            self.structure_str = self.__get_humanoid_state_str("render_content_free_view_tree")
         self.possible_events = None
-        self.width = device.get_width(refresh=True)
-        self.height = device.get_height(refresh=False)
+        display_info = device.get_display_info_for_rotation(rotation)
+        self.width = display_info.get("width", 0)
+        self.height = display_info.get("height", 0)
+
+    @lazy_property
+    def search_content(self):
+        return self.__get_search_content()
+
+    @lazy_property
+    def text_representation(self):
+        return self.get_text_representation()
 
     @property
     def activity_short_name(self):
@@ -48,45 +249,99 @@ class DeviceState(object):
                  'background_services': self.background_services,
                  'width': self.width,
                  'height': self.height,
+                 'screenshot_scale': self.screenshot_scale,
                  'views': self.views}
         return state
 
     def to_json(self):
         import json
-        return json.dumps(self.to_dict(), indent=2)
+        return json.dumps(self.to_dict(), indent=2, default=view_to_json)
 
     def __parse_views(self, raw_views):
-        views = []
+        """
+        store the views in a ViewTable
+        :return: list of ViewRecord, which behave as the view dicts
+        """
         if not raw_views or len(raw_views) == 0:
-            return views
-
-        for view_dict in raw_views:
-            # # Simplify resource_id
-            # resource_id = view_dict['resource_id']
-            # if resource_id is not None and ":" in resource_id:
-            #     resource_id = resource_id[(resource_id.find(":") + 1):]
-            #     view_dict['resource_id'] = resource_id
-            views.append(view_dict)
-        return views
-
-    def __assemble_view_tree(self, root_view, views):
-        if not len(self.view_tree): # bootstrap
-            if not len(views): # to fix if views is empty
-                return
-            self.view_tree = copy.deepcopy(views[0])
-            self.__assemble_view_tree(self.view_tree, views)
-        else:
-            children = list(enumerate(root_view["children"]))
-            if not len(children):
-                return
-            for i, j in children:
-                root_view["children"][i] = copy.deepcopy(self.views[j])
-                self.__assemble_view_tree(root_view["children"][i], views)
+            self.view_table = None
+            return []
+        self.view_table = ViewTable(raw_views)
+        return self.view_table.records
 
-    def __generate_view_strs(self):
-        for view_dict in self.views:
-            self.__get_view_str(view_dict)
-            # self.__get_view_structure(view_dict)
+    def get_memory_size(self):
+        """
+        approximate memory used by the views of this state
+        :return: int, size in bytes
+        """
+        return self.view_table.nbytes() if self.view_table is not None else 0
+
+    @lazy_property
+    def view_tree(self):
+        """
+        the views as a nested tree, built on first access (humanoid, exporters)
+        each node is a shallow copy of a view without the keys cached on it by this class,
+        with its children ids replaced by the child nodes
+        @return: the root node, {} if there is no view
+        """
+        if not len(self.views):
+            return {}
+        nodes = [{key: value for key, value in view.items() if key not in VIEW_DERIVED_KEYS}
+                 for view in self.views]
+        for node in nodes:
+            node["children"] = [nodes[child_id] for child_id in node["children"]]
+        return nodes[0]
+
+    @lazy_property
+    def view_index(self):
+        return ViewIndex(self.views)
+
+    def _hash_views(self):
+        """
+        hash all the views in one pass, ancestors first: the signatures of every view are hashed once,
+        and the ancestors of a view are hashed as a chain extending the hash of its parent's ancestors
+        the view_str of each view, the state_str and the structure_str are derived from these digests
+        :return: (state_str, structure_str), the hashes of the foreground activity and the set of
+                 (content-free) view signatures
+        """
+        VIEW_SIGNATURES.trim()
+        CONTENT_FREE_VIEW_SIGNATURES.trim()
+        count = len(self.views)
+        view_index = self.view_index
+        parents = view_index.parents
+        signature_digests = [b""] * count
+        # digest of the signatures from the root down to the view
+        path_digests = [b""] * count
+        # many views share a signature, each distinct signature of the run is formatted and hashed once
+        all_signature_digests = VIEW_SIGNATURES.digests
+        signature_ids = set()
+        content_free_signature_ids = set()
+        for view_id in view_index.top_down_order():
+            view_dict = self.views[view_id]
+            signature_id = DeviceState.__get_view_signature_id(view_dict)
+            signature_ids.add(signature_id)
+            signature_digest = signature_digests[view_id] = all_signature_digests[signature_id]
+            parent_id = parents[view_id]
+            if parent_id == -1 or not path_digests[parent_id]:
+                path_digests[view_id] = signature_digest
+            else:
+                path_digests[view_id] = fast_digest(path_digests[parent_id] + signature_digest)
+            content_free_signature_ids.add(DeviceState.__get_content_free_view_signature_id(view_dict))
+
+        activity_digest = fast_digest(str(self.foreground_activity).encode('utf-8'))
+        for view_id, view_dict in enumerate(self.views):
+            if 'view_str' in view_dict:
+                continue
+            parent_id = parents[view_id]
+            # every part has a fixed size except the children, so the concatenation is unambiguous
+            parent_path = path_digests[parent_id] if parent_id != -1 else bytes(16)
+            child_digests = sorted(signature_digests[child_id] for child_id in set(view_dict.get('children') or ())
+                                   if 0 <= child_id < count)
+            view_dict['view_str'] = fast_digest(activity_digest + signature_digests[view_id] + parent_path +
+                                                b"".join(child_digests)).hex()
+        return DeviceState.__hash_digest_set(self.foreground_activity,
+                                             [all_signature_digests[i] for i in signature_ids]), \
+            DeviceState.__hash_digest_set(self.foreground_activity,
+                                          [CONTENT_FREE_VIEW_SIGNATURES.digests[i] for i in content_free_signature_ids])
 
     @staticmethod
     def __calculate_depth(views):
@@ -103,47 +358,24 @@ class DeviceState(object):
         for view_id in DeviceState.__safe_dict_get(view_dict, 'children', []):
             DeviceState.__assign_depth(views, views[view_id], depth + 1)
 
-    def __get_state_str(self):
-        state_str_raw = self.__get_state_str_raw()
-        return md5(state_str_raw)
+    def __get_humanoid_state_str(self, render_method):
+        """
+        hash the view tree rendered by humanoid
+        :param render_method: render_view_tree or render_content_free_view_tree
+        """
+        import json
+        from xmlrpc.client import ServerProxy
+        proxy = ServerProxy("http://%s/" % self.device.humanoid)
+        state_str_raw = getattr(proxy, render_method)(json.dumps({
+            "view_tree": self.view_tree,
+            "screen_res": [self.device.display_info["width"],
+                           self.device.display_info["height"]]
+        }))
+        return fast_digest(state_str_raw.encode('utf-8')).hex()
 
-    def __get_state_str_raw(self):
-        if self.device.humanoid is not None:
-            import json
-            from xmlrpc.client import ServerProxy
-            proxy = ServerProxy("http://%s/" % self.device.humanoid)
-            return proxy.render_view_tree(json.dumps({
-                "view_tree": self.view_tree,
-                "screen_res": [self.device.display_info["width"],
-                               self.device.display_info["height"]]
-            }))
-        else:
-            view_signatures = set()
-            for view in self.views:
-                view_signature = DeviceState.__get_view_signature(view)
-                if view_signature:
-                    view_signatures.add(view_signature)
-            return "%s{%s}" % (self.foreground_activity, ",".join(sorted(view_signatures)))
-
-    def __get_content_free_state_str(self):
-        if self.device.humanoid is not None:
-            import json
-            from xmlrpc.client import ServerProxy
-            proxy = ServerProxy("http://%s/" % self.device.humanoid)
-            state_str = proxy.render_content_free_view_tree(json.dumps({
-                "view_tree": self.view_tree,
-                "screen_res": [self.device.display_info["width"],
-                               self.device.display_info["height"]]
-            }))
-        else:
-            view_signatures = set()
-            for view in self.views:
-                view_signature = DeviceState.__get_content_free_view_signature(view)
-                if view_signature:
-                    view_signatures.add(view_signature)
-            state_str = "%s{%s}" % (self.foreground_activity, ",".join(sorted(view_signatures)))
-        import hashlib
-        return hashlib.md5(state_str.encode('utf-8')).hexdigest()
+    @staticmethod
+    def __hash_digest_set(foreground_activity, digests):
+        return fast_digest(str(foreground_activity).encode('utf-8') + b"{" + b"".join(sorted(digests))).hex()
 
     def __get_search_content(self):
         """
@@ -166,25 +398,87 @@ class DeviceState(object):
                 property_values.add(property_value)
         return property_values
 
+    def get_screenshot_file_name(self):
+        """
+        :return: str, the name of the screenshot of this state in the states directory
+        """
+        return "screen_%s.%s" % (self.tag, self.device.get_screenshot_format())
+
+    @lazy_property
+    def screenshot_dhash(self):
+        """
+        int, the dHash of the screenshot, None if there is none, raises ImportError if opencv is not installed
+        """
+        from .adapter import cv
+        if self.screenshot_data is not None:
+            return cv.calculate_dhash_value_from_buf(self.screenshot_data)
+        if self.screenshot_path and os.path.exists(self.screenshot_path):
+            image = cv.load_image_from_path(self.screenshot_path)
+            return cv.calculate_dhash_value(image) if image is not None else None
+        return None
+
+    def get_screenshot_image(self):
+        """
+        :return: PIL.Image, the screenshot in the coordinates of the views, None if there is none
+        """
+        import io
+        from PIL import Image
+        if self.screenshot_data is not None:
+            return Image.open(io.BytesIO(self.screenshot_data))
+        # the saved screenshot may still be waiting in the writer
+        if self.device.run_store is not None and self.screenshot_path is None:
+            self.device.state_writer.flush()
+            data = self.device.run_store.get(KIND_SCREENSHOT, self.get_screenshot_file_name())
+            if data is None:
+                return None
+            image = Image.open(io.BytesIO(data))
+        elif self.screenshot_path:
+            if not os.path.exists(self.screenshot_path):
+                self.device.state_writer.flush()
+            image = Image.open(self.screenshot_path)
+        else:
+            return None
+        if self.screenshot_scale != 1.0:
+            image = image.resize((round(image.width / self.screenshot_scale),
+                                  round(image.height / self.screenshot_scale)))
+        return image
+
     def save2dir(self, output_dir=None):
         try:
+            # the screenshots saved to the output dir of the device are deduplicated
+            dedup = output_dir is None
             if output_dir is None:
                 if self.device.output_dir is None:
                     return
-                else:
-                    output_dir = os.path.join(self.device.output_dir, "states")
+                if self.device.run_store is not None:
+                    self.__save2store()
+                    return
+                output_dir = os.path.join(self.device.output_dir, "states")
             if not os.path.exists(output_dir):
                 os.makedirs(output_dir)
-            dest_state_json_path = "%s/state_%s.json" % (output_dir, self.tag)
-            if self.device.adapters[self.device.minicap]:
-                dest_screenshot_path = "%s/screen_%s.jpg" % (output_dir, self.tag)
+            dest_state_path = os.path.join(output_dir, get_state_file_name(self.tag, self.device.state_format))
+            dest_screenshot_path = os.path.join(output_dir, self.get_screenshot_file_name())
+            self.device.state_writer.submit(dest_state_path, self.__get_state_snapshot())
+            saved_screenshot_path = self.device.find_saved_screenshot(self) if dedup else None
+            if saved_screenshot_path is not None:
+                # the same screen is saved already
+                self.device.state_writer.submit_job(link_screenshot_file, saved_screenshot_path,
+                                                    dest_screenshot_path)
+            elif self.screenshot_data is not None:
+                # encoded, scaled and written once, by the writer
+                self.device.state_writer.submit_job(write_screenshot_file, dest_screenshot_path,
+                                                    self.screenshot_data, self.screenshot_scale)
+                if dedup:
+                    self.device.add_saved_screenshot(self, dest_screenshot_path)
+            elif self.screenshot_path:
+                # the screenshot is moved out of the temp dir rather than written a second time
+                try:
+                    os.replace(self.screenshot_path, dest_screenshot_path)
+                except OSError:
+                    import shutil
+                    shutil.copyfile(self.screenshot_path, dest_screenshot_path)
             else:
-                dest_screenshot_path = "%s/screen_%s.png" % (output_dir, self.tag)
-            state_json_file = open(dest_state_json_path, "w")
-            state_json_file.write(self.to_json())
-            state_json_file.close()
-            import shutil
-            shutil.copyfile(self.screenshot_path, dest_screenshot_path)
+                return
             self.screenshot_path = dest_screenshot_path
             # from PIL.Image import Image
             # if isinstance(self.screenshot_path, Image):
@@ -192,32 +486,64 @@ class DeviceState(object):
         except Exception as e:
             self.device.logger.warning(e)
 
+    def __get_state_snapshot(self):
+        """
+        the state with the views copied to plain dicts, so that the writer thread can encode it while exploring goes on
+        """
+        state_dict = self.to_dict()
+        state_dict['views'] = [dict(view) for view in self.views]
+        return state_dict
+
+    def __save2store(self):
+        """
+        save the state and its screenshot to the run store, a screen saved already is only referenced
+        """
+        screenshot_name = self.get_screenshot_file_name()
+        screenshot_link = self.device.find_saved_screenshot(self)
+        self.device.state_writer.submit_job(put_state, self.device.run_store, self.__get_state_snapshot(),
+                                            self.screenshot_data, screenshot_name, self.screenshot_scale,
+                                            screenshot_link, self.screenshot_path)
+        if screenshot_link is None and self.screenshot_data is not None:
+            self.device.add_saved_screenshot(self, screenshot_name)
+
     def save_view_img(self, view_dict, output_dir=None):
         try:
-            if output_dir is None:
-                if self.device.output_dir is None:
-                    return
-                else:
-                    output_dir = os.path.join(self.device.output_dir, "views")
-            if not os.path.exists(output_dir):
-                os.makedirs(output_dir)
             view_str = view_dict['view_str']
             if self.device.adapters[self.device.minicap]:
-                view_file_path = "%s/view_%s.jpg" % (output_dir, view_str)
+                view_file_name = "view_%s.jpg" % view_str
             else:
-                view_file_path = "%s/view_%s.png" % (output_dir, view_str)
-            if os.path.exists(view_file_path):
+                view_file_name = "view_%s.png" % view_str
+            run_store = None
+            if output_dir is None:
+                if self.device.output_dir is None:
+                    return
+                run_store = self.device.run_store
+                output_dir = os.path.join(self.device.output_dir, "views")
+            view_file_path = os.path.join(output_dir, view_file_name)
+            if run_store is not None:
+                if run_store.contains(KIND_VIEW, view_file_name):
+                    return
+            elif os.path.exists(view_file_path):
                 return
-            from PIL import Image
+            elif not os.path.exists(output_dir):
+                os.makedirs(output_dir)
             # Load the original image:
             view_bound = view_dict['bounds']
-            original_img = Image.open(self.screenshot_path)
+            original_img = self.get_screenshot_image()
+            if original_img is None:
+                return
             # view bound should be in original image bound
             view_img = original_img.crop((min(original_img.width - 1, max(0, view_bound[0][0])),
                                           min(original_img.height - 1, max(0, view_bound[0][1])),
                                           min(original_img.width, max(0, view_bound[1][0])),
                                           min(original_img.height, max(0, view_bound[1][1]))))
-            view_img.convert("RGB").save(view_file_path)
+            if run_store is not None:
+                import io
+                view_img_bytes = io.BytesIO()
+                view_img.convert("RGB").save(view_img_bytes, format="JPEG" if view_file_name.endswith(".jpg") else "PNG")
+                self.device.state_writer.submit_job(run_store.put, KIND_VIEW, view_file_name, view_img_bytes.getvalue())
+            else:
+                view_img.convert("RGB").save(view_file_path)
         except Exception as e:
             self.device.logger.warning(e)
     
@@ -248,7 +574,6 @@ class DeviceState(object):
                     view_file_path = "%s/view_%s.png" % (output_dir, view_str)
                 if os.path.exists(view_file_path):
                     continue
-                from PIL import Image
                 # Load the original image:
                 view_bound = view_dict['bounds']
                 # ignore the view if its bounds are a line or a point or less than 0
@@ -256,7 +581,9 @@ class DeviceState(object):
                 #    self.device.logger.warning("View %s has invalid bounds %s, skip saving." %
                 #                               (view_str, view_bound))
                 #    continue
-                original_img = Image.open(self.screenshot_path)
+                original_img = self.get_screenshot_image()
+                if original_img is None:
+                    return
                 # view bound should be in original image bound
                 view_img = original_img.crop((min(original_img.width - 1, max(0, view_bound[0][0])),
                                             min(original_img.height - 1, max(0, view_bound[0][1])),
@@ -276,67 +603,45 @@ class DeviceState(object):
         return self.state_str != another_state.state_str
 
     @staticmethod
-    def __get_view_signature(view_dict):
+    def __get_view_signature_id(view_dict):
         """
-        get the signature of the given view
+        get the id of the signature of the given view in VIEW_SIGNATURES
         @param view_dict: dict, an element of list DeviceState.views
-        @return:
+        @return: int
         """
-        if 'signature' in view_dict:
-            return view_dict['signature']
+        signature = view_dict.get('signature')
+        if signature is not None:
+            return VIEW_SIGNATURES.get_id(signature)
 
         view_text = DeviceState.__safe_dict_get(view_dict, 'text', "None")
-        if view_text is None or len(view_text) > 50:
+        if len(view_text) > 50:
             view_text = "None"
 
-        signature = "[class]%s[resource_id]%s[text]%s[%s,%s,%s]" % \
-                    (DeviceState.__safe_dict_get(view_dict, 'class', "None"),
-                     DeviceState.__safe_dict_get(view_dict, 'resource_id', "None"),
-                     view_text,
-                     DeviceState.__key_if_true(view_dict, 'enabled'),
-                     DeviceState.__key_if_true(view_dict, 'checked'),
-                     DeviceState.__key_if_true(view_dict, 'selected'))
-        view_dict['signature'] = signature
-        return signature
+        signature_id = VIEW_SIGNATURES.get_id_for_attributes(
+            (DeviceState.__safe_dict_get(view_dict, 'class', "None"),
+             DeviceState.__safe_dict_get(view_dict, 'resource_id', "None"),
+             view_text,
+             DeviceState.__key_if_true(view_dict, 'enabled'),
+             DeviceState.__key_if_true(view_dict, 'checked'),
+             DeviceState.__key_if_true(view_dict, 'selected')))
+        view_dict['signature'] = VIEW_SIGNATURES.get_string(signature_id)
+        return signature_id
 
     @staticmethod
-    def __get_content_free_view_signature(view_dict):
+    def __get_content_free_view_signature_id(view_dict):
         """
-        get the content-free signature of the given view
+        get the id of the content-free signature of the given view in CONTENT_FREE_VIEW_SIGNATURES
         @param view_dict: dict, an element of list DeviceState.views
-        @return:
-        """
-        if 'content_free_signature' in view_dict:
-            return view_dict['content_free_signature']
-        content_free_signature = "[class]%s[resource_id]%s" % \
-                                 (DeviceState.__safe_dict_get(view_dict, 'class', "None"),
-                                  DeviceState.__safe_dict_get(view_dict, 'resource_id', "None"))
-        view_dict['content_free_signature'] = content_free_signature
-        return content_free_signature
-
-    def __get_view_str(self, view_dict):
+        @return: int
         """
-        get a string which can represent the given view
-        @param view_dict: dict, an element of list DeviceState.views
-        @return:
-        """
-        if 'view_str' in view_dict:
-            return view_dict['view_str']
-        view_signature = DeviceState.__get_view_signature(view_dict)
-        parent_strs = []
-        for parent_id in self.get_all_ancestors(view_dict):
-            parent_strs.append(DeviceState.__get_view_signature(self.views[parent_id]))
-        parent_strs.reverse()
-        child_strs = []
-        for child_id in self.get_all_children(view_dict):
-            child_strs.append(DeviceState.__get_view_signature(self.views[child_id]))
-        child_strs.sort()
-        view_str = "Activity:%s\nSelf:%s\nParents:%s\nChildren:%s" % \
-                   (self.foreground_activity, view_signature, "//".join(parent_strs), "||".join(child_strs))
-        import hashlib
-        view_str = hashlib.md5(view_str.encode('utf-8')).hexdigest()
-        view_dict['view_str'] = view_str
-        return view_str
+        content_free_signature = view_dict.get('content_free_signature')
+        if content_free_signature is not None:
+            return CONTENT_FREE_VIEW_SIGNATURES.get_id(content_free_signature)
+        signature_id = CONTENT_FREE_VIEW_SIGNATURES.get_id_for_attributes(
+            (DeviceState.__safe_dict_get(view_dict, 'class', "None"),
+             DeviceState.__safe_dict_get(view_dict, 'resource_id', "None")))
+        view_dict['content_free_signature'] = CONTENT_FREE_VIEW_SIGNATURES.get_string(signature_id)
+        return signature_id
 
     def __get_view_structure(self, view_dict):
         """
@@ -371,11 +676,11 @@ class DeviceState(object):
 
     @staticmethod
     def __key_if_true(view_dict, key):
-        return key if (key in view_dict and view_dict[key]) else ""
+        return key if view_dict.get(key) else ""
 
     @staticmethod
     def __safe_dict_get(view_dict, key, default=None):
-        value = view_dict[key] if key in view_dict else None
+        value = view_dict.get(key)
         return value if value is not None else default
 
     @staticmethod
@@ -414,12 +719,7 @@ class DeviceState(object):
         :param view_dict: dict, an element of DeviceState.views
         :return: list of int, each int is an ancestor node id
         """
-        result = []
-        parent_id = self.__safe_dict_get(view_dict, 'parent', -1)
-        if 0 <= parent_id < len(self.views):
-            result.append(parent_id)
-            result += self.get_all_ancestors(self.views[parent_id])
-        return result
+        return self.view_index.ancestors(self.__safe_dict_get(view_dict, 'parent', -1))
 
     def get_all_children(self, view_dict):
         """
@@ -430,11 +730,19 @@ class DeviceState(object):
         children = self.__safe_dict_get(view_dict, 'children')
         if not children:
             return set()
-        children = set(children)
-        for child in children:
-            children_of_child = self.get_all_children(self.views[child])
-            children.union(children_of_child)
-        return children
+        return set(children)
+
+    def get_all_descendants(self, view_dict):
+        """
+        Get temp view ids of all the views under the given view
+        :param view_dict: dict, an element of DeviceState.views
+        :return: set of int, each int is a descendant node id
+        """
+        descendants = set()
+        for child_id in self.get_all_children(view_dict):
+            descendants.add(child_id)
+            descendants.update(self.view_index.descendants(child_id))
+        return descendants
 
     def get_app_activity_depth(self, app):
         """
@@ -456,112 +764,82 @@ class DeviceState(object):
         """
         if self.possible_events:
             return [] + self.possible_events
-        possible_events = []
-        enabled_view_ids = []
-        touch_exclude_view_ids = set()
-        for view_dict in self.views:
+        # the events are collected in one pass, in buckets, to keep the order of the former one pass per kind:
+        # touches of clickable views, scrolls, touches of checkable views, long touches, text inputs,
+        # and last the touches of the leaf views not handled before
+        touch_events = []
+        scroll_events = []
+        check_events = []
+        long_touch_events = []
+        text_events = []
+        leaf_view_ids = []
+        touch_excluded = bytearray(len(self.views))
+
+        # Ting: reverse the tree and conduct bottom-up checking
+        for view_dict in reversed(self.views):
             # exclude navigation bar if exists
-            if (
+            resource_id = self.__safe_dict_get(view_dict, 'resource_id')
+            if not (
                 self.__safe_dict_get(view_dict, 'enabled')
                 and self.__safe_dict_get(view_dict, 'visible')
-                and self.__safe_dict_get(view_dict, 'resource_id')
-                not in [
-                    'android:id/navigationBarBackground',
-                    'android:id/statusBarBackground',
-                ]
+                and resource_id not in NAVIGATION_BAR_IDS
             ):
-                enabled_view_ids.append(view_dict['temp_id'])
-
-        # Ting: reverse the tree and conduct bottom-up checking
-        enabled_view_ids.reverse()
-
-        for view_id in enabled_view_ids:
-            if self.__safe_dict_get(self.views[view_id], 'clickable') and not (
-                '.widget.EditText' in self.__safe_dict_get(self.views[view_id], 'class')
-            ):
-                # Ting: do not generate the "click" event for EditText
-
-                possible_events.append(TouchEvent(view=self.views[view_id]))
-                touch_exclude_view_ids.add(view_id)
+                continue
+            view_id = view_dict['temp_id']
+            view_class = self.__safe_dict_get(view_dict, 'class')
+            clickable = self.__safe_dict_get(view_dict, 'clickable')
+            checkable = self.__safe_dict_get(view_dict, 'checkable')
+            children = self.__safe_dict_get(view_dict, 'children')
+
+            # Ting: do not generate the "click" event for EditText
+            if clickable and not ('.widget.EditText' in view_class):
+                touch_events.append(TouchEvent(view=view_dict))
                 # Ting: fix a bug: add union return values
-                touch_exclude_view_ids = touch_exclude_view_ids.union(
-                    self.get_all_children(self.views[view_id])
-                )
-                # Ting: 
+                self.__exclude_from_touch(touch_excluded, view_id, children)
+                # Ting:
                 if "org.y20k.transistor" in self.foreground_activity and \
-                        self.views[view_id]['resource_id'] == "org.y20k.transistor:id/player_sheet":
-                    possible_events.append(ScrollEvent(view=self.views[view_id], direction="UP"))
+                        resource_id == "org.y20k.transistor:id/player_sheet":
+                    touch_events.append(ScrollEvent(view=view_dict, direction="UP"))
                 if "org.y20k.transistor" in self.foreground_activity and \
-                        self.views[view_id]['resource_id'] == "org.y20k.transistor:id/station_card":
-                    possible_events.append(ScrollEvent(view=self.views[view_id], direction="RIGHT"))
+                        resource_id == "org.y20k.transistor:id/station_card":
+                    touch_events.append(ScrollEvent(view=view_dict, direction="RIGHT"))
 
-        for view_id in enabled_view_ids:
-            if self.__safe_dict_get(self.views[view_id], 'scrollable'):
-                possible_events.append(
-                    ScrollEvent(view=self.views[view_id], direction="UP")
-                )
-                possible_events.append(
-                    ScrollEvent(view=self.views[view_id], direction="DOWN")
-                )
-                possible_events.append(
-                    ScrollEvent(view=self.views[view_id], direction="LEFT")
-                )
-                possible_events.append(
-                    ScrollEvent(view=self.views[view_id], direction="RIGHT")
-                )
+            if self.__safe_dict_get(view_dict, 'scrollable'):
+                for direction in ("UP", "DOWN", "LEFT", "RIGHT"):
+                    scroll_events.append(ScrollEvent(view=view_dict, direction=direction))
 
-        for view_id in enabled_view_ids:
-            if self.__safe_dict_get(self.views[view_id], 'checkable'):
-                possible_events.append(TouchEvent(view=self.views[view_id]))
-                touch_exclude_view_ids.add(view_id)
-                # Ting: fix a bug: add union return values
-                touch_exclude_view_ids = touch_exclude_view_ids.union(
-                    self.get_all_children(self.views[view_id])
-                )
+            if checkable:
+                check_events.append(TouchEvent(view=view_dict))
+                self.__exclude_from_touch(touch_excluded, view_id, children)
 
-        for view_id in enabled_view_ids:
-            
-            if self.__safe_dict_get(self.views[view_id], 'long_clickable') and not self.__safe_dict_get(self.views[view_id], 'class') == 'android.widget.EditText':
-                possible_events.append(LongTouchEvent(view=self.views[view_id]))
+            if self.__safe_dict_get(view_dict, 'long_clickable') and not view_class == 'android.widget.EditText':
+                long_touch_events.append(LongTouchEvent(view=view_dict))
 
-        for view_id in enabled_view_ids:
-            if self.__safe_dict_get(self.views[view_id], 'editable'):
-                from hypothesis import strategies as st
-                import string
-                sample_text = st.text(alphabet=string.printable,min_size=0, max_size=8).example()
+            if self.__safe_dict_get(view_dict, 'editable'):
+                sample_text = random_text(string.printable, 0, 8)
                 if random.random() < 0.5:
-                    sample_text = st.text(alphabet=string.ascii_letters,min_size=0, max_size=8).example()
-                possible_events.append(
-                    SetTextEvent(view=self.views[view_id], text=sample_text)
-                )
-                
-                if  self.__safe_dict_get(self.views[view_id], 'resource_id') is not None and "search" in self.__safe_dict_get(self.views[view_id], 'resource_id'):
-                    sample_text = st.text(alphabet=string.printable,min_size=1, max_size=2).example()
+                    sample_text = random_text(string.ascii_letters, 0, 8)
+                text_events.append(SetTextEvent(view=view_dict, text=sample_text))
+
+                if resource_id is not None and "search" in resource_id:
+                    sample_text = random_text(string.printable, 1, 2)
                     if random.random() < 0.5:
-                        sample_text = st.text(alphabet=string.ascii_letters,min_size=1, max_size=2).example()
-                    possible_events.append(
-                        SearchEvent()
-                    )
-                    possible_events.append(
-                        SetTextAndSearchEvent(text=sample_text)
-                    )
-
-                touch_exclude_view_ids.add(view_id)
+                        sample_text = random_text(string.ascii_letters, 1, 2)
+                    text_events.append(SearchEvent())
+                    text_events.append(SetTextAndSearchEvent(text=sample_text))
+
+                touch_excluded[view_id] = 1
                 # TODO figure out what event can be sent to editable views
-                pass
-        # Ting: for those views that (1) have not been handled, and (2) are leaf views, generate touch events
-        for view_id in enabled_view_ids:
-            if view_id in touch_exclude_view_ids:
-                continue
-            children = self.__safe_dict_get(self.views[view_id], 'children')
-            if children and len(children) > 0:
-                continue
 
+            # Ting: for those views that (1) have not been handled, and (2) are leaf views, generate touch events
             # Ting: fix a possible bug: we still need to check the property
             # before we add them into "possible_events"
-            if self.__safe_dict_get(
-                self.views[view_id], 'clickable'
-            ) or self.__safe_dict_get(self.views[view_id], 'checkable'):
+            if not children and (clickable or checkable):
+                leaf_view_ids.append(view_id)
+
+        possible_events = touch_events + scroll_events + check_events + long_touch_events + text_events
+        for view_id in leaf_view_ids:
+            if not touch_excluded[view_id]:
                 possible_events.append(TouchEvent(view=self.views[view_id]))
 
         # For old Android navigation bars
@@ -570,6 +848,15 @@ class DeviceState(object):
         self.possible_events = possible_events
         return [] + possible_events
 
+    def __exclude_from_touch(self, touch_excluded, view_id, children):
+        """
+        exclude a view and its children from the touch events of the leaf views
+        """
+        touch_excluded[view_id] = 1
+        for child_id in children or ():
+            if 0 <= child_id < len(touch_excluded):
+                touch_excluded[child_id] = 1
+
 
     def get_text_representation(self, merge_buttons=False):
         """
@@ -702,12 +989,13 @@ class DeviceState(object):
         return state_desc, activity, indexed_views
 
     def _get_self_ancestors_property(self, view, key, default=None):
-        all_views = [view] + [self.views[i] for i in self.get_all_ancestors(view)]
-        for v in all_views:
-            value = self.__safe_dict_get(v, key)
-            if value:
-                return value
-        return default
+        value = self.__safe_dict_get(view, key)
+        if value:
+            return value
+        parent_id = self.__safe_dict_get(view, 'parent', -1)
+        if 0 <= parent_id < len(self.views):
+            value = self.view_index.inherited(key)[parent_id]
+        return value if value else default
 
     def _merge_text(self, children_ids):
         texts, content_descriptions = [], []
@@ -13,6 +13,7 @@ from .device import Device
 from .app import App
 from .env_manager import AppEnvManager
 from .input_manager import InputManager
+from .state_store import SCREENSHOT_DEDUP_EXACT, STATE_FORMAT_JSON
 
 
 class DroidBot(object):
@@ -44,7 +45,13 @@ class DroidBot(object):
                  master=None,
                  humanoid=None,
                  ignore_ad=False,
-                 replay_output=None):
+                 replay_output=None,
+                 state_similarity=None,
+                 state_format=STATE_FORMAT_JSON,
+                 screenshot_format=None,
+                 screenshot_scale=1.0,
+                 screenshot_dedup=SCREENSHOT_DEDUP_EXACT,
+                 reuse_unchanged_views=False):
         """
         initiate droidbot with configurations
         :return:
@@ -94,7 +101,12 @@ class DroidBot(object):
                 enable_accessibility_hard=self.enable_accessibility_hard,
                 humanoid=self.humanoid,
                 app_package_name=self.app.package_name,
-                ignore_ad=ignore_ad)
+                ignore_ad=ignore_ad,
+                state_format=state_format,
+                screenshot_format=screenshot_format,
+                screenshot_scale=screenshot_scale,
+                screenshot_dedup=screenshot_dedup,
+                reuse_unchanged_views=reuse_unchanged_views)
             
 
             self.env_manager = AppEnvManager(
@@ -111,7 +123,8 @@ class DroidBot(object):
                 script_path=script_path,
                 profiling_method=profiling_method,
                 master=master,
-                replay_output=replay_output)
+                replay_output=replay_output,
+                state_similarity=state_similarity)
         except Exception:
             import traceback
             traceback.print_exc()
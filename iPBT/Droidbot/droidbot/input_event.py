@@ -6,6 +6,8 @@ from abc import abstractmethod
 
 from . import utils
 from .intent import Intent
+from .run_store import KIND_EVENT
+from .view_table import view_to_json
 
 POSSIBLE_KEYS = [
     "BACK",
@@ -102,7 +104,7 @@ class InputEvent(object):
         return self.__dict__
 
     def to_json(self):
-        return json.dumps(self.to_dict())
+        return json.dumps(self.to_dict(), default=view_to_json)
 
     def __str__(self):
         return self.to_dict().__str__()
@@ -205,14 +207,17 @@ class EventLog(object):
         if output_dir is None:
             if self.device.output_dir is None:
                 return
-            else:
-                output_dir = os.path.join(self.device.output_dir, "events")
+            if self.device.run_store is not None:
+                self.device.state_writer.submit_job(self.device.run_store.put_object, KIND_EVENT, self.tag,
+                                                    self.to_dict(), view_to_json)
+                return
+            output_dir = os.path.join(self.device.output_dir, "events")
         try:
             if not os.path.exists(output_dir):
                 os.makedirs(output_dir)
             event_json_file_path = "%s/event_%s.json" % (output_dir, self.tag)
             event_json_file = open(event_json_file_path, "w")
-            json.dump(self.to_dict(), event_json_file, indent=2)
+            json.dump(self.to_dict(), event_json_file, indent=2, default=view_to_json)
             event_json_file.close()
         except Exception as e:
             self.device.logger.warning("Saving event to dir failed.")
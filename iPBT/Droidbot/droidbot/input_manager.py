@@ -31,12 +31,13 @@ class InputManager(object):
     def __init__(self, device, app, policy_name, random_input,
                  event_count, event_interval,
                  script_path=None, profiling_method=None, master=None,
-                 replay_output=None):
+                 replay_output=None, state_similarity=None):
         """
         manage input event sent to the target device
         :param device: instance of Device
         :param app: instance of App
         :param policy_name: policy of generating events, string
+        :param state_similarity: float, if set, the UTG merges the states whose views are more similar
         :return:
         """
         self.logger = logging.getLogger('InputEventManager')
@@ -53,6 +54,7 @@ class InputManager(object):
         self.event_count = event_count
         self.event_interval = event_interval
         self.replay_output = replay_output
+        self.state_similarity = state_similarity
 
         self.monkey = None
 
@@ -92,6 +94,9 @@ class InputManager(object):
         if isinstance(input_policy, UtgBasedInputPolicy):
             input_policy.script = self.script
             input_policy.master = master
+            if self.state_similarity:
+                from .state_index import StateIndex
+                input_policy.utg.state_index = StateIndex(threshold=self.state_similarity)
         return input_policy
 
     def add_event(self, event):
@@ -171,5 +176,7 @@ class InputManager(object):
             pid = self.device.get_app_pid("com.android.commands.monkey")
             if pid is not None:
                 self.device.adb.shell("kill -9 %d" % pid)
+        if isinstance(self.policy, UtgBasedInputPolicy) and self.policy.utg.state_index is not None:
+            self.policy.utg.state_index.report()
         self.enabled = False
 
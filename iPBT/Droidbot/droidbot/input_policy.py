@@ -6,6 +6,8 @@ from abc import abstractmethod
 
 from .input_event import InputEvent, KeyEvent, IntentEvent, KillAndRestartAppEvent, ReInstallAppEvent, TouchEvent, ManualEvent, SetTextEvent, KillAppEvent
 from .utg import UTG
+from .run_store import KIND_EVENT, RUN_STORE_DIR, RunStore, is_run_store
+from .view_table import view_to_json
 
 # Max number of restarts
 MAX_NUM_RESTARTS = 5
@@ -639,7 +641,8 @@ class UtgGreedySearchPolicy(UtgBasedInputPolicy):
             "screen_res": [self.device.display_info["width"],
                            self.device.display_info["height"]]
         }
-        result = json.loads(proxy.predict(json.dumps(request_json)))
+        # the events refer to their views, which are ViewRecords
+        result = json.loads(proxy.predict(json.dumps(request_json, default=view_to_json)))
         new_idx = result["indices"]
         text = result["text"]
         new_events = []
@@ -702,10 +705,17 @@ class UtgReplayPolicy(InputPolicy):
         self.replay_output = replay_output
 
         import os
-        event_dir = os.path.join(replay_output, "events")
-        self.event_paths = sorted([os.path.join(event_dir, x) for x in
-                                   next(os.walk(event_dir))[2]
-                                   if x.endswith(".json")])
+        store_dir = os.path.join(replay_output, RUN_STORE_DIR)
+        if is_run_store(store_dir):
+            # the events are read from the run store, by tag
+            self.replay_store = RunStore(store_dir)
+            self.event_paths = sorted(self.replay_store.keys(KIND_EVENT))
+        else:
+            self.replay_store = None
+            event_dir = os.path.join(replay_output, "events")
+            self.event_paths = sorted([os.path.join(event_dir, x) for x in
+                                       next(os.walk(event_dir))[2]
+                                       if x.endswith(".json")])
         # skip HOME and start app intent
         self.device = device
         self.app = app
@@ -735,36 +745,48 @@ class UtgReplayPolicy(InputPolicy):
             self.__update_utg()
             while curr_event_idx < len(self.event_paths):
                 event_path = self.event_paths[curr_event_idx]
-                with open(event_path, "r") as f:
-                    curr_event_idx += 1
-
-                    try:
-                        event_dict = json.load(f)
-                    except Exception as e:
-                        self.logger.info("Loading %s failed" % event_path)
-                        continue
-
-                    if event_dict["start_state"] != current_state.state_str:
-                        continue
-                    if not self.device.is_foreground(self.app):
-                        # if current app is in background, bring it to foreground
-                        component = self.app.get_package_name()
-                        if self.app.get_main_activity():
-                            component += "/%s" % self.app.get_main_activity()
-                        return IntentEvent(Intent(suffix=component))
-                    
-                    self.logger.info("Replaying %s" % event_path)
-                    self.event_idx = curr_event_idx
-                    self.num_replay_tries = 0
-                    # return InputEvent.from_dict(event_dict["event"])
-                    event = InputEvent.from_dict(event_dict["event"])
-                    self.last_state = self.current_state
-                    self.last_event = event
-                    return event                    
+                curr_event_idx += 1
+
+                event_dict = self.__load_event(event_path)
+                if event_dict is None:
+                    self.logger.info("Loading %s failed" % event_path)
+                    continue
+
+                if event_dict["start_state"] != current_state.state_str:
+                    continue
+                if not self.device.is_foreground(self.app):
+                    # if current app is in background, bring it to foreground
+                    component = self.app.get_package_name()
+                    if self.app.get_main_activity():
+                        component += "/%s" % self.app.get_main_activity()
+                    return IntentEvent(Intent(suffix=component))
+
+                self.logger.info("Replaying %s" % event_path)
+                self.event_idx = curr_event_idx
+                self.num_replay_tries = 0
+                # return InputEvent.from_dict(event_dict["event"])
+                event = InputEvent.from_dict(event_dict["event"])
+                self.last_state = self.current_state
+                self.last_event = event
+                return event
 
             time.sleep(5)
 
         # raise InputInterruptedException("No more record can be replayed.")
+
+    def __load_event(self, event_path):
+        """
+        @param event_path: str, an event file, or the tag of an event in the run store
+        @return: dict, the saved EventLog, None if it cannot be loaded
+        """
+        try:
+            if self.replay_store is not None:
+                return self.replay_store.get(KIND_EVENT, event_path)
+            with open(event_path, "r") as f:
+                return json.load(f)
+        except Exception:
+            return None
+
     def __update_utg(self):
         self.utg.add_transition(self.last_event, self.last_state, self.current_state)
 
@@ -483,7 +483,7 @@ class Memory:
                 self.known_states[k]['views_emb'] = ele_embed[i]
 
     def get_unexplored_actions(self, current_state):
-        action_strs = set()
+        action_ids = set()
         structure_strs = set()
         self._memorize_state(current_state)
         for state_str, state_info in reversed(self.known_states.items()):
@@ -494,12 +494,12 @@ class Memory:
             for action in state.get_possible_input():
                 if not isinstance(action, TouchEvent):
                     continue
-                action_str = action.get_event_str(state=state)
-                if action_str in action_strs:
+                action_id = self.utg.get_event_id(action, state)
+                if action_id in action_ids:
                     continue
                 if self.utg.is_event_explored(action, state):
                     continue
-                action_strs.add(action_str)
+                action_ids.add(action_id)
                 yield state, action
 
     def get_action_emb(self, state, action):
@@ -0,0 +1,252 @@
+# append-only store of the states, events and images of a run, in a few large segment files
+# usage: python -m droidbot.run_store export <output_dir>/run_store <legacy_output_dir>
+import argparse
+import json
+import logging
+import os
+import re
+import threading
+import zlib
+
+from .state_store import encode_screenshot
+
+RUN_STORE_DIR = "run_store"
+INDEX_FILE_NAME = "index.jsonl"
+SEGMENT_FILE_NAME = "segment_%05d.bin"
+SEGMENT_FILE_RE = re.compile(r"^segment_(\d+)\.bin$")
+# a new segment is started when the current one reaches this size
+SEGMENT_SIZE = 256 * 1024 * 1024
+
+# kinds of records, and the legacy directory of their files
+KIND_STATE = "state"
+KIND_EVENT = "event"
+KIND_SCREENSHOT = "screenshot"
+KIND_VIEW = "view"
+LEGACY_DIRS = {KIND_STATE: "states", KIND_SCREENSHOT: "states", KIND_EVENT: "events", KIND_VIEW: "views"}
+
+CODEC_RAW = "raw"
+CODEC_ZLIB_JSON = "zlib-json"
+
+
+def is_run_store(store_dir):
+    return os.path.isfile(os.path.join(store_dir, INDEX_FILE_NAME))
+
+
+def put_state(store, state_dict, screenshot_data=None, screenshot_name=None, screenshot_scale=1.0,
+              screenshot_link=None, screenshot_path=None):
+    """
+    append a state and its screenshot to a store
+    :param state_dict: dict, DeviceState.to_dict() with plain dict views
+    :param screenshot_data: bytes, the screenshot as captured, stored as a record named screenshot_name,
+                            in the format given by its extension and scaled by screenshot_scale
+    :param screenshot_link: str, the name of a stored screenshot of the same screen, referenced instead of
+                            storing screenshot_data
+    :param screenshot_path: str, the screenshot file of a state without screenshot_data, stored as it is
+    """
+    store.put_object(KIND_STATE, state_dict["tag"], state_dict, state_str=state_dict["state_str"])
+    if screenshot_link:
+        store.put_link(KIND_SCREENSHOT, screenshot_name, screenshot_link, tag=state_dict["tag"])
+    elif screenshot_data:
+        data = encode_screenshot(screenshot_data, os.path.splitext(screenshot_name)[1][1:], screenshot_scale)
+        store.put(KIND_SCREENSHOT, screenshot_name, data, tag=state_dict["tag"])
+    elif screenshot_path and os.path.exists(screenshot_path):
+        with open(screenshot_path, "rb") as f:
+            store.put(KIND_SCREENSHOT, screenshot_name, f.read(), tag=state_dict["tag"])
+
+
+class RunStore(object):
+    """
+    the states, events, screenshots and view images of a run, appended as records to segment files
+    every record is written to the current segment, then indexed by a line of index.jsonl:
+    {"kind", "key", "segment", "offset", "length", "codec", ...}
+    a record with the same data as another one (e.g. the screenshot of an unchanged screen) is only an index entry
+    pointing to the data of the other one, with "link": its key
+    the states are keyed by tag and indexed by state_str too, the events by tag, the images by file name
+    a record whose data did not reach its segment (e.g. the run was killed) is dropped when the store is opened
+    """
+
+    def __init__(self, store_dir, writable=False, segment_size=SEGMENT_SIZE):
+        """
+        :param store_dir: str, the directory of the store
+        :param writable: bool, open the store for appending, created if it does not exist
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.store_dir = store_dir
+        self.writable = writable
+        self.segment_size = segment_size
+        # kind -> key -> index entry, in the order of the records
+        self.entries = {}
+        self.keys_by_state_str = {}
+        self.lock = threading.Lock()
+        self.read_files = {}
+        self.segment = 0
+        self.segment_file = None
+        self.index_file = None
+
+        if writable and not os.path.isdir(store_dir):
+            os.makedirs(store_dir)
+        self.__load_index()
+        if writable:
+            # records are never appended after the data of an interrupted run, a new segment is started,
+            # numbered after the segment files, which can be partly written and have no index entry left
+            segments = [int(match.group(1)) for match in map(SEGMENT_FILE_RE.match, os.listdir(store_dir)) if match]
+            self.segment = max(segments) + 1 if segments else 0
+            self.index_file = open(os.path.join(store_dir, INDEX_FILE_NAME), "a", encoding="utf-8")
+
+    def __load_index(self):
+        index_path = os.path.join(self.store_dir, INDEX_FILE_NAME)
+        if not os.path.exists(index_path):
+            return
+        segment_sizes = {}
+        with open(index_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                segment = entry["segment"]
+                if segment not in segment_sizes:
+                    segment_path = os.path.join(self.store_dir, SEGMENT_FILE_NAME % segment)
+                    segment_sizes[segment] = os.path.getsize(segment_path) if os.path.exists(segment_path) else 0
+                if entry["offset"] + entry["length"] > segment_sizes[segment]:
+                    continue
+                self.__add_entry(entry)
+
+    def __add_entry(self, entry):
+        self.entries.setdefault(entry["kind"], {})[entry["key"]] = entry
+        if "state_str" in entry:
+            self.keys_by_state_str.setdefault(entry["state_str"], []).append(entry["key"])
+
+    def put(self, kind, key, data, codec=CODEC_RAW, **attrs):
+        """
+        append a record, a record already in the store is not written again
+        :param data: bytes, the encoded record
+        :param attrs: more fields of the index entry, e.g. state_str
+        """
+        with self.lock:
+            if key in self.entries.get(kind, ()):
+                return
+            if self.segment_file is None or self.segment_file.tell() + len(data) > self.segment_size \
+                    and self.segment_file.tell() > 0:
+                self.__start_segment()
+            entry = dict(attrs, kind=kind, key=key, segment=self.segment, offset=self.segment_file.tell(),
+                         length=len(data), codec=codec)
+            self.segment_file.write(data)
+            self.segment_file.flush()
+            self.index_file.write(json.dumps(entry) + "\n")
+            self.index_file.flush()
+            self.__add_entry(entry)
+
+    def put_link(self, kind, key, target_key, **attrs):
+        """
+        add a record with the data of a record already in the store, only its index entry is written
+        :param target_key: str, the key of the record of the same kind whose data is referenced
+        """
+        with self.lock:
+            if key in self.entries.get(kind, ()):
+                return
+            target = self.entries[kind][target_key]
+            entry = dict(attrs, kind=kind, key=key, segment=target["segment"], offset=target["offset"],
+                         length=target["length"], codec=target["codec"], link=target_key)
+            self.index_file.write(json.dumps(entry) + "\n")
+            self.index_file.flush()
+            self.__add_entry(entry)
+
+    def put_object(self, kind, key, obj, default=None, **attrs):
+        """
+        append a json serializable object as a record
+        :param default: the default function of json.dumps
+        """
+        self.put(kind, key, zlib.compress(json.dumps(obj, default=default).encode("utf-8")), CODEC_ZLIB_JSON,
+                 **attrs)
+
+    def __start_segment(self):
+        if self.segment_file is not None:
+            self.segment_file.close()
+            self.segment += 1
+        self.segment_file = open(os.path.join(self.store_dir, SEGMENT_FILE_NAME % self.segment), "ab")
+
+    def get(self, kind, key):
+        """
+        :return: the record, decoded: bytes for raw records, the object for json records, None if there is none
+        """
+        entry = self.entries.get(kind, {}).get(key)
+        if entry is None:
+            return None
+        with self.lock:
+            if self.segment_file is not None:
+                self.segment_file.flush()
+            segment_file = self.read_files.get(entry["segment"])
+            if segment_file is None:
+                segment_path = os.path.join(self.store_dir, SEGMENT_FILE_NAME % entry["segment"])
+                segment_file = self.read_files[entry["segment"]] = open(segment_path, "rb")
+            segment_file.seek(entry["offset"])
+            data = segment_file.read(entry["length"])
+        if entry["codec"] == CODEC_ZLIB_JSON:
+            return json.loads(zlib.decompress(data))
+        return data
+
+    def contains(self, kind, key):
+        return key in self.entries.get(kind, ())
+
+    def keys(self, kind):
+        """
+        :return: list of str, the keys of the records of a kind, in the order they were written
+        """
+        return list(self.entries.get(kind, ()))
+
+    def get_states_by_state_str(self, state_str):
+        """
+        :return: list of dict, the saved states with this state_str
+        """
+        return [self.get(KIND_STATE, key) for key in self.keys_by_state_str.get(state_str, [])]
+
+    def export(self, output_dir):
+        """
+        write the records as the files of a legacy droidbot output directory
+        :param output_dir: str, states/, events/ and views/ are created in it
+        """
+        counts = {}
+        for kind, legacy_dir in LEGACY_DIRS.items():
+            kind_dir = os.path.join(output_dir, legacy_dir)
+            for key in self.keys(kind):
+                if not os.path.isdir(kind_dir):
+                    os.makedirs(kind_dir)
+                record = self.get(kind, key)
+                if kind == KIND_STATE or kind == KIND_EVENT:
+                    with open(os.path.join(kind_dir, "%s_%s.json" % (kind, key)), "w", encoding="utf-8") as f:
+                        json.dump(record, f, indent=2)
+                else:
+                    with open(os.path.join(kind_dir, key), "wb") as f:
+                        f.write(record)
+                counts[kind] = counts.get(kind, 0) + 1
+        return counts
+
+    def close(self):
+        with self.lock:
+            for f in [self.segment_file, self.index_file] + list(self.read_files.values()):
+                if f is not None:
+                    f.close()
+            self.segment_file = None
+            self.index_file = None
+            self.read_files = {}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Tools for the run store of a droidbot output")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser("export", help="write the run as a legacy droidbot output directory")
+    export_parser.add_argument("store_dir", help="the run_store directory of a droidbot output")
+    export_parser.add_argument("output_dir", help="the directory to write states/, events/ and views/ to")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if not is_run_store(args.store_dir):
+        print("%s is not a run store" % args.store_dir)
+    else:
+        store = RunStore(args.store_dir)
+        counts = store.export(args.output_dir)
+        store.close()
+        print(", ".join("%d %ss" % (count, kind) for kind, count in sorted(counts.items())))
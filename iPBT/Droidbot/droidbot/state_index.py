@@ -0,0 +1,122 @@
+import logging
+
+import numpy as np
+
+from .device_state import VIEW_SIGNATURES
+
+
+class StateIndex(object):
+    """
+    clusters near-duplicate states, e.g. a scrolled list or a screen whose clock changed, so that the UTG
+    does not get a new node for each of them
+    a state joins the cluster of a known state of the same activity if the Jaccard similarity of their view
+    signature sets, estimated with MinHash, is above a threshold and, if the screenshots are used, their
+    dHashes are close
+    the candidate clusters are found with locality-sensitive hashing on bands of the MinHash signatures,
+    so a lookup costs about the same with 10 or 10000 known states
+    """
+
+    def __init__(self, threshold=0.9, max_dhash_distance=24, num_perm=64, bands=16, use_screenshots=True, seed=0):
+        """
+        :param threshold: float, the minimal estimated Jaccard similarity of the view signatures of two states
+                          of the same cluster
+        :param max_dhash_distance: int, the maximal hamming distance of the screenshot dHashes (272 bits)
+        :param num_perm: int, the size of the MinHash signatures
+        :param bands: int, the number of LSH bands, num_perm must be a multiple of it
+        :param use_screenshots: bool, whether to compare the dHashes of the screenshots
+        :param seed: int, the seed of the hash functions
+        """
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.threshold = threshold
+        self.max_dhash_distance = max_dhash_distance
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.use_screenshots = use_screenshots
+        # the hash functions are h(x) = a * x + b mod 2^64, with odd multipliers a
+        random_state = np.random.RandomState(seed)
+        self.multipliers = random_state.randint(0, 2 ** 62, num_perm, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+        self.offsets = random_state.randint(0, 2 ** 62, num_perm, dtype=np.uint64)
+        # (band, activity, band of the signature) -> cluster_strs
+        self.buckets = {}
+        # state_str -> cluster_str, the cluster of every state seen
+        self.clusters = {}
+        # cluster_str -> MinHash signature, dHash of the first state of the cluster
+        self.signatures = {}
+        self.dhashes = {}
+        self.cluster_sizes = {}
+
+    def get_cluster_str(self, state):
+        """
+        get the cluster of a state, a new cluster if it is similar to no known state
+        :param state: DeviceState
+        :return: str, the state_str of the first state of the cluster
+        """
+        cluster_str = self.clusters.get(state.state_str)
+        if cluster_str is not None:
+            return cluster_str
+        signature = self.get_minhash(state)
+        dhash = self.get_dhash(state)
+        band_keys = [(band, state.foreground_activity, signature[band * self.rows:(band + 1) * self.rows].tobytes())
+                     for band in range(self.bands)]
+
+        candidates = set()
+        for band_key in band_keys:
+            candidates.update(self.buckets.get(band_key, ()))
+        best_similarity = self.threshold
+        for candidate in candidates:
+            similarity = float(np.count_nonzero(signature == self.signatures[candidate])) / len(signature)
+            if similarity < best_similarity:
+                continue
+            candidate_dhash = self.dhashes[candidate]
+            if dhash is not None and candidate_dhash is not None \
+                    and bin(dhash ^ candidate_dhash).count("1") > self.max_dhash_distance:
+                continue
+            best_similarity = similarity
+            cluster_str = candidate
+
+        if cluster_str is None:
+            cluster_str = state.state_str
+            self.signatures[cluster_str] = signature
+            self.dhashes[cluster_str] = dhash
+            for band_key in band_keys:
+                self.buckets.setdefault(band_key, []).append(cluster_str)
+        else:
+            self.logger.debug("state %s merged into %s (similarity %.2f)" % (state.state_str, cluster_str,
+                                                                             best_similarity))
+        self.clusters[state.state_str] = cluster_str
+        self.cluster_sizes[cluster_str] = self.cluster_sizes.get(cluster_str, 0) + 1
+        return cluster_str
+
+    def get_minhash(self, state):
+        """
+        :return: numpy.ndarray of uint64, the MinHash signature of the set of view signatures of a state
+        """
+        # the signatures are set on the views when the state_str is computed
+        state.state_str
+        signatures = set(view['signature'] for view in state.views)
+        if not signatures:
+            return np.full(len(self.multipliers), np.iinfo(np.uint64).max, dtype=np.uint64)
+        values = np.fromiter((int.from_bytes(VIEW_SIGNATURES.digests[VIEW_SIGNATURES.get_id(signature)][:8],
+                                             "little") for signature in signatures),
+                             dtype=np.uint64, count=len(signatures))
+        return (np.outer(self.multipliers, values) + self.offsets[:, None]).min(axis=1)
+
+    def get_dhash(self, state):
+        """
+        :return: int, the dHash of the screenshot of a state, None if there is none or it cannot be read
+        """
+        if not self.use_screenshots:
+            return None
+        try:
+            return state.screenshot_dhash
+        except ImportError:
+            self.logger.warning("opencv is not installed, the screenshots are not compared")
+            self.use_screenshots = False
+            return None
+
+    def report(self):
+        merged = len(self.clusters) - len(self.cluster_sizes)
+        self.logger.info("%d states in %d clusters, %d near-duplicate states merged" % (
+            len(self.clusters), len(self.cluster_sizes), merged))
@@ -0,0 +1,220 @@
+import json
+import logging
+import os
+import queue
+import threading
+
+# state file formats: pretty-printed json, or msgpack, compressed with zstd if zstandard is installed
+# or no files at all: the states, events and images go to the RunStore of the run
+STATE_FORMAT_JSON = "json"
+STATE_FORMAT_MSGPACK = "msgpack"
+STATE_FORMAT_STORE = "store"
+STATE_FORMATS = [STATE_FORMAT_JSON, STATE_FORMAT_MSGPACK, STATE_FORMAT_STORE]
+STATE_FILE_EXTENSIONS = (".json", ".msgpack", ".msgpack.zst")
+
+ZSTD_LEVEL = 3
+
+# screenshot formats, the screenshots are kept as captured (png, or jpg with minicap) unless one is chosen
+SCREENSHOT_FORMAT_PNG = "png"
+SCREENSHOT_FORMAT_JPG = "jpg"
+SCREENSHOT_FORMAT_WEBP = "webp"
+SCREENSHOT_FORMATS = [SCREENSHOT_FORMAT_PNG, SCREENSHOT_FORMAT_JPG, SCREENSHOT_FORMAT_WEBP]
+SCREENSHOT_QUALITY = 85
+# a screenshot already saved in the run is saved again as a link to it: if its captured bytes are the same,
+# or with dhash, if the dHashes of the two screens are the same too
+SCREENSHOT_DEDUP_EXACT = "exact"
+SCREENSHOT_DEDUP_DHASH = "dhash"
+SCREENSHOT_DEDUPS = [SCREENSHOT_DEDUP_EXACT, SCREENSHOT_DEDUP_DHASH]
+# magic numbers of the captured images, and the format PIL writes them in
+IMAGE_SIGNATURES = {SCREENSHOT_FORMAT_PNG: b"\x89PNG", SCREENSHOT_FORMAT_JPG: b"\xff\xd8"}
+PIL_FORMATS = {SCREENSHOT_FORMAT_PNG: "PNG", SCREENSHOT_FORMAT_JPG: "JPEG", SCREENSHOT_FORMAT_WEBP: "WEBP"}
+
+
+def get_state_file_name(tag, state_format=STATE_FORMAT_JSON):
+    """
+    :param tag: str, the tag of the state
+    :return: str, the name of the file of the state in the states directory
+    """
+    if state_format == STATE_FORMAT_MSGPACK:
+        try:
+            import zstandard
+            return "state_%s.msgpack.zst" % tag
+        except ImportError:
+            return "state_%s.msgpack" % tag
+    return "state_%s.json" % tag
+
+
+def is_state_file(path):
+    name = os.path.basename(path)
+    return name.startswith("state_") and name.endswith(STATE_FILE_EXTENSIONS)
+
+
+def encode_state(state_dict, path):
+    """
+    :param state_dict: dict, DeviceState.to_dict() with plain dict views
+    :param path: str, the state file, its extension gives the format
+    :return: bytes
+    """
+    if path.endswith(".json"):
+        return json.dumps(state_dict, indent=2).encode("utf-8")
+    import msgpack
+    data = msgpack.packb(state_dict, use_bin_type=True)
+    if path.endswith(".zst"):
+        import zstandard
+        data = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return data
+
+
+def load_state_file(path):
+    """
+    load a state file of any format
+    :param path: str, a state_*.json, state_*.msgpack or state_*.msgpack.zst file
+    :return: dict, the state
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    if path.endswith(".json"):
+        return json.loads(data)
+    if path.endswith(".zst"):
+        import zstandard
+        data = zstandard.ZstdDecompressor().decompress(data)
+    import msgpack
+    return msgpack.unpackb(data, raw=False)
+
+
+def list_state_files(states_dir):
+    """
+    :return: list of str, the state files of a states directory, of any format, sorted by name
+    """
+    if not os.path.isdir(states_dir):
+        return []
+    return sorted(os.path.join(states_dir, name) for name in os.listdir(states_dir) if is_state_file(name))
+
+
+def write_state_file(path, state_dict):
+    data = encode_state(state_dict, path)
+    # written under a temporary name, so that readers never see a partial state file
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+
+def get_image_format(data):
+    """
+    :param data: bytes, an encoded image
+    :return: str, png or jpg, None for other formats
+    """
+    for image_format, signature in IMAGE_SIGNATURES.items():
+        if data.startswith(signature):
+            return image_format
+    return None
+
+
+def encode_screenshot(data, image_format, scale=1.0):
+    """
+    encode a captured screenshot in the format it is saved in
+    :param data: bytes, the screenshot as captured, png or jpg
+    :param image_format: str, one of SCREENSHOT_FORMATS
+    :param scale: float, the size of the saved screenshot relative to the screen, e.g. 0.5
+    :return: bytes, data itself if it is already in this format and not scaled
+    """
+    if scale == 1.0 and get_image_format(data) == image_format:
+        return data
+    import io
+    from PIL import Image
+    image = Image.open(io.BytesIO(data))
+    if scale != 1.0:
+        image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))),
+                             Image.BILINEAR)
+    if image_format != SCREENSHOT_FORMAT_PNG:
+        image = image.convert("RGB")
+    output = io.BytesIO()
+    image.save(output, format=PIL_FORMATS[image_format], quality=SCREENSHOT_QUALITY)
+    return output.getvalue()
+
+
+def write_screenshot_file(path, data, scale=1.0):
+    """
+    :param path: str, the screenshot file, its extension gives the format
+    :param data: bytes, the screenshot as captured
+    """
+    data = encode_screenshot(data, os.path.splitext(path)[1][1:], scale)
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+
+def link_screenshot_file(source_path, path):
+    """
+    save a screenshot as a hard link to the file of the same screen, or a copy where hard links are not supported
+    """
+    try:
+        os.link(source_path, path)
+    except OSError:
+        import shutil
+        shutil.copyfile(source_path, path)
+
+
+class StateWriter(object):
+    """
+    encodes and writes the state files, the screenshots and the records of the run store, in a background thread,
+    so that exploring does not wait for the disk
+    """
+
+    def __init__(self, max_pending=64):
+        """
+        :param max_pending: int, the states waiting to be written, submitting more blocks until one is written
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def submit(self, path, state_dict):
+        """
+        write a state in the background
+        :param path: str, the state file
+        :param state_dict: dict, the state, not modified after being submitted
+        """
+        self.submit_job(write_state_file, path, state_dict)
+
+    def submit_job(self, func, *args):
+        """
+        run func(*args) in the writer thread, after the jobs submitted before
+        """
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.__run, name="StateWriter", daemon=True)
+                self.thread.start()
+        self.queue.put((func, args))
+
+    def __run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            func, args = item
+            try:
+                func(*args)
+            except Exception as e:
+                self.logger.warning("%s failed: %s" % (func.__name__, e))
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        """
+        wait until every submitted state is written
+        """
+        if self.thread is not None:
+            self.queue.join()
+
+    def close(self):
+        with self.lock:
+            if self.thread is None:
+                return
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
@@ -3,8 +3,11 @@ import json
 import os
 import random
 import datetime
+import weakref
 import networkx as nx
 
+from .utils import StringTable
+
 
 class UTG(object):
     """
@@ -21,15 +24,24 @@ class UTG(object):
         self.G2 = nx.DiGraph()  # graph with same-structure states clustered
 
         self.transitions = []
-        self.effective_event_strs = set()
-        self.ineffective_event_strs = set()
+        # the event strings of the run, the events are identified by their id in it
+        self.event_strs = StringTable()
+        # the id of the event string of an event, with the state_str it was computed in
+        self.__event_id_cache = weakref.WeakKeyDictionary()
+        self.effective_event_ids = set()
+        self.ineffective_event_ids = set()
         self.explored_state_strs = set()
         self.reached_state_strs = set()
         self.reached_activities = set()
+        # the state_strs of the states saved to the output, every distinct state is saved even if its node is shared
+        self.saved_state_strs = set()
 
         self.first_state = None
         self.last_state = None
 
+        # StateIndex clustering the near-duplicate states into one node, None to keep a node per state_str
+        self.state_index = None
+
         self.start_time = datetime.datetime.now()
 
     @property
@@ -42,7 +54,32 @@ class UTG(object):
 
     @property
     def effective_event_count(self):
-        return len(self.effective_event_strs)
+        return len(self.effective_event_ids)
+
+    def get_node_str(self, state):
+        """
+        get the node of a state in G, the state_str of its cluster if near-duplicate states are clustered
+        @param state: DeviceState
+        @return: str
+        """
+        if self.state_index is None:
+            return state.state_str
+        return self.state_index.get_cluster_str(state)
+
+    def get_event_id(self, event, state):
+        """
+        get the id of the event string of an event in a state
+        the string is built once per event and state, the possible events of a state are asked again and again
+        @param event: InputEvent
+        @param state: DeviceState
+        @return: int, the id of the event string in event_strs
+        """
+        cached = self.__event_id_cache.get(event)
+        if cached is not None and cached[0] == state.state_str:
+            return cached[1]
+        event_id = self.event_strs.get_id(event.get_event_str(state))
+        self.__event_id_cache[event] = (state.state_str, event_id)
+        return event_id
 
     @property
     def num_transitions(self):
@@ -56,31 +93,32 @@ class UTG(object):
         if not old_state or not new_state:
             return
 
-        event_str = event.get_event_str(old_state)
+        event_id = self.get_event_id(event, old_state)
         self.transitions.append((old_state, event, new_state))
+        old_node_str = self.get_node_str(old_state)
+        new_node_str = self.get_node_str(new_state)
 
-        if old_state.state_str == new_state.state_str:
-            self.ineffective_event_strs.add(event_str)
+        if old_node_str == new_node_str:
+            self.ineffective_event_ids.add(event_id)
             # delete the transitions including the event from utg
-            for new_state_str in self.G[old_state.state_str]:
-                if event_str in self.G[old_state.state_str][new_state_str]["events"]:
-                    self.G[old_state.state_str][new_state_str]["events"].pop(event_str)
-            if event_str in self.effective_event_strs:
-                self.effective_event_strs.remove(event_str)
+            for new_state_str in self.G[old_node_str]:
+                if event_id in self.G[old_node_str][new_state_str]["events"]:
+                    self.G[old_node_str][new_state_str]["events"].pop(event_id)
+            self.effective_event_ids.discard(event_id)
             return
 
-        self.effective_event_strs.add(event_str)
+        self.effective_event_ids.add(event_id)
 
-        if (old_state.state_str, new_state.state_str) not in self.G.edges():
-            self.G.add_edge(old_state.state_str, new_state.state_str, events={})
-        self.G[old_state.state_str][new_state.state_str]["events"][event_str] = {
+        if (old_node_str, new_node_str) not in self.G.edges():
+            self.G.add_edge(old_node_str, new_node_str, events={})
+        self.G[old_node_str][new_node_str]["events"][event_id] = {
             "event": event,
             "id": self.effective_event_count
         }
 
         if (old_state.structure_str, new_state.structure_str) not in self.G2.edges():
             self.G2.add_edge(old_state.structure_str, new_state.structure_str, events={})
-        self.G2[old_state.structure_str][new_state.structure_str]["events"][event_str] = {
+        self.G2[old_state.structure_str][new_state.structure_str]["events"][event_id] = {
             "event": event,
             "id": self.effective_event_count
         }
@@ -89,26 +127,29 @@ class UTG(object):
         self.__output_utg()
 
     def remove_transition(self, event, old_state, new_state):
-        event_str = event.get_event_str(old_state)
-        if (old_state.state_str, new_state.state_str) in self.G.edges():
-            events = self.G[old_state.state_str][new_state.state_str]["events"]
-            if event_str in events.keys():
-                events.pop(event_str)
+        event_id = self.get_event_id(event, old_state)
+        old_node_str = self.get_node_str(old_state)
+        new_node_str = self.get_node_str(new_state)
+        if (old_node_str, new_node_str) in self.G.edges():
+            events = self.G[old_node_str][new_node_str]["events"]
+            events.pop(event_id, None)
             if len(events) == 0:
-                self.G.remove_edge(old_state.state_str, new_state.state_str)
+                self.G.remove_edge(old_node_str, new_node_str)
         if (old_state.structure_str, new_state.structure_str) in self.G2.edges():
             events = self.G2[old_state.structure_str][new_state.structure_str]["events"]
-            if event_str in events.keys():
-                events.pop(event_str)
+            events.pop(event_id, None)
             if len(events) == 0:
                 self.G2.remove_edge(old_state.structure_str, new_state.structure_str)
 
     def add_node(self, state):
         if not state:
             return
-        if state.state_str not in self.G.nodes():
+        if state.state_str not in self.saved_state_strs:
             state.save2dir()
-            self.G.add_node(state.state_str, state=state)
+            self.saved_state_strs.add(state.state_str)
+        node_str = self.get_node_str(state)
+        if node_str not in self.G.nodes():
+            self.G.add_node(node_str, state=state)
             if self.first_state is None:
                 self.first_state = state
 
@@ -153,7 +194,8 @@ class UTG(object):
             utg_node = {
                 "id": state_str,
                 "shape": "image",
-                "image": os.path.relpath(state.screenshot_path, self.device.output_dir),
+                # where save2dir (or exporting the run store) puts the screenshot
+                "image": os.path.join("states", state.get_screenshot_file_name()),
                 "label": short_activity_name,
                 # "group": state.foreground_activity,
                 "package": package_name,
@@ -164,10 +206,10 @@ class UTG(object):
                 "content": "\n".join([package_name, activity_name, state.state_str, state.search_content])
             }
 
-            if state.state_str == self.first_state_str:
+            if self.first_state and state_str == self.get_node_str(self.first_state):
                 utg_node["label"] += "\n<FIRST>"
                 utg_node["font"] = "14px Arial red"
-            if state.state_str == self.last_state_str:
+            if self.last_state and state_str == self.get_node_str(self.last_state):
                 utg_node["label"] += "\n<LAST>"
                 utg_node["font"] = "14px Arial red"
 
@@ -181,7 +223,8 @@ class UTG(object):
             event_short_descs = []
             event_list = []
 
-            for event_str, event_info in sorted(iter(events.items()), key=lambda x: x[1]["id"]):
+            for event_id, event_info in sorted(iter(events.items()), key=lambda x: x[1]["id"]):
+                event_str = self.event_strs.get_string(event_id)
                 event_short_descs.append((event_info["id"], event_str))
                 if self.device.adapters[self.device.minicap]:
                     view_images = ["views/view_" + view["view_str"] + ".jpg"
@@ -217,7 +260,7 @@ class UTG(object):
 
             "num_nodes": len(utg_nodes),
             "num_edges": len(utg_edges),
-            "num_effective_events": len(self.effective_event_strs),
+            "num_effective_events": len(self.effective_event_ids),
             "num_reached_activities": len(self.reached_activities),
             "test_date": self.start_time.strftime("%Y-%m-%d %H:%M:%S"),
             "time_spent": (datetime.datetime.now() - self.start_time).total_seconds(),
@@ -239,8 +282,8 @@ class UTG(object):
         utg_file.close()
 
     def is_event_explored(self, event, state):
-        event_str = event.get_event_str(state)
-        return event_str in self.effective_event_strs or event_str in self.ineffective_event_strs
+        event_id = self.get_event_id(event, state)
+        return event_id in self.effective_event_ids or event_id in self.ineffective_event_ids
 
     def is_state_explored(self, state):
         if state.state_str in self.explored_state_strs:
@@ -259,7 +302,7 @@ class UTG(object):
 
     def get_reachable_states(self, current_state):
         reachable_states = []
-        for target_state_str in nx.descendants(self.G, current_state.state_str):
+        for target_state_str in nx.descendants(self.G, self.get_node_str(current_state)):
             target_state = self.G.nodes[target_state_str]["state"]
             reachable_states.append(target_state)
         return reachable_states
@@ -269,19 +312,19 @@ class UTG(object):
             return None
         try:
             steps = []
-            from_state_str = from_state.state_str
-            to_state_str = to_state.state_str
+            from_state_str = self.get_node_str(from_state)
+            to_state_str = self.get_node_str(to_state)
             state_strs = nx.shortest_path(G=self.G, source=from_state_str, target=to_state_str)
             if not isinstance(state_strs, list) or len(state_strs) < 2:
                 self.logger.warning(f"Error getting path from {from_state_str} to {to_state_str}")
             start_state_str = state_strs[0]
             for state_str in state_strs[1:]:
                 edge = self.G[start_state_str][state_str]
-                edge_event_strs = list(edge["events"].keys())
+                edge_event_ids = list(edge["events"].keys())
                 if self.random_input:
-                    random.shuffle(edge_event_strs)
+                    random.shuffle(edge_event_ids)
                 start_state = self.G.nodes[start_state_str]['state']
-                event = edge["events"][edge_event_strs[0]]["event"]
+                event = edge["events"][edge_event_ids[0]]["event"]
                 steps.append((start_state, event))
                 start_state_str = state_str
             return steps
@@ -316,10 +359,10 @@ class UTG(object):
             start_state_str = state_strs[0]
             for state_str in state_strs[1:]:
                 edge = self.G2[start_state_str][state_str]
-                edge_event_strs = list(edge["events"].keys())
+                edge_event_ids = list(edge["events"].keys())
                 start_state = random.choice(self.G2.nodes[start_state_str]['states'])
-                event_str = random.choice(edge_event_strs)
-                event = edge["events"][event_str]["event"]
+                event_id = random.choice(edge_event_ids)
+                event = edge["events"][event_id]["event"]
                 nav_steps.append((start_state, event))
                 start_state_str = state_str
             if nav_steps is None:
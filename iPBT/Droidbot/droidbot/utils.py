@@ -1,5 +1,6 @@
 import re
 import functools
+import hashlib
 from datetime import datetime
 import warnings
 
@@ -92,3 +93,58 @@ def md5(input_str):
     import hashlib
     return hashlib.md5(input_str.encode('utf-8')).hexdigest()
 
+
+def fast_digest(data):
+    """
+    16-byte digest for identifying states and views, much cheaper than md5 on the many small inputs of a state
+    blake2b is used rather than a faster non-cryptographic hash from an optional package,
+    so that the digests are the same on every installation and can be compared across runs
+    @param data: bytes
+    @return: bytes
+    """
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+class StringTable(object):
+    """
+    maps strings to small integer ids, in the order they are first seen
+    used to keep the strings recurring across the states of a run (view signatures, event strings) once,
+    and to work on their ids instead
+    """
+
+    def __init__(self):
+        self.ids = {}
+        self.strings = []
+
+    def get_id(self, string):
+        """
+        @param string: str
+        @return: int, the id of the string, a new id if it was never seen
+        """
+        string_id = self.ids.get(string)
+        if string_id is None:
+            string_id = self.ids[string] = len(self.strings)
+            self.strings.append(string)
+        return string_id
+
+    def get_string(self, string_id):
+        return self.strings[string_id]
+
+    def intern(self, string):
+        """
+        @return: str, the string of the table equal to the given one, so that equal strings are shared
+        """
+        return self.strings[self.get_id(string)]
+
+    def clear(self):
+        """
+        forget all the strings, the ids given before must not be used anymore
+        """
+        self.ids.clear()
+        del self.strings[:]
+
+    def __contains__(self, string):
+        return string in self.ids
+
+    def __len__(self):
+        return len(self.strings)
@@ -0,0 +1,221 @@
+import sys
+from array import array
+from collections.abc import MutableMapping
+
+# boolean attributes of the views, stored as two bits (present, value) in one int per view
+FLAG_KEYS = ('visible', 'checkable', 'editable', 'clickable', 'is_password', 'focusable', 'enabled', 'focused',
+             'checked', 'scrollable', 'selected', 'long_clickable', 'covered')
+# string attributes, stored as interned strings, the signatures and view_str are set by DeviceState
+STRING_KEYS = ('package', 'content_description', 'resource_id', 'text', 'class', 'size',
+               'signature', 'content_free_signature', 'view_str')
+# int attributes, stored in 64-bit arrays
+INT_KEYS = ('temp_id', 'parent', 'child_count', 'drawing-order', 'global_drawing_order')
+
+# markers of the string and int columns for missing keys and None values
+_MISSING = object()
+_INT_MISSING = -2 ** 63
+_INT_NONE = -2 ** 63 + 1
+_BOUNDS_MISSING = -2 ** 31
+# marks a key of a column deleted from a view
+_DELETED = object()
+_FLAG_BITS = {key: 2 * i for i, key in enumerate(FLAG_KEYS)}
+
+
+class ViewTable(object):
+    """
+    columnar storage of the views of a state, much smaller than a dict per view
+    the views are accessed through ViewRecord, a dict-like facade, so DeviceState.views is still a list of
+    "view dicts": reading, checking and setting keys work as on a dict
+    keys that do not fit a column (other keys, values of another type) are kept in a small dict per view
+    """
+
+    def __init__(self, raw_views):
+        """
+        :param raw_views: list of dict, the views as dumped from the device
+        """
+        count = len(raw_views)
+        self.count = count
+        self.flags = array('Q', bytes(8 * count))
+        self.strings = {key: [_MISSING] * count for key in STRING_KEYS}
+        self.ints = {key: array('q', [_INT_MISSING]) * count for key in INT_KEYS}
+        self.bounds = array('i', [_BOUNDS_MISSING]) * (4 * count)
+        # the children of view i are child_ids[child_offsets[i]:child_offsets[i + 1]], None if it has no children key
+        self.child_offsets = array('i', [0]) * (count + 1)
+        self.child_ids = array('i')
+        self.has_children = array('b', bytes(count))
+        self.extras = [None] * count
+        # key order of the first view, so that the records iterate like the dicts they come from
+        self.key_order = list(raw_views[0].keys()) if count else []
+        key_order_set = set(self.key_order)
+        for key in STRING_KEYS:
+            if key not in key_order_set:
+                self.key_order.append(key)
+
+        intern = sys.intern
+        for i, view in enumerate(raw_views):
+            extras = None
+            flags = 0
+            for key, value in view.items():
+                if key in _FLAG_BITS and isinstance(value, bool):
+                    flags |= (2 | value) << _FLAG_BITS[key]
+                elif key in self.strings and (value is None or type(value) is str):
+                    self.strings[key][i] = None if value is None else intern(value)
+                elif key in self.ints and (value is None or type(value) is int) \
+                        and (value is None or _INT_NONE < value < 2 ** 63):
+                    self.ints[key][i] = _INT_NONE if value is None else value
+                elif key == 'bounds' and self.__is_bounds(value):
+                    self.bounds[4 * i:4 * i + 4] = array('i', (value[0][0], value[0][1], value[1][0], value[1][1]))
+                elif key == 'children' and isinstance(value, list) and all(type(child) is int for child in value):
+                    self.has_children[i] = 1
+                    self.child_ids.extend(value)
+                else:
+                    if extras is None:
+                        extras = {}
+                    extras[key] = value
+                    if key not in key_order_set:
+                        key_order_set.add(key)
+                        self.key_order.append(key)
+            self.flags[i] = flags
+            self.child_offsets[i + 1] = len(self.child_ids)
+            self.extras[i] = extras
+        self.records = [ViewRecord(self, i) for i in range(count)]
+
+    @staticmethod
+    def __is_bounds(value):
+        return isinstance(value, list) and len(value) == 2 \
+            and all(isinstance(point, list) and len(point) == 2 for point in value) \
+            and all(type(coordinate) is int and _BOUNDS_MISSING < coordinate < 2 ** 31
+                    for point in value for coordinate in point)
+
+    def get(self, i, key, default=None):
+        extras = self.extras[i]
+        if extras is not None and key in extras:
+            value = extras[key]
+            return default if value is _DELETED else value
+        bit = _FLAG_BITS.get(key)
+        if bit is not None:
+            flag = (self.flags[i] >> bit) & 3
+            return bool(flag & 1) if flag & 2 else default
+        column = self.strings.get(key)
+        if column is not None:
+            value = column[i]
+            return default if value is _MISSING else value
+        column = self.ints.get(key)
+        if column is not None:
+            value = column[i]
+            if value == _INT_MISSING:
+                return default
+            return None if value == _INT_NONE else value
+        if key == 'bounds':
+            x1, y1, x2, y2 = self.bounds[4 * i:4 * i + 4]
+            return default if x1 == _BOUNDS_MISSING else [[x1, y1], [x2, y2]]
+        if key == 'children':
+            if not self.has_children[i]:
+                return default
+            return self.child_ids[self.child_offsets[i]:self.child_offsets[i + 1]].tolist()
+        return default
+
+    def set(self, i, key, value):
+        column = self.strings.get(key)
+        if column is not None and (value is None or type(value) is str):
+            column[i] = None if value is None else sys.intern(value)
+            if self.extras[i] is not None:
+                self.extras[i].pop(key, None)
+            return
+        if self.extras[i] is None:
+            self.extras[i] = {}
+        self.extras[i][key] = value
+        if key not in self.key_order:
+            self.key_order.append(key)
+
+    def delete(self, i, key):
+        if not self.contains(i, key):
+            raise KeyError(key)
+        if self.extras[i] is None:
+            self.extras[i] = {}
+        self.extras[i][key] = _DELETED
+
+    def contains(self, i, key):
+        return self.get(i, key, _MISSING) is not _MISSING
+
+    def keys(self, i):
+        return [key for key in self.key_order if self.contains(i, key)]
+
+    def nbytes(self):
+        """
+        approximate memory used by the views, in bytes, without the strings shared with other states
+        """
+        size = sys.getsizeof(self) + sys.getsizeof(self.records) + sys.getsizeof(self.extras)
+        size += sum(sys.getsizeof(record) for record in self.records)
+        size += self.flags.buffer_info()[1] * self.flags.itemsize
+        size += self.bounds.buffer_info()[1] * self.bounds.itemsize
+        size += self.child_offsets.buffer_info()[1] * self.child_offsets.itemsize
+        size += self.child_ids.buffer_info()[1] * self.child_ids.itemsize
+        size += self.has_children.buffer_info()[1]
+        size += sum(column.buffer_info()[1] * column.itemsize for column in self.ints.values())
+        size += sum(sys.getsizeof(column) for column in self.strings.values())
+        size += sum(sys.getsizeof(extras) + sum(sys.getsizeof(value) for value in extras.values())
+                    for extras in self.extras if extras is not None)
+        return size
+
+
+class ViewRecord(MutableMapping):
+    """
+    a view of a ViewTable, behaves as the view dict it was built from
+    """
+    __slots__ = ('table', 'index')
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    def __getitem__(self, key):
+        value = self.table.get(self.index, key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        return self.table.get(self.index, key, default)
+
+    def __contains__(self, key):
+        return self.table.contains(self.index, key)
+
+    def __setitem__(self, key, value):
+        self.table.set(self.index, key, value)
+
+    def __delitem__(self, key):
+        self.table.delete(self.index, key)
+
+    def __iter__(self):
+        return iter(self.table.keys(self.index))
+
+    def __len__(self):
+        return len(self.table.keys(self.index))
+
+    # views are compared and hashed by identity, as dicts of different views are never meant to be equal
+    __eq__ = object.__eq__
+    __ne__ = object.__ne__
+    __hash__ = object.__hash__
+
+    def to_dict(self):
+        return {key: self[key] for key in self}
+
+    def __copy__(self):
+        return self.to_dict()
+
+    def __deepcopy__(self, memo):
+        import copy
+        return copy.deepcopy(self.to_dict(), memo)
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+
+def view_to_json(obj):
+    """
+    json default function, to serialize the objects holding views, e.g. json.dumps(event, default=view_to_json)
+    """
+    if isinstance(obj, ViewRecord):
+        return obj.to_dict()
+    raise TypeError("Object of type %s is not JSON serializable" % obj.__class__.__name__)
@@ -6,6 +6,8 @@ from droidbot import input_policy
 from droidbot import env_manager
 from droidbot import DroidBot
 from droidbot.droidmaster import DroidMaster
+from droidbot.state_store import SCREENSHOT_DEDUPS, SCREENSHOT_DEDUP_EXACT, SCREENSHOT_FORMATS, STATE_FORMATS, \
+    STATE_FORMAT_JSON
 
 
 def parse_args():
@@ -89,6 +91,28 @@ def parse_args():
                         help="Ignore Ad views by checking resource_id.")
     parser.add_argument("-replay_output", action="store", dest="replay_output",
                         help="The droidbot output directory being replayed.")
+    parser.add_argument("-state_similarity", action="store", dest="state_similarity", type=float, default=None,
+                        help="Merge the near-duplicate states into one UTG node, if the similarity of their views "
+                             "is above this threshold (e.g. 0.9).")
+    parser.add_argument("-state_format", action="store", dest="state_format", default=STATE_FORMAT_JSON,
+                        choices=STATE_FORMATS,
+                        help="Format of the saved states: json, msgpack (compressed with zstd if installed), "
+                             "much smaller on long runs, or store, to append the states, events and images to "
+                             "<output_dir>/run_store instead of writing a file for each.")
+    parser.add_argument("-screenshot_format", action="store", dest="screenshot_format", default=None,
+                        choices=SCREENSHOT_FORMATS,
+                        help="Format of the saved screenshots: png, jpg or webp. By default they are saved as "
+                             "captured, png, or jpg with minicap.")
+    parser.add_argument("-screenshot_scale", action="store", dest="screenshot_scale", type=float, default=1.0,
+                        help="Size of the saved screenshots relative to the screen, e.g. 0.5. The scale is "
+                             "recorded in the states as screenshot_scale.")
+    parser.add_argument("-screenshot_dedup", action="store", dest="screenshot_dedup", default=SCREENSHOT_DEDUP_EXACT,
+                        choices=SCREENSHOT_DEDUPS,
+                        help="Save a screenshot of a screen already saved as a link to it: exact for identical "
+                             "screenshots, dhash for screenshots with the same dHash too (needs opencv).")
+    parser.add_argument("-reuse_unchanged_views", action="store_true", dest="reuse_unchanged_views",
+                        help="Take the screenshot before dumping the views, and skip the view dump if the screen "
+                             "is the same as in the previous state.")
     options = parser.parse_args()
     # print options
     return options
@@ -165,7 +189,13 @@ def main():
             master=opts.master,
             humanoid=opts.humanoid,
             ignore_ad=opts.ignore_ad,
-            replay_output=opts.replay_output)
+            replay_output=opts.replay_output,
+            state_similarity=opts.state_similarity,
+            state_format=opts.state_format,
+            screenshot_format=opts.screenshot_format,
+            screenshot_scale=opts.screenshot_scale,
+            screenshot_dedup=opts.screenshot_dedup,
+            reuse_unchanged_views=opts.reuse_unchanged_views)
         droidbot.start()
     return
 
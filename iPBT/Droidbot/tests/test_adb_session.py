@@ -0,0 +1,131 @@
+import re
+import subprocess
+import unittest
+from unittest import mock
+
+from droidbot.adapter.adb_session import ADBSessionException, ADBSessionLostException, ADBShellSession
+
+SCRIPT_LINE_RE = re.compile(r"^\((.*)\) </dev/null 2>/dev/null; printf '\\n(\S+) %d\\n' \$\?$")
+
+
+class FakeSocket(object):
+    """
+    the adb server and the device shell: accepts the requests, runs each command of a script with run_command
+    and answers its output followed by the sentinel line
+    """
+
+    def __init__(self, run_command, chunk_size=65536, fail_request=None, close_after_script=False):
+        """
+        :param run_command: function of a command, returning (output, exit status)
+        :param chunk_size: int, the most bytes returned by a recv
+        :param fail_request: str, a request of the adb server protocol answered with FAIL
+        :param close_after_script: bool, the connection is closed once a script is received
+        """
+        self.run_command = run_command
+        self.chunk_size = chunk_size
+        self.fail_request = fail_request
+        self.close_after_script = close_after_script
+        self.requests = []
+        self.scripts = []
+        self.pending = b""
+        self.closed = False
+
+    def setsockopt(self, *args):
+        pass
+
+    def sendall(self, data):
+        if len(self.requests) < 2:
+            request = data[4:].decode("utf-8")
+            self.requests.append(request)
+            if request == self.fail_request:
+                message = b"device offline"
+                self.pending += b"FAIL" + b"%04x" % len(message) + message
+            else:
+                self.pending += b"OKAY"
+            return
+        self.scripts.append(data.decode("utf-8"))
+        if self.close_after_script:
+            return
+        for line in data.decode("utf-8").splitlines():
+            command, sentinel = SCRIPT_LINE_RE.match(line).groups()
+            output, exit_status = self.run_command(command)
+            self.pending += ("%s\n%s %d\n" % (output, sentinel, exit_status)).encode("utf-8")
+
+    def recv(self, size):
+        data = self.pending[:min(size, self.chunk_size)]
+        self.pending = self.pending[len(data):]
+        return data
+
+    def close(self):
+        self.closed = True
+
+
+def echo_command(command):
+    if command.startswith("exit "):
+        return "", int(command.split()[1])
+    return command[len("echo"):], 0
+
+
+class ADBShellSessionTest(unittest.TestCase):
+
+    def open_session(self, fake_socket):
+        session = ADBShellSession("emulator-5554")
+        patcher = mock.patch("socket.create_connection", return_value=fake_socket)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return session
+
+    def test_run(self):
+        fake_socket = FakeSocket(echo_command)
+        session = self.open_session(fake_socket)
+        self.assertEqual(session.run("echo hello"), "hello")
+        self.assertEqual(session.run_many(["echo a", "echo  b c ", "echo"]), ["a", "b c", ""])
+        self.assertEqual(fake_socket.requests, ["host:transport:emulator-5554", "shell:sh"])
+        # the commands of run_many are sent at once
+        self.assertEqual(len(fake_socket.scripts), 2)
+
+    def test_sentinel_split_across_reads(self):
+        fake_socket = FakeSocket(lambda command: ("x" * 100 + "\n" + "y" * 50, 0), chunk_size=3)
+        session = self.open_session(fake_socket)
+        self.assertEqual(session.run_many(["one", "two"]), ["x" * 100 + "\n" + "y" * 50] * 2)
+        self.assertEqual(fake_socket.pending, b"")
+
+    def test_sentinel_in_output(self):
+        # the sentinel of a command is only matched at the start of a line, followed by the exit status
+        fake_socket = FakeSocket(lambda command: ("__droidbot_1__ text __droidbot_1__", 0))
+        session = self.open_session(fake_socket)
+        self.assertEqual(session.run("cat"), "__droidbot_1__ text __droidbot_1__")
+
+    def test_exit_status(self):
+        fake_socket = FakeSocket(echo_command)
+        session = self.open_session(fake_socket)
+        with self.assertRaises(subprocess.CalledProcessError) as context:
+            session.run_many(["echo a", "exit 3"])
+        self.assertEqual(context.exception.returncode, 3)
+        self.assertEqual(context.exception.cmd, "exit 3")
+        # the session is still usable
+        self.assertEqual(session.run("echo b"), "b")
+
+    def test_open_failure(self):
+        session = ADBShellSession("emulator-5554")
+        with mock.patch("socket.create_connection", side_effect=ConnectionRefusedError()):
+            self.assertRaises(ADBSessionException, session.run, "echo a")
+        fake_socket = FakeSocket(echo_command, fail_request="host:transport:emulator-5554")
+        with mock.patch("socket.create_connection", return_value=fake_socket):
+            self.assertRaises(ADBSessionException, session.run, "echo a")
+        self.assertTrue(fake_socket.closed)
+        self.assertEqual(fake_socket.scripts, [])
+
+    def test_lost_after_send(self):
+        fake_socket = FakeSocket(echo_command, close_after_script=True)
+        session = self.open_session(fake_socket)
+        # the command may have run, it is not reported as a session that could not be used
+        with self.assertRaises(ADBSessionLostException):
+            session.run("input tap 10 10")
+        self.assertEqual(len(fake_socket.scripts), 1)
+        self.assertTrue(fake_socket.closed)
+        self.assertIsNone(session.sock)
+
+
+if __name__ == "__main__":
+    unittest.main()
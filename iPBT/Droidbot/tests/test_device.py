@@ -0,0 +1,74 @@
+import logging
+import unittest
+from unittest import mock
+
+from droidbot.device import DUMPSYS_SEPARATOR, Device, parse_activities_dump, parse_services_dump
+
+ACTIVITIES_DUMP = """ACTIVITY MANAGER ACTIVITIES (dumpsys activity activities)
+Display #0 (activities from top to bottom):
+  Stack #1:
+    Task id #12
+    * TaskRecord{5b2c1a0 #12 A=com.app U=0 StackId=1 sz=2}
+      * Hist #1: ActivityRecord{8c3e0f1 u0 com.app/.DetailActivity t12}
+      * Hist #0: ActivityRecord{2a9d4b7 u0 com.app/.MainActivity t12}
+  Stack #0:
+    Task id #3
+      * Hist #0: ActivityRecord{41f2e8c u0 com.android.launcher3/.Launcher t3}
+"""
+
+SERVICES_DUMP = """ACTIVITY MANAGER SERVICES (dumpsys activity services)
+  User 0 active services:
+  * ServiceRecord{d1a2b3c u0 com.app/.SyncService}
+    intent={cmp=com.app/.SyncService}
+  * ServiceRecord{e4f5a6b u0 com.google.android.gms/.chimera.PersistentIntentOperationService}
+"""
+
+
+class DumpsysParserTest(unittest.TestCase):
+
+    def test_parse_activities_dump(self):
+        top_activity, task_to_activities = parse_activities_dump(ACTIVITIES_DUMP)
+        self.assertEqual(top_activity, "com.app/.DetailActivity")
+        self.assertEqual(task_to_activities, {
+            "12": ["com.app/.DetailActivity", "com.app/.MainActivity"],
+            "3": ["com.android.launcher3/.Launcher"],
+        })
+
+    def test_parse_activities_dump_without_activity(self):
+        self.assertEqual(parse_activities_dump(""), (None, {}))
+
+    def test_parse_services_dump(self):
+        self.assertEqual(parse_services_dump(SERVICES_DUMP), [
+            "com.app/.SyncService",
+            "com.google.android.gms/.chimera.PersistentIntentOperationService",
+        ])
+
+    def test_get_activity_snapshot(self):
+        device = Device.__new__(Device)
+        device.logger = logging.getLogger("Device")
+        device.adb = mock.Mock()
+        device.adb.shell.return_value = ACTIVITIES_DUMP + DUMPSYS_SEPARATOR + "\n" + SERVICES_DUMP
+
+        top_activity, activity_stack, services = device.get_activity_snapshot()
+        self.assertEqual(top_activity, "com.app/.DetailActivity")
+        self.assertEqual(activity_stack, ["com.app/.DetailActivity", "com.app/.MainActivity"])
+        self.assertEqual(services, parse_services_dump(SERVICES_DUMP))
+        # both dumps come from a single shell command
+        device.adb.shell.assert_called_once()
+        self.assertIn(DUMPSYS_SEPARATOR, " ".join(device.adb.shell.call_args[0][0]))
+
+    def test_get_activity_snapshot_split(self):
+        # the activities of the services dump are not taken for the activity stack, and the other way around
+        device = Device.__new__(Device)
+        device.logger = logging.getLogger("Device")
+        device.adb = mock.Mock()
+        device.adb.shell.return_value = SERVICES_DUMP + DUMPSYS_SEPARATOR + "\n" + ACTIVITIES_DUMP
+
+        top_activity, activity_stack, services = device.get_activity_snapshot()
+        self.assertIsNone(top_activity)
+        self.assertIsNone(activity_stack)
+        self.assertEqual(services, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from droidbot.run_store import KIND_SCREENSHOT, KIND_STATE, SEGMENT_FILE_NAME, RunStore
+
+
+class RunStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.store_dir)
+
+    def segment_path(self, segment):
+        return os.path.join(self.store_dir, SEGMENT_FILE_NAME % segment)
+
+    def test_reopen(self):
+        store = RunStore(self.store_dir, writable=True)
+        store.put_object(KIND_STATE, "t1", {"tag": "t1"}, state_str="s1")
+        store.put(KIND_SCREENSHOT, "screen_t1.png", b"png")
+        store.put_link(KIND_SCREENSHOT, "screen_t2.png", "screen_t1.png")
+        store.close()
+
+        store = RunStore(self.store_dir)
+        self.assertEqual(store.get(KIND_STATE, "t1"), {"tag": "t1"})
+        self.assertEqual(store.get_states_by_state_str("s1"), [{"tag": "t1"}])
+        self.assertEqual(store.keys(KIND_SCREENSHOT), ["screen_t1.png", "screen_t2.png"])
+        self.assertEqual(store.get(KIND_SCREENSHOT, "screen_t2.png"), b"png")
+        store.close()
+
+    def test_reopen_after_truncated_segment(self):
+        store = RunStore(self.store_dir, writable=True)
+        store.put(KIND_SCREENSHOT, "a", b"a" * 10)
+        store.close()
+        store = RunStore(self.store_dir, writable=True)
+        store.put(KIND_SCREENSHOT, "b", b"b" * 10)
+        store.close()
+        # the run was killed before the data of b reached its segment
+        with open(self.segment_path(1), "wb") as f:
+            f.write(b"bb")
+
+        store = RunStore(self.store_dir, writable=True)
+        self.assertEqual(store.keys(KIND_SCREENSHOT), ["a"])
+        store.put(KIND_SCREENSHOT, "c", b"c" * 10)
+        store.close()
+        # c is not appended after the partial data of b
+        with open(self.segment_path(1), "rb") as f:
+            self.assertEqual(f.read(), b"bb")
+
+        store = RunStore(self.store_dir)
+        self.assertEqual(store.keys(KIND_SCREENSHOT), ["a", "c"])
+        self.assertEqual(store.get(KIND_SCREENSHOT, "a"), b"a" * 10)
+        self.assertEqual(store.get(KIND_SCREENSHOT, "c"), b"c" * 10)
+        store.close()
+
+    def test_segment_size(self):
+        store = RunStore(self.store_dir, writable=True, segment_size=16)
+        for key in "abc":
+            store.put(KIND_SCREENSHOT, key, key.encode() * 10)
+        self.assertEqual([store.entries[KIND_SCREENSHOT][key]["segment"] for key in "abc"], [0, 1, 2])
+        self.assertEqual(store.get(KIND_SCREENSHOT, "b"), b"b" * 10)
+        store.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
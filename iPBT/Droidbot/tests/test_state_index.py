@@ -0,0 +1,61 @@
+import unittest
+
+from droidbot.state_index import StateIndex
+
+
+class FakeState(object):
+    """
+    the attributes of DeviceState used by StateIndex, with views already holding their signatures
+    """
+
+    def __init__(self, state_str, signatures, foreground_activity="com.app/.MainActivity", screenshot_dhash=None):
+        self.state_str = state_str
+        self.foreground_activity = foreground_activity
+        self.views = [{"signature": signature} for signature in signatures]
+        self.screenshot_dhash = screenshot_dhash
+
+
+def list_signatures(first, last):
+    return ["[class]android.widget.TextView,[resource_id]com.app:id/item,[text]item %d" % i
+            for i in range(first, last)]
+
+
+class StateIndexTest(unittest.TestCase):
+
+    def test_near_duplicate(self):
+        index = StateIndex(use_screenshots=False)
+        # a list scrolled by one item
+        self.assertEqual(index.get_cluster_str(FakeState("s1", list_signatures(0, 100))), "s1")
+        self.assertEqual(index.get_cluster_str(FakeState("s2", list_signatures(1, 101))), "s1")
+        self.assertEqual(index.cluster_sizes, {"s1": 2})
+
+    def test_different_states(self):
+        index = StateIndex(use_screenshots=False)
+        self.assertEqual(index.get_cluster_str(FakeState("s1", list_signatures(0, 100))), "s1")
+        self.assertEqual(index.get_cluster_str(FakeState("s2", list_signatures(50, 150))), "s2")
+        # the same views in another activity
+        self.assertEqual(index.get_cluster_str(FakeState("s3", list_signatures(0, 100), "com.app/.Other")), "s3")
+
+    def test_known_state(self):
+        index = StateIndex(use_screenshots=False)
+        index.get_cluster_str(FakeState("s1", list_signatures(0, 100)))
+        index.get_cluster_str(FakeState("s2", list_signatures(1, 101)))
+        self.assertEqual(index.get_cluster_str(FakeState("s2", [])), "s1")
+        self.assertEqual(index.cluster_sizes, {"s1": 2})
+
+    def test_screenshots(self):
+        index = StateIndex(max_dhash_distance=8)
+        index.get_cluster_str(FakeState("s1", list_signatures(0, 100), screenshot_dhash=0))
+        self.assertEqual(index.get_cluster_str(FakeState("s2", list_signatures(1, 101), screenshot_dhash=0xff)), "s1")
+        # same views, but the screen looks different
+        self.assertEqual(index.get_cluster_str(FakeState("s3", list_signatures(1, 101), screenshot_dhash=0x1ff)),
+                         "s3")
+
+    def test_empty_state(self):
+        index = StateIndex(use_screenshots=False)
+        self.assertEqual(index.get_cluster_str(FakeState("s1", [])), "s1")
+        self.assertEqual(index.get_cluster_str(FakeState("s2", [])), "s1")
+
+
+if __name__ == "__main__":
+    unittest.main()
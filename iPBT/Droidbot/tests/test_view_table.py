@@ -0,0 +1,84 @@
+import copy
+import json
+import unittest
+
+from droidbot.view_table import ViewTable, view_to_json
+
+
+def make_raw_views():
+    return [
+        {"temp_id": 0, "parent": -1, "children": [1, 2], "class": "android.widget.FrameLayout",
+         "resource_id": None, "text": None, "content_description": None, "package": "com.app",
+         "visible": True, "clickable": False, "enabled": True, "bounds": [[0, 0], [1080, 2400]],
+         "size": "1080*2400", "child_count": 2},
+        {"temp_id": 1, "parent": 0, "children": [], "class": "android.widget.Button",
+         "resource_id": "com.app:id/ok", "text": "OK", "content_description": "confirm", "package": "com.app",
+         "visible": True, "clickable": True, "enabled": True, "bounds": [[10, 20], [110, 70]],
+         "size": "100*50", "child_count": 0},
+        # values that do not fit the columns are kept as they are
+        {"temp_id": 2, "parent": 0, "children": [], "class": "android.widget.TextView",
+         "resource_id": None, "text": 42, "content_description": None, "package": "com.app",
+         "visible": "yes", "clickable": False, "enabled": True, "bounds": [[0, 0], [1.5, 2]],
+         "size": "0*0", "child_count": 0, "hint": {"lines": 2}},
+    ]
+
+
+class ViewRecordTest(unittest.TestCase):
+    """
+    a ViewRecord must behave as the view dict it is built from
+    """
+
+    def setUp(self):
+        self.raw_views = make_raw_views()
+        self.records = ViewTable(copy.deepcopy(self.raw_views)).records
+
+    def test_keys_and_values(self):
+        for raw_view, record in zip(self.raw_views, self.records):
+            self.assertEqual(list(record.keys()), list(raw_view.keys()))
+            self.assertEqual(len(record), len(raw_view))
+            for key, value in raw_view.items():
+                self.assertEqual(record[key], value)
+            self.assertEqual(record.to_dict(), raw_view)
+
+    def test_get_and_contains(self):
+        record = self.records[1]
+        self.assertEqual(record.get("text"), "OK")
+        self.assertIn("resource_id", record)
+        self.assertNotIn("signature", record)
+        self.assertIsNone(record.get("signature"))
+        self.assertEqual(record.get("signature", "default"), "default")
+        self.assertIsNone(self.records[0].get("text", "default"))
+        with self.assertRaises(KeyError):
+            record["signature"]
+
+    def test_set_and_delete(self):
+        record = self.records[1]
+        record["signature"] = "[class]Button"
+        record["text"] = None
+        record["extra"] = [1, 2]
+        self.assertEqual(record["signature"], "[class]Button")
+        self.assertIsNone(record["text"])
+        self.assertEqual(record["extra"], [1, 2])
+        del record["content_description"]
+        self.assertNotIn("content_description", record)
+        with self.assertRaises(KeyError):
+            del record["content_description"]
+        # the other views are not changed
+        self.assertEqual(self.records[2].to_dict(), self.raw_views[2])
+
+    def test_json(self):
+        self.assertEqual(json.loads(json.dumps(self.records, default=view_to_json)), self.raw_views)
+        event = {"event_type": "touch", "view": self.records[1]}
+        self.assertEqual(json.loads(json.dumps(event, default=view_to_json)),
+                         {"event_type": "touch", "view": self.raw_views[1]})
+
+    def test_copy(self):
+        view_copy = copy.deepcopy(self.records[2])
+        self.assertIsInstance(view_copy, dict)
+        self.assertEqual(view_copy, self.raw_views[2])
+        view_copy["hint"]["lines"] = 3
+        self.assertEqual(self.records[2]["hint"], {"lines": 2})
+
+
+if __name__ == "__main__":
+    unittest.main()
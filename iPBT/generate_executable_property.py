@@ -1,13 +1,49 @@
+import functools
+import hashlib
 import json
+import math
+import random
+import re
+import sqlite3
+from collections import Counter
 import pandas as pd
 import os
-from openai import AsyncOpenAI
+import httpx
+from openai import AsyncOpenAI, APIConnectionError, APIStatusError, APITimeoutError, DefaultAsyncHttpxClient
 from dotenv import load_dotenv
 import asyncio
+from llm_backend import backend_base_url
 
 load_dotenv()
 
+# provider name -> (api key env var, base url env var, model), the model of deepseek is read from DEEPSEEK_MODEL
+PROVIDERS = {
+    "gpt-4o": ("OPENAI_API_KEY", None, "gpt-4o"),
+    "deepseek_fireworks": ("DEEPSEEK_API_KEY", "DEEPSEEK_URL", None),
+}
+# maximum number of requests in flight, shared by all the columns
+MAX_CONCURRENCY = int(os.environ.get("PROPERTY_MAX_CONCURRENCY", 16))
+MAX_RETRIES = 5
+REQUEST_TIMEOUT = 120
+
+# at most this many widgets of the identifier file are put in a prompt, the ones most relevant to the property
+MAX_IDENTIFIERS = int(os.environ.get("PROPERTY_MAX_IDENTIFIERS", 40))
+# widget fields searched when ranking the identifiers, see generate_final_widget_annotation
+IDENTIFIER_FIELDS = ("text", "resource_id", "description", "class", "semantic_label", "functionality")
+# BM25 parameters
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# one client per provider, so the connections are kept alive and reused across prompts
+clients = {}
+llm_semaphore = None
+response_cache = None
+# prompts being sent, identical prompts wait for the same call
+in_flight = {}
+
 def generate_prompt(property_description, ui_element_identifier):
+    # the static instructions, APIs and examples come first and the per-property parts last,
+    # so that every prompt shares the same prefix and the provider can cache it
     template = """
 You are an expert in Python programming and Android app testing, and your role is to write test snippets for Android apps.
 
@@ -48,9 +84,6 @@ open notification: self.device.open_notification()
 Next button on the notification: self.device(description="Next")
 get the current time from the device: self.device(resourceId="com.android.systemui:id/clock").get_text()
 
-The app's UI element identifiers are detailed below for reference, ensuring accurate element selection in tests.
-{ui_element_identifier}
-
 Here is an example test snippet that you might write, based on a given property description:
 
 Example 1: 
@@ -101,6 +134,9 @@ Property test snippet:
         self.device.press("back")
         assert self.device(text=note_content_text).exists() and self.device(text=note_title_text).exists()
 
+The app's UI element identifiers are detailed below for reference, ensuring accurate element selection in tests.
+{ui_element_identifier}
+
 Your task:
 Using the available APIs, UI element identifiers and following the example format, please write a test snippet for the following property:
 {property_description}
@@ -111,32 +147,233 @@ Respond only with the Python code snippet, strictly adhering to the given proper
         "{ui_element_identifier}", ui_element_identifier
     )
 
-async def call_llm(prompt,llm="gpt-4o"):
-    try:
-        client = None
-        model = None
-        if llm == "deepseek_fireworks":
-            print("calling deepseek")
-            client = AsyncOpenAI(api_key=os.environ.get("DEEPSEEK_API_KEY"),base_url=os.environ.get("DEEPSEEK_URL"))
-            model = os.environ.get("DEEPSEEK_MODEL")
-        else:
-            client = AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
-            model="gpt-4o"
-            print("calling gpt-4o")
-        completion = await client.chat.completions.create(
-            model=model,
-            messages=[
-                {
-                    "role": "user",
-                    "content": prompt,
-                }
-            ],
-            temperature=0,
+def tokenize(text):
+    """
+    split into lowercase words, resource ids and camelCase names are split too: "id/noteTitle" -> ["id", "note", "title"]
+    """
+    text = re.sub(r"([a-z0-9])([A-Z])", r"\1 \2", str(text))
+    return [token for token in re.split(r"[^0-9a-z]+", text.lower()) if len(token) > 1]
+
+
+class IdentifierIndex:
+    """
+    BM25 index over the widgets of an identifier file ({activity: [widget, ...]}, the _final.json annotations)
+    """
+    def __init__(self, identifiers):
+        self.identifiers = identifiers
+        self.entries = []
+        self.docs = []
+        for activity, widgets in identifiers.items():
+            for position, widget in enumerate(widgets):
+                tokens = tokenize(activity)
+                for field in IDENTIFIER_FIELDS:
+                    if widget.get(field):
+                        tokens.extend(tokenize(widget[field]))
+                self.entries.append((activity, position))
+                self.docs.append(Counter(tokens))
+        self.doc_lengths = [sum(doc.values()) for doc in self.docs]
+        self.avg_length = sum(self.doc_lengths) / len(self.docs) if self.docs else 0
+        doc_freq = Counter(token for doc in self.docs for token in doc)
+        self.idf = {token: math.log(1 + (len(self.docs) - freq + 0.5) / (freq + 0.5))
+                    for token, freq in doc_freq.items()}
+
+    def score(self, query_tokens, i):
+        doc = self.docs[i]
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths[i] / self.avg_length)
+        score = 0.0
+        for token in query_tokens:
+            tf = doc.get(token, 0)
+            if tf:
+                score += self.idf[token] * tf * (BM25_K1 + 1) / (tf + norm)
+        return score
+
+    def select(self, description, top_k=MAX_IDENTIFIERS):
+        """
+        keep the top_k widgets most relevant to the description, in their original order
+        :return: {activity: [widget, ...]}, every widget if none of them matches the description
+        """
+        if len(self.entries) <= top_k:
+            return self.identifiers
+        query_tokens = set(tokenize(description))
+        scores = [(self.score(query_tokens, i), i) for i in range(len(self.entries))]
+        selected = sorted(i for score, i in sorted(scores, reverse=True)[:top_k] if score > 0)
+        if not selected:
+            return self.identifiers
+        relevant = {}
+        for i in selected:
+            activity, position = self.entries[i]
+            relevant.setdefault(activity, []).append(self.identifiers[activity][position])
+        return relevant
+
+
+@functools.lru_cache(maxsize=None)
+def load_ui_identifiers(ui_identifier_path):
+    """
+    read an identifier file once for all the properties using it
+    :return: (identifiers, index), the index is None if the file is not in the {activity: [widget, ...]} format
+    """
+    with open(ui_identifier_path, "r", encoding="utf-8") as f:
+        identifiers = json.load(f)
+    if isinstance(identifiers, dict) and all(
+            isinstance(widgets, list) and all(isinstance(widget, dict) for widget in widgets)
+            for widgets in identifiers.values()):
+        return identifiers, IdentifierIndex(identifiers)
+    return identifiers, None
+
+def get_ui_identifier(ui_identifier_path, property_description):
+    """
+    the identifiers to put in the prompt of a property, filtered to the relevant widgets when possible
+    """
+    identifiers, index = load_ui_identifiers(ui_identifier_path)
+    if index is not None:
+        identifiers = index.select(property_description)
+    return json.dumps(identifiers, ensure_ascii=False)
+
+class ResponseCache:
+    """
+    persistent cache of llm responses keyed by (model, prompt hash), the calls use temperature 0
+    so the same prompt can be answered from the cache across columns and runs
+    """
+    def __init__(self, path):
+        dir_name = os.path.dirname(path)
+        if dir_name:
+            os.makedirs(dir_name, exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, model TEXT, response TEXT)"
         )
-        return completion.choices[0].message.content
-    except Exception as e:
-        print(f"Error: {e}")
-        return ""
+        self.conn.commit()
+        self.hits = 0
+        self.misses = 0
+        self.deduplicated = 0
+
+    @staticmethod
+    def get_key(model, prompt):
+        return hashlib.sha256(f"{model}\0{prompt}".encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        row = self.conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0]
+
+    def put(self, key, model, response):
+        self.conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)", (key, model, response))
+        self.conn.commit()
+
+    def report(self):
+        total = self.hits + self.misses + self.deduplicated
+        if total == 0:
+            return
+        print(f"Response cache: {self.hits} hits, {self.deduplicated} duplicate prompts in this run, "
+              f"{self.misses} misses, hit rate {(self.hits + self.deduplicated) / total:.1%}")
+
+    def close(self):
+        self.conn.close()
+
+
+def get_client(llm):
+    """
+    get the shared client of a provider, creating it on first use
+    """
+    if llm not in clients:
+        api_key_env, base_url_env, _ = PROVIDERS[llm]
+        http_client = DefaultAsyncHttpxClient(
+            limits=httpx.Limits(max_connections=MAX_CONCURRENCY, max_keepalive_connections=MAX_CONCURRENCY),
+            timeout=httpx.Timeout(REQUEST_TIMEOUT, connect=10),
+        )
+        # retries are handled in call_llm so they are bounded by the scheduler
+        clients[llm] = AsyncOpenAI(api_key=os.environ.get(api_key_env),
+                                   base_url=backend_base_url(os.environ.get(base_url_env) if base_url_env else None),
+                                   http_client=http_client, max_retries=0)
+    return clients[llm]
+
+async def close_clients():
+    for client in clients.values():
+        await client.close()
+    clients.clear()
+
+def get_retry_after(error, attempt):
+    """
+    seconds to wait before retrying: the retry-after header of the provider if any,
+    otherwise exponential backoff with jitter
+    """
+    response = getattr(error, "response", None)
+    if response is not None:
+        try:
+            if "retry-after-ms" in response.headers:
+                return float(response.headers["retry-after-ms"]) / 1000
+            if "retry-after" in response.headers:
+                return float(response.headers["retry-after"])
+        except ValueError:
+            pass
+    return min(60, 2 ** attempt) * (0.5 + random.random())
+
+def is_retryable(error):
+    if isinstance(error, (APIConnectionError, APITimeoutError)):
+        return True
+    return isinstance(error, APIStatusError) and (error.status_code == 429 or error.status_code >= 500)
+
+async def call_llm(prompt,llm="gpt-4o", retries=MAX_RETRIES):
+    """
+    call the llm, answered from the response cache if the prompt was already sent to the model
+    :return: the response, None if the call failed
+    """
+    model = PROVIDERS[llm][2] or os.environ.get("DEEPSEEK_MODEL")
+    if response_cache is None:
+        return await request_llm(prompt, llm, model, retries)
+
+    key = ResponseCache.get_key(model, prompt)
+    if key in in_flight:
+        response_cache.deduplicated += 1
+        return await in_flight[key]
+    cached = response_cache.get(key)
+    if cached is not None:
+        return cached
+
+    in_flight[key] = asyncio.ensure_future(request_llm(prompt, llm, model, retries))
+    try:
+        response = await in_flight[key]
+    finally:
+        del in_flight[key]
+    if response is not None:
+        response_cache.put(key, model, response)
+    return response
+
+async def request_llm(prompt, llm, model, retries):
+    """
+    send the prompt to the llm, at most MAX_CONCURRENCY requests run at the same time
+    """
+    global llm_semaphore
+    if llm_semaphore is None:
+        llm_semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+    client = get_client(llm)
+    for attempt in range(retries):
+        async with llm_semaphore:
+            try:
+                print(f"calling {model}")
+                completion = await client.chat.completions.create(
+                    model=model,
+                    messages=[
+                        {
+                            "role": "user",
+                            "content": prompt,
+                        }
+                    ],
+                    temperature=0,
+                )
+                return completion.choices[0].message.content
+            except Exception as e:
+                if not is_retryable(e) or attempt == retries - 1:
+                    print(f"Error: {e}")
+                    return None
+                wait_time = get_retry_after(e, attempt)
+                print(f"Error: {e}, retrying in {wait_time:.1f} seconds ({attempt + 1}/{retries})")
+        # back off outside the semaphore so the other requests can go on
+        await asyncio.sleep(wait_time)
+    return None
 
 
 async def process_column(df, col_name):
@@ -146,10 +383,7 @@ async def process_column(df, col_name):
     for index, description in enumerate(df[col_name]):
         ui_identifier_path = df.iloc[index, 1]  # get UI Element Identifier
         try:
-            with open(ui_identifier_path, "r", encoding="utf-8") as f:
-                config = json.load(f)
-            
-            ui_identifier = json.dumps(config, ensure_ascii=False)
+            ui_identifier = get_ui_identifier(ui_identifier_path, description)
         except Exception as e:
             print(f"read {ui_identifier_path} error: {e}")
             ui_identifier = ""
@@ -158,6 +392,10 @@ async def process_column(df, col_name):
         tasks.append(call_llm(prompt))
 
     processed_results = await asyncio.gather(*tasks)
+    failed = sum(result is None for result in processed_results)
+    if failed:
+        print(f"{col_name}: {failed}/{len(processed_results)} properties failed, left empty")
+    processed_results = ["" if result is None else result for result in processed_results]
     empty_result = ["" for _ in processed_results]
 
     # save the results on the next column
@@ -167,7 +405,13 @@ async def process_column(df, col_name):
     df.insert(df.columns.get_loc(col_name) + 2, empty_col_name, empty_result)
 
 
-async def main(input_file, output_file):
+async def main(input_file, output_file, cache_path=None):
+    """
+    :param cache_path: sqlite file of the response cache, None to always call the llm
+    """
+    global response_cache
+    if cache_path:
+        response_cache = ResponseCache(cache_path)
     try:
         df = pd.read_excel(input_file)
         property_description_cols = list(df.columns[2:])
@@ -181,8 +425,17 @@ async def main(input_file, output_file):
         print(f"Results saved to {output_file}")
     except Exception as e:
         print(f"Error: {e}")
+    finally:
+        await close_clients()
+        if response_cache is not None:
+            response_cache.report()
+            response_cache.close()
+            response_cache = None
 
 # put the widget widget identifier and the property description in the file property.xlsx
-file_path = "property.xlsx"
-output_file = "generated_executable_property.xlsx"
-asyncio.run(main(file_path, output_file))
+if __name__ == "__main__":
+    file_path = "property.xlsx"
+    output_file = "generated_executable_property.xlsx"
+    # responses are reused across columns and runs, delete the file to regenerate everything
+    cache_path = "output/property_response_cache.sqlite"
+    asyncio.run(main(file_path, output_file, cache_path))
@@ -1,6 +1,15 @@
 import asyncio
 import glob
+import hashlib
 import io
+import math
+import random
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from multiprocessing.util import debug
 from openai import AsyncOpenAI, OpenAI
 import base64
@@ -10,37 +19,420 @@ from dotenv import load_dotenv
 import os
 
 from openai import RateLimitError
+from llm_backend import backend_base_url
+# the outputs of droidbot are read with its own modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "Droidbot"))
+from droidbot.run_store import KIND_SCREENSHOT, KIND_STATE, RunStore, is_run_store
+from droidbot.state_store import STATE_FILE_EXTENSIONS, load_state_file
 load_dotenv()
 from asyncio import Condition
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+ANNOTATION_MODEL = "gpt-4o-mini"
+WIDGET_ANNOTATION_PROMPT = """You are a professional mobile app UI semantic annotation assistant. 
+    Please annotate the provided UI widget with the semantic label and functionality based on the given context. 
+    - The full page screenshot, where the target widget is highlighted with a red bounding box.
+    - The cropped widget image and its attributes.
+    - The provided app name and foreground activity name.
+
+    Strict rules:
+    1. You must ONLY annotate the SINGLE widget provided in the input.
+    2. It is STRICTLY FORBIDDEN to invent or add any other widgets.
+    3. You must output EXACTLY one JSON object for the given widget, with no explanations or extra text.
+    4. The JSON object MUST contain ONLY these two fields:
+    - semantic_label: a concise semantic description of the widget.
+    - functionality: a brief description of the widget's functionality.
+
+    Example:
+    App name: "bankapp"
+    Foreground Activity name: "MainActivity"
+
+    Input widget:
+    {
+        "text": "Login",
+        "resource_id": "btn_login",
+        "content_description": "",
+        "class": "android.widget.Button",
+        "bounds": [50, 600, 200, 650]
+    }
+
+    Expected output:
+    {
+        "semantic_label": "Login button",
+        "functionality": "Authenticate user and enter the app",
+    }
+    """
+BATCH_ANNOTATION_PROMPT = """You are a professional mobile app UI semantic annotation assistant. 
+    Please annotate each of the provided UI widgets with the semantic label and functionality based on the given context. 
+    - The full page screenshot, where every target widget is highlighted with a red bounding box labelled with its index.
+    - For each target widget, its index, its attributes and its cropped image.
+    - The provided app name and foreground activity name.
+
+    Strict rules:
+    1. You must ONLY annotate the widgets provided in the input, each exactly once.
+    2. It is STRICTLY FORBIDDEN to invent or add any other widgets.
+    3. You must output EXACTLY one JSON object with no explanations or extra text.
+    4. The JSON object MUST contain ONLY the field "annotations", a list with one object per widget, and each object MUST contain ONLY these three fields:
+    - index: the index of the widget in the input.
+    - semantic_label: a concise semantic description of the widget.
+    - functionality: a brief description of the widget's functionality.
+
+    Example:
+    App name: "bankapp"
+    Foreground Activity name: "MainActivity"
+
+    Widget 0:
+    {
+        "text": "Login",
+        "resource_id": "btn_login",
+        "content_description": "",
+        "class": "android.widget.Button",
+        "bounds": [50, 600, 200, 650]
+    }
+    Widget 1:
+    {
+        "text": "",
+        "resource_id": "et_username",
+        "content_description": "Username",
+        "class": "android.widget.EditText",
+        "bounds": [50, 400, 650, 480]
+    }
+
+    Expected output:
+    {
+        "annotations": [
+            {"index": 0, "semantic_label": "Login button", "functionality": "Authenticate user and enter the app"},
+            {"index": 1, "semantic_label": "Username input field", "functionality": "Enter the user name used to log in"}
+        ]
+    }
+    """
+# widgets sharing a screenshot are annotated in chunks of at most this size
+MAX_BATCH_SIZE = 30
+
+# images are downscaled to what the model actually looks at (it resizes to fit 2048x2048, then to a
+# shortest side of 768) and sent as JPEG by default, set ANNOTATION_IMAGE_FORMAT to WEBP or PNG to change
+PAGE_MAX_SHORT_SIDE = int(os.environ.get("ANNOTATION_PAGE_MAX_SHORT_SIDE", 768))
+PAGE_MAX_LONG_SIDE = int(os.environ.get("ANNOTATION_PAGE_MAX_LONG_SIDE", 2048))
+IMAGE_FORMAT = os.environ.get("ANNOTATION_IMAGE_FORMAT", "JPEG").upper()
+IMAGE_MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+# number of decoded screenshots kept in memory
+SCREENSHOT_CACHE_SIZE = 32
+# droidbot saves the screenshots as png, or jpg with minicap, or in the format chosen with -screenshot_format
+SCREENSHOT_EXTENSIONS = (".png", ".jpg", ".webp")
+
+# provider limits of the annotation model, see https://platform.openai.com/account/limits
+REQUESTS_PER_MINUTE = int(os.environ.get("ANNOTATION_RPM", 500))
+TOKENS_PER_MINUTE = int(os.environ.get("ANNOTATION_TPM", 2000000))
+# gpt-4o-mini counts image inputs at a much higher token rate than gpt-4o (85 + 170 per tile)
+IMAGE_BASE_TOKENS = 2833
+IMAGE_TILE_TOKENS = 5667
+# rough allowance for the JSON answer
+COMPLETION_TOKENS = 100
+
+
+class TokenBucket:
+    """
+    token bucket refilled continuously at `rate_per_minute`, holding at most one minute of budget
+    """
+    def __init__(self, rate_per_minute):
+        self.capacity = float(rate_per_minute)
+        self.tokens = self.capacity
+        self.fill_rate = rate_per_minute / 60.0
+        self.timestamp = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def __refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.fill_rate)
+        self.timestamp = now
+
+    async def consume(self, amount):
+        """
+        wait until `amount` tokens are available and take them, waiters are served in FIFO order
+        """
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            while True:
+                self.__refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.fill_rate)
+
+
 class RateLimiter:
-    def __init__(self):
+    """
+    global limiter of the annotation requests
+    - token buckets on both requests/min and tokens/min
+    - AIMD concurrency: one more slot per window of fast successful requests,
+      halved on a 429 and shrunk when the latency degrades
+    """
+    def __init__(self, requests_per_minute=REQUESTS_PER_MINUTE, tokens_per_minute=TOKENS_PER_MINUTE,
+                 max_concurrency=20, min_concurrency=1, latency_tolerance=2.0):
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.concurrency = float(max_concurrency)
+        self.latency_tolerance = latency_tolerance
+        self.base_latency = None
+        self.in_flight = 0
         self.condition = Condition()
-        self.is_active = False
-        self.cooldown = 60  
 
+    async def acquire(self, estimated_tokens):
+        async with self.condition:
+            while self.in_flight >= int(self.concurrency):
+                await self.condition.wait()
+            self.in_flight += 1
+        await self.request_bucket.consume(1)
+        await self.token_bucket.consume(estimated_tokens)
+
+    async def release(self, latency=None, rate_limited=False):
+        """
+        free a slot and adapt the concurrency to the outcome of the request
+        :param latency: seconds the request took, None if it failed for other reasons
+        :param rate_limited: whether the request was rejected with a 429
+        """
+        async with self.condition:
+            self.in_flight -= 1
+            if rate_limited:
+                self.concurrency = max(self.min_concurrency, self.concurrency / 2)
+                print(f" Rate limit detected, concurrency reduced to {int(self.concurrency)}")
+            elif latency is not None:
+                if self.base_latency is None or latency < self.base_latency:
+                    self.base_latency = latency
+                else:
+                    # let the baseline follow slow drifts of the provider latency
+                    self.base_latency = 0.95 * self.base_latency + 0.05 * latency
+                if latency > self.latency_tolerance * self.base_latency:
+                    self.concurrency = max(self.min_concurrency, self.concurrency * 0.9)
+                else:
+                    self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+            self.condition.notify_all()
 
-rate_limiter = RateLimiter()
+
+def estimate_image_tokens(width, height):
+    """
+    estimate the tokens of an image input with detail "high", following the OpenAI tiling rules
+    """
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = math.ceil(width / 512) * math.ceil(height / 512)
+    return IMAGE_BASE_TOKENS + IMAGE_TILE_TOKENS * tiles
+
+
+def estimate_request_tokens(page_image_path, widgets, prompt=WIDGET_ANNOTATION_PROMPT):
+    """
+    estimate the tokens of one annotation request: prompt text, page screenshot and one crop per widget
+    """
+    text_tokens = (len(prompt) + sum(len(json.dumps(widget, ensure_ascii=False)) for widget in widgets)) // 4
+    width, height = screenshot_cache.get(page_image_path).size
+    page_tokens = estimate_image_tokens(width, height)
+    crop_tokens = 0
+    for widget in widgets:
+        bounds = widget["bounds"]
+        crop_tokens += estimate_image_tokens(max(1, bounds[2] - bounds[0]), max(1, bounds[3] - bounds[1]))
+    return text_tokens + page_tokens + crop_tokens + COMPLETION_TOKENS * len(widgets)
+
+
+def get_retry_after(error, attempt):
+    """
+    seconds to wait before retrying a rate-limited request, honoring the provider's retry-after headers
+    """
+    response = getattr(error, "response", None)
+    headers = response.headers if response is not None else {}
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    # exponential backoff with jitter
+    return min(60, 2 ** attempt) + random.random()
+
+
+def dhash(img, hash_size=8):
+    """
+    perceptual difference hash of an image, as a hex string
+    """
+    pixels = list(img.convert("L").resize((hash_size + 1, hash_size)).getdata())
+    bits = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    return "%0*x" % (hash_size * hash_size // 4, bits)
+
+
+class AnnotationCache:
+    """
+    persistent, content-addressed cache of widget annotations
+    the key is a hash of everything that goes into the prompt, so a widget that is unchanged
+    between two runs (or two app versions) is never sent to the LLM again
+    """
+    def __init__(self, path):
+        cache_dir = os.path.dirname(path)
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS annotations "
+                          "(key TEXT PRIMARY KEY, semantic_label TEXT, functionality TEXT)")
+        self.conn.commit()
+        self.hits = 0
+        self.misses = 0
+        self.__page_hashes = {}
+
+    def get_key(self, page_image_path, app_name, activity_name, widget):
+        """
+        hash the prompt inputs: widget attributes, app/activity name,
+        and the perceptual hashes of the widget crop and the full page
+        """
+        img = screenshot_cache.get(page_image_path)
+        if page_image_path not in self.__page_hashes:
+            self.__page_hashes[page_image_path] = dhash(img)
+        crop_hash = dhash(img.crop(widget["bounds"]))
+        key_inputs = {
+            "model": ANNOTATION_MODEL,
+            "app_name": app_name,
+            "activity_name": activity_name,
+            "text": widget.get("text", ""),
+            "resource_id": widget.get("resource_id", ""),
+            "content_description": widget.get("content_description", ""),
+            "class": widget.get("class", ""),
+            "page_hash": self.__page_hashes[page_image_path],
+            "crop_hash": crop_hash,
+        }
+        key_str = json.dumps(key_inputs, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(key_str.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        row = self.conn.execute("SELECT semantic_label, functionality FROM annotations WHERE key = ?",
+                                (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return {"semantic_label": row[0], "functionality": row[1]}
+
+    def put(self, key, annotation):
+        self.conn.execute("INSERT OR REPLACE INTO annotations VALUES (?, ?, ?)",
+                          (key, annotation["semantic_label"], annotation["functionality"]))
+        self.conn.commit()
+
+    def report(self):
+        total = self.hits + self.misses
+        hit_rate = self.hits / total * 100 if total else 0.0
+        print(f"Annotation cache: {self.hits} hits, {self.misses} misses ({hit_rate:.1f}% hit rate)")
+
+    def close(self):
+        self.conn.close()
+
+
+class ScreenshotCache:
+    """
+    LRU cache of decoded screenshots, so that a page is decoded once for all of its widgets
+    the cached images are shared between threads and must not be modified, draw on a copy
+    """
+    def __init__(self, max_size=SCREENSHOT_CACHE_SIZE):
+        self.max_size = max_size
+        self.images = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, image_path):
+        with self.lock:
+            if image_path in self.images:
+                self.images.move_to_end(image_path)
+                return self.images[image_path]
+        with Image.open(open_screenshot(image_path)) as img:
+            img = img.convert("RGB")
+        # a screenshot saved with -screenshot_scale is brought back to the coordinates of the widget bounds
+        scale = screenshot_scales.get(image_path, 1.0)
+        if scale != 1.0:
+            img = img.resize((round(img.width / scale), round(img.height / scale)), Image.BILINEAR)
+        with self.lock:
+            self.images[image_path] = img
+            while len(self.images) > self.max_size:
+                self.images.popitem(last=False)
+        return img
+
+
+rate_limiter = None
 client = None
-semaphore = None
+annotation_cache = None
+screenshot_cache = ScreenshotCache()
+# page image path -> the scale it was saved at, for the screenshots that are not at the size of the screen
+screenshot_scales = {}
+# decoding, drawing and encoding images is done here to keep the event loop free for the HTTP clients
+image_executor = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1))
+
+async def run_in_image_pool(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(image_executor, func, *args)
+
+def downscale_image(img, max_short_side=PAGE_MAX_SHORT_SIDE, max_long_side=PAGE_MAX_LONG_SIDE):
+    scale = min(1.0, max_short_side / min(img.size), max_long_side / max(img.size))
+    if scale < 1.0:
+        img = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))), Image.LANCZOS)
+    return img
+
+def encode_base64(img):
+    buf = io.BytesIO()
+    if IMAGE_FORMAT == "PNG":
+        img.save(buf, format="PNG")
+    else:
+        img.save(buf, format=IMAGE_FORMAT, quality=85)
+    return base64.b64encode(buf.getvalue()).decode("utf-8")
+
+def image_url(encoded_image):
+    return f"data:{IMAGE_MIME_TYPES[IMAGE_FORMAT]};base64,{encoded_image}"
 
 def encode_image(image_path,bounds, save_path=None):
     """
     annotate the widget in the screenshot
     s"""
-    with Image.open(image_path) as img:
-        draw = ImageDraw.Draw(img)
+    img = screenshot_cache.get(image_path).copy()
+    draw = ImageDraw.Draw(img)
+    # view bound should be in original image bound
+    draw.rectangle([min((img.width - 1), bounds[0]), min((img.height - 1), bounds[1]),
+                    min((img.width), bounds[2]), min((img.height), bounds[3])], outline="red", width=5)
+
+    if debug:
+        save_path = f"./annotated_image/annotated_{os.path.basename(image_path)}"
+    if save_path:
+        img.save(save_path, "PNG")
+    return encode_base64(downscale_image(img))
+
+def encode_image_with_boxes(image_path, widgets):
+    """
+    annotate all the widgets in the screenshot, each box labelled with the widget index
+    """
+    img = screenshot_cache.get(image_path).copy()
+    draw = ImageDraw.Draw(img)
+    for index, widget in enumerate(widgets):
+        bounds = widget["bounds"]
         # view bound should be in original image bound
-        draw.rectangle([min((img.width - 1), bounds[0]), min((img.height - 1), bounds[1]),
-                        min((img.width), bounds[2]), min((img.height), bounds[3])], outline="red", width=5)
+        box = [min((img.width - 1), bounds[0]), min((img.height - 1), bounds[1]),
+               min((img.width), bounds[2]), min((img.height), bounds[3])]
+        draw.rectangle(box, outline="red", width=5)
+        label_box = draw.textbbox((box[0], box[1]), str(index))
+        draw.rectangle(label_box, fill="red")
+        draw.text((box[0], box[1]), str(index), fill="white")
+    return encode_base64(downscale_image(img))
 
-        if debug:
-            save_path = f"./annotated_image/annotated_{os.path.basename(image_path)}"
-        if save_path:
-            img.save(save_path, "PNG")
-        buf = io.BytesIO()
-        img.save(buf, format="PNG")
-        return base64.b64encode(buf.getvalue()).decode("utf-8")
+def encode_batch_images(image_path, widgets):
+    """
+    encode the page with all the widgets highlighted, and the crop of every widget
+    """
+    page_image = encode_image_with_boxes(image_path, widgets)
+    widget_images = [encode_element_crop(image_path, widget["bounds"]) for widget in widgets]
+    return page_image, widget_images
 
 def crop_element(image_path, bounds, save_path=None):
     """
@@ -48,7 +440,7 @@ def crop_element(image_path, bounds, save_path=None):
     bounds format: [x1, y1, x2, y2]
     """
     try:
-        img = Image.open(image_path)
+        img = screenshot_cache.get(image_path)
         crop = img.crop(bounds)
         if debug:
             save_path = f"./cropped_image/cropped_element_{os.path.basename(image_path)}_{bounds[0]}_{bounds[1]}_{bounds[2]}_{bounds[3]}.png"
@@ -64,9 +456,7 @@ def encode_element_crop(image_path, bounds):
 
     crop_img = crop_element(image_path, bounds)
 
-    buf = io.BytesIO()
-    crop_img.save(buf, format="PNG")
-    return base64.b64encode(buf.getvalue()).decode("utf-8")
+    return encode_base64(downscale_image(crop_img))
 
 def generate_final_widget_annotation(input_file):
     widgets_data = json.load(open(input_file, "r", encoding="utf-8"))
@@ -90,61 +480,203 @@ def generate_final_widget_annotation(input_file):
         json.dump(final_output, f, ensure_ascii=False, indent=2)
     print(f"Final annotations saved to {output_file}")
         
-async def generate_with_rate_limit(page_image_path, app_name, activity_name, widget, retries=5):
-    global rate_limit_active
-    
+async def lookup_cached_annotation(page_image_path, app_name, activity_name, widget):
+    """
+    look up the widget in the annotation cache
+    :return: (cache key, annotated widget), the key is None if caching is disabled,
+             the widget is None on a cache miss
+    """
+    if annotation_cache is None:
+        return None, None
+    try:
+        cache_key = await run_in_image_pool(annotation_cache.get_key, page_image_path, app_name, activity_name,
+                                            widget)
+    except Exception as e:
+        print(f"Error computing cache key: {e}")
+        return None, None
+    cached = annotation_cache.get(cache_key)
+    if cached is None:
+        return cache_key, None
+    widget["semantic_label"] = cached["semantic_label"]
+    widget["functionality"] = cached["functionality"]
+    widget.pop("screen_tag", None)
+    widget.pop("screen_scale", None)
+    return cache_key, widget
+
+async def generate_with_rate_limit(page_image_path, app_name, activity_name, widget, retries=5, cache_key=None):
+    """
+    :param cache_key: the widget's cache key if the cache has already been checked by the caller
+    """
+    if cache_key is None:
+        cache_key, cached = await lookup_cached_annotation(page_image_path, app_name, activity_name, widget)
+        if cached is not None:
+            return cached
+
+    estimated_tokens = await run_in_image_pool(estimate_request_tokens, page_image_path, [widget])
     for attempt in range(retries):
-        # wait until no limit
-        async with rate_limiter.condition:
-            while rate_limiter.is_active:
-                await rate_limiter.condition.wait()
-        
-        async with semaphore:
+        await rate_limiter.acquire(estimated_tokens)
+        start_time = time.monotonic()
+        try:
+            result = await generate_single_widget_annotation(page_image_path, app_name, activity_name, widget)
+        except RateLimitError as e:
+            await rate_limiter.release(rate_limited=True)
+            retry_after = get_retry_after(e, attempt)
+            print(f" Attempt {attempt + 1}: Rate limit error, retrying in {retry_after:.1f}s: {e}")
+            await asyncio.sleep(retry_after)
+            continue
+        except Exception as e:
+            await rate_limiter.release()
+            print(f" Attempt {attempt + 1}: Other error: {e}")
+            await asyncio.sleep(2)
+            continue
+        await rate_limiter.release(latency=time.monotonic() - start_time)
+
+        if result is None:
+            print(f" Attempt {attempt + 1}: Result is None, retrying...")
+            continue
+        if cache_key is not None:
+            annotation_cache.put(cache_key, result)
+        return result
+
+    print(" Exceeded max retries, giving up.")
+    return None
+
+
+async def generate_batch_with_rate_limit(page_image_path, app_name, activity_name, widgets, retries=5):
+    """
+    annotate widgets sharing one screenshot in a single request,
+    widgets missing from a valid answer fall back to per-widget requests
+    :return: list of annotated widgets (None on failure), in the order of `widgets`
+    """
+    results = [None] * len(widgets)
+    cache_keys = [None] * len(widgets)
+    pending = []
+    for i, widget in enumerate(widgets):
+        cache_keys[i], results[i] = await lookup_cached_annotation(page_image_path, app_name, activity_name, widget)
+        if results[i] is None:
+            pending.append(i)
+    if len(pending) == 1:
+        i = pending[0]
+        results[i] = await generate_with_rate_limit(page_image_path, app_name, activity_name, widgets[i],
+                                                    retries, cache_key=cache_keys[i])
+        return results
+
+    annotations = {}
+    if pending:
+        batch = [widgets[i] for i in pending]
+        estimated_tokens = await run_in_image_pool(estimate_request_tokens, page_image_path, batch,
+                                                   BATCH_ANNOTATION_PROMPT)
+        for attempt in range(retries):
+            await rate_limiter.acquire(estimated_tokens)
+            start_time = time.monotonic()
             try:
-                result = await generate_single_widget_annotation(page_image_path, app_name, activity_name, widget)
-                if result is None:
-                    print(f" Attempt {attempt + 1}: Result is None, retrying...")
-                    continue
-                return result
-                
+                annotations = await generate_batch_widget_annotation(page_image_path, app_name, activity_name, batch)
             except RateLimitError as e:
-                print(f" Attempt {attempt + 1}: Rate limit error: {e}")
-                
-                async with rate_limiter.condition:
-                    if not rate_limiter.is_active:
-                        
-                        rate_limiter.is_active = True
-                        print(f" Rate limit detected, pausing all tasks for {rate_limiter.cooldown}s...")
-                        rate_limiter.condition.notify_all()     
-                await asyncio.sleep(rate_limiter.cooldown)
-                 
-                async with rate_limiter.condition:
-                    rate_limiter.is_active = False
-                    print(" Rate limit cooldown complete, resuming tasks...")
-                    rate_limiter.condition.notify_all()   
+                await rate_limiter.release(rate_limited=True)
+                retry_after = get_retry_after(e, attempt)
+                print(f" Batch attempt {attempt + 1}: Rate limit error, retrying in {retry_after:.1f}s: {e}")
+                await asyncio.sleep(retry_after)
                 continue
-                
             except Exception as e:
-                print(f" Attempt {attempt + 1}: Other error: {e}")
-                await asyncio.sleep(2)
-                continue
-                
-    print(" Exceeded max retries, giving up.")
-    return None
+                await rate_limiter.release()
+                print(f" Batch attempt {attempt + 1}: Other error: {e}")
+            else:
+                await rate_limiter.release(latency=time.monotonic() - start_time)
+            break
 
+    fallback = []
+    for batch_index, i in enumerate(pending):
+        annotation = annotations.get(batch_index)
+        if annotation is None:
+            fallback.append(i)
+            continue
+        widget = widgets[i]
+        widget["semantic_label"] = annotation["semantic_label"]
+        widget["functionality"] = annotation["functionality"]
+        widget.pop("screen_tag", None)
+        widget.pop("screen_scale", None)
+        if cache_keys[i] is not None:
+            annotation_cache.put(cache_keys[i], widget)
+        results[i] = widget
 
-async def generate_single_widget_annotation(page_image_path, app_name, activity_name, widget):
+    if fallback:
+        print(f" {len(fallback)} of {len(pending)} widgets failed in batch, falling back to per-widget requests")
+        fallback_results = await asyncio.gather(
+            *(generate_with_rate_limit(page_image_path, app_name, activity_name, widgets[i],
+                                       retries, cache_key=cache_keys[i]) for i in fallback))
+        for i, result in zip(fallback, fallback_results):
+            results[i] = result
+    return results
+
+
+def get_client():
     """
-    generate annotation for single widget
+    get the client shared by all the annotation requests, creating it on first use
     """
     global client
-    
-    
     if client is None:
-        client = AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
-    
+        # rate limits are retried by generate_with_rate_limit, the client must not retry them again
+        client = AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY"), base_url=backend_base_url(), max_retries=0)
+    return client
+
+
+async def generate_batch_widget_annotation(page_image_path, app_name, activity_name, widgets):
+    """
+    generate annotations for several widgets of the same page in one request
+    :return: dict mapping the index of each validly annotated widget to its annotation
+    """
+    client = get_client()
+    page_image, widget_images = await run_in_image_pool(encode_batch_images, page_image_path, widgets)
+
+    content = [
+        {"type": "text", "text": f"App name: {app_name}"},
+        {"type": "text", "text": f"Foreground activity: {activity_name}"},
+        {"type": "text", "text": "Here is the full page screenshot, the target widgets are labelled with their index:"},
+        {"type": "image_url", "image_url": {"url": image_url(page_image)}},
+    ]
+    for index, (widget, widget_image) in enumerate(zip(widgets, widget_images)):
+        content.extend([
+            {"type": "text", "text": f"Widget {index}:"},
+            {"type": "text", "text": json.dumps(widget, ensure_ascii=False)},
+            {"type": "image_url", "image_url": {"url": image_url(widget_image)}}
+        ])
+    messages = [
+        {"role": "system", "content": BATCH_ANNOTATION_PROMPT},
+        {"role": "user", "content": content}
+    ]
+
+    response = await client.chat.completions.create(
+        model=ANNOTATION_MODEL,
+        messages=messages,
+        response_format={"type": "json_object"}
+    )
+    output = json.loads(response.choices[0].message.content)
+
+    # keep only the items matching the schema, the others are retried one by one
+    annotations = {}
+    items = output.get("annotations") if isinstance(output, dict) else None
+    if not isinstance(items, list):
+        print("Output format error, expected a JSON object with an 'annotations' list.")
+        return annotations
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        index = item.get("index")
+        if not isinstance(index, int) or not 0 <= index < len(widgets) or index in annotations:
+            continue
+        if not isinstance(item.get("semantic_label"), str) or not isinstance(item.get("functionality"), str):
+            continue
+        annotations[index] = item
+    return annotations
+
+
+async def generate_single_widget_annotation(page_image_path, app_name, activity_name, widget):
+    """
+    generate annotation for single widget
+    """
+    client = get_client()
     try:
-        page_image = encode_image(page_image_path, widget["bounds"])
+        page_image = await run_in_image_pool(encode_image, page_image_path, widget["bounds"])
     except Exception as e:
         print(f"Widget bounds: {widget['bounds']}")
         print(f"Error encoding page image: {e}")
@@ -154,7 +686,7 @@ async def generate_single_widget_annotation(page_image_path, app_name, activity_
         print(type(widget["bounds"]))
     
     try:
-        widget_image = encode_element_crop(page_image_path, widget["bounds"])
+        widget_image = await run_in_image_pool(encode_element_crop, page_image_path, widget["bounds"])
     except Exception as e:
         print(f"Error cropping widget image: {e}")
         return None
@@ -166,39 +698,7 @@ async def generate_single_widget_annotation(page_image_path, app_name, activity_
     messages = [
     {
     "role": "system",
-    "content": """You are a professional mobile app UI semantic annotation assistant. 
-    Please annotate the provided UI widget with the semantic label and functionality based on the given context. 
-    - The full page screenshot, where the target widget is highlighted with a red bounding box.
-    - The cropped widget image and its attributes.
-    - The provided app name and foreground activity name.
-
-    Strict rules:
-    1. You must ONLY annotate the SINGLE widget provided in the input.
-    2. It is STRICTLY FORBIDDEN to invent or add any other widgets.
-    3. You must output EXACTLY one JSON object for the given widget, with no explanations or extra text.
-    4. The JSON object MUST contain ONLY these two fields:
-    - semantic_label: a concise semantic description of the widget.
-    - functionality: a brief description of the widget's functionality.
-
-    Example:
-    App name: "bankapp"
-    Foreground Activity name: "MainActivity"
-
-    Input widget:
-    {
-        "text": "Login",
-        "resource_id": "btn_login",
-        "content_description": "",
-        "class": "android.widget.Button",
-        "bounds": [50, 600, 200, 650]
-    }
-
-    Expected output:
-    {
-        "semantic_label": "Login button",
-        "functionality": "Authenticate user and enter the app",
-    }
-    """
+    "content": WIDGET_ANNOTATION_PROMPT
         },
         {
             "role": "user",
@@ -206,11 +706,11 @@ async def generate_single_widget_annotation(page_image_path, app_name, activity_
                 {"type": "text", "text": f"App name: {app_name}"},
                 {"type": "text", "text": f"Foreground activity: {activity_name}"},
                 {"type": "text", "text": "Here is the full page screenshot:"},
-                {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{page_image}"}},
+                {"type": "image_url", "image_url": {"url": image_url(page_image)}},
                 {"type": "text", "text": "Target UI widget information:"},
                 {"type": "text", "text": json.dumps(widget, ensure_ascii=False)},
                 {"type": "text", "text": "Target UI widget (with cropped region):"},
-                {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{widget_image}"}}
+                {"type": "image_url", "image_url": {"url": image_url(widget_image)}}
             ]
         }
     ]
@@ -218,7 +718,7 @@ async def generate_single_widget_annotation(page_image_path, app_name, activity_
     # ===== call GPT-4o mini =====
     try:
         response = await client.chat.completions.create(
-            model="gpt-4o-mini",
+            model=ANNOTATION_MODEL,
             messages=messages,
             response_format={"type": "json_object"}
         )
@@ -239,71 +739,276 @@ async def generate_single_widget_annotation(page_image_path, app_name, activity_
     widget["functionality"] = output["functionality"]
     
     widget.pop("screen_tag", None)
+    widget.pop("screen_scale", None)
     return widget
 
-async def generate_widget_annotations(app_name, state_dir_path, widgets_file_path):
+def get_widget_key(activity_name, widget):
+    """
+    identify a widget of an activity, same fields as the deduplication in get_widget_info
+    """
+    return activity_name, widget.get("text", ""), widget.get("resource_id", ""), widget.get("content_description", "")
+
+def load_progress(progress_path):
+    """
+    load the results streamed by previous (possibly interrupted) runs
+    :return: dict mapping widget keys to the latest result of each widget
+    """
+    progress = {}
+    if not os.path.exists(progress_path):
+        return progress
+    with open(progress_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line may be truncated if the run was killed while writing
+                continue
+            progress[get_widget_key(record["activity"], record["widget"])] = record["widget"]
+    return progress
+
+async def generate_widget_annotations(app_name, state_dir_path, widgets_file_path, progress_path,
+                                      cache_path=None, batch=True):
     """
     generate functionality annotations for each widget
+    widgets of all activities go through one bounded work queue, and each result is appended to
+    `progress_path` (JSONL) as soon as it completes, so an interrupted run resumes where it stopped
+    :param progress_path: JSONL file the results are streamed to
+    :param cache_path: path to the persistent annotation cache, None to disable caching
+    :param batch: annotate the widgets sharing a screenshot in one request instead of one request per widget
+    :return: dict mapping each activity to its annotated widgets
     """
-    global semaphore, rate_limit_lock, resume_event
-    
-   
-    semaphore = asyncio.Semaphore(20)
+    global rate_limiter, annotation_cache
+
+    rate_limiter = RateLimiter(max_concurrency=20)
+    if cache_path is not None:
+        annotation_cache = AnnotationCache(cache_path)
     
     
-    output = {}
     widgets_file = json.load(open(widgets_file_path, "r", encoding="utf-8"))
+    progress = load_progress(progress_path)
+    if progress:
+        print(f"Resuming from {progress_path}: {len(progress)} widgets already processed")
+
+    num_workers = rate_limiter.max_concurrency
+    queue = asyncio.Queue(maxsize=2 * num_workers)
+    progress_file = open(progress_path, "a", encoding="utf-8")
+
+    def save_result(activity_name, widget, result):
+        if isinstance(result, Exception):
+            print(f"Widget result: Exception - {result}")
+            widget["error"] = "error: exception"
+        elif result is None:
+            widget["error"] = "error: result is None"
+        else:
+            widget = result
+        progress[get_widget_key(activity_name, widget)] = widget
+        progress_file.write(json.dumps({"activity": activity_name, "widget": widget}, ensure_ascii=False) + "\n")
+        progress_file.flush()
+
+    async def worker():
+        while True:
+            activity_name, page_image_path, widgets = await queue.get()
+            try:
+                if batch:
+                    results = await generate_batch_with_rate_limit(page_image_path, app_name, activity_name, widgets)
+                else:
+                    results = [await generate_with_rate_limit(page_image_path, app_name, activity_name, widgets[0])]
+            except Exception as e:
+                results = [e] * len(widgets)
+            for widget, result in zip(widgets, results):
+                save_result(activity_name, widget, result)
+            queue.task_done()
+
+    workers = [asyncio.create_task(worker()) for _ in range(num_workers)]
+    try:
+        for activity_name, activity_widgets in widgets_file.items():
+            print(f"Processing activity: {activity_name}")
+            # group the widgets by screenshot, skipping the ones finished by a previous run
+            screens = {}
+            for widget in activity_widgets:
+                done = progress.get(get_widget_key(activity_name, widget))
+                if done is not None and "error" not in done:
+                    continue
+                widget.pop("error", None)
 
+                page_image_path = get_screenshot_path(state_dir_path, widget["screen_tag"])
+                if "screen_scale" in widget:
+                    screenshot_scales[page_image_path] = widget["screen_scale"]
+                if not screenshot_exists(page_image_path):
+                    print(f"Page image {page_image_path} does not exist, skipping widget {widget}")
+                    continue
+                screens.setdefault(page_image_path, []).append(widget)
+
+            for page_image_path, screen_widgets in screens.items():
+                chunk_size = MAX_BATCH_SIZE if batch else 1
+                for start in range(0, len(screen_widgets), chunk_size):
+                    await queue.put((activity_name, page_image_path, screen_widgets[start:start + chunk_size]))
+        await queue.join()
+    finally:
+        for task in workers:
+            task.cancel()
+        progress_file.close()
+
+    # assemble the results of this and previous runs in the order of the widgets file
+    output = {}
     for activity_name, activity_widgets in widgets_file.items():
-        tasks = []
-        print(f"Processing activity: {activity_name}")
         for widget in activity_widgets:
-            
-            page_image_path = state_dir_path+"screen_"+widget["screen_tag"]+".png"
-            if not os.path.exists(page_image_path):
-                print(f"Page image {page_image_path} does not exist, skipping widget {widget}")
-                continue
-            tasks.append(generate_with_rate_limit(page_image_path, app_name, activity_name, widget))
-        
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-        for widget, result in zip(activity_widgets, results):
-            if isinstance(result, Exception):
-                print(f"Widget result: Exception - {result}")
-                widget["error"] = "error: exception"
-                output.setdefault(activity_name, []).append(widget)
-            elif result is None:
-                widget["error"] = "error: result is None"
-                output.setdefault(activity_name, []).append(widget)
-            else:
+            result = progress.get(get_widget_key(activity_name, widget))
+            if result is not None:
                 output.setdefault(activity_name, []).append(result)
 
     return output
 
-def load_all_json_file(path):
-   
-    json_files = glob.glob(path + "*.json")
-    all_data = []
+# views are reduced to these fields when states are loaded for widget extraction
+WIDGET_VIEW_FIELDS = ("package", "child_count", "text", "resource_id", "content_description", "class", "bounds")
+# below this many state files parsing in the main process is faster than starting a process pool
+MIN_FILES_FOR_POOL = 64
+
+
+def load_json_file(json_file):
+    """
+    parse a json file, with orjson if it is installed, or a msgpack state file
+    :return: the parsed data, None if the file is not valid
+    """
+    try:
+        if not json_file.endswith(".json") or orjson is None:
+            return load_state_file(json_file)
+        with open(json_file, "rb") as file:
+            return orjson.loads(file.read())
+    except ImportError:
+        # msgpack or zstandard is missing, every file of this format would fail
+        raise
+    except Exception as e:
+        # also the zstd and msgpack errors of a truncated or corrupt state file, e.g. from an interrupted run
+        print(f"read {json_file} error: {e}")
+        return None
 
-    for json_file in json_files:
-        with open(json_file, "r", encoding="utf-8") as file:
-            try:
-                data = json.load(file)
-                all_data.append(data)  
-            except json.JSONDecodeError as e:
-                print(f"read {json_file} error: {e}")
 
-    return all_data
+def list_state_files(path):
+    return sorted(state_file for state_file in glob.glob(path + "*")
+                  if state_file.endswith(STATE_FILE_EXTENSIONS))
+
+
+run_stores = {}
+
+
+def get_run_store(path):
+    """
+    the states directory can be the run store of a droidbot run saved with -state_format store
+    :return: RunStore of the run store at path, opened read-only, None if path is a states directory
+    """
+    store_dir = os.path.normpath(path)
+    if store_dir not in run_stores:
+        run_stores[store_dir] = RunStore(store_dir) if is_run_store(store_dir) else None
+    return run_stores[store_dir]
+
+
+def open_screenshot(image_path):
+    """
+    :return: the screenshot file, or its bytes if it is in a run store
+    """
+    if not os.path.exists(image_path):
+        store = get_run_store(os.path.dirname(image_path))
+        if store is not None and store.contains(KIND_SCREENSHOT, os.path.basename(image_path)):
+            return io.BytesIO(store.get(KIND_SCREENSHOT, os.path.basename(image_path)))
+    return image_path
+
+
+def screenshot_exists(image_path):
+    if os.path.exists(image_path):
+        return True
+    store = get_run_store(os.path.dirname(image_path))
+    return store is not None and store.contains(KIND_SCREENSHOT, os.path.basename(image_path))
+
+
+def get_screenshot_path(state_dir_path, screen_tag):
+    """
+    :return: the path of the screenshot of a state, in whichever format it was saved, the png path if there is none
+    """
+    for extension in SCREENSHOT_EXTENSIONS:
+        image_path = state_dir_path + "screen_" + screen_tag + extension
+        if screenshot_exists(image_path):
+            return image_path
+    return state_dir_path + "screen_" + screen_tag + ".png"
+
+
+def load_state_for_widgets(json_file, app_package):
+    """
+    load a state file keeping only the views of the app and the fields get_widget_info needs,
+    so that the worker processes send back a fraction of the state
+    """
+    return reduce_state_for_widgets(load_json_file(json_file), app_package)
+
+
+def reduce_state_for_widgets(data, app_package):
+    if data is None:
+        return None
+    return {
+        "tag": data["tag"],
+        "foreground_activity": data["foreground_activity"],
+        "screenshot_scale": data.get("screenshot_scale", 1.0),
+        "views": [{field: view[field] for field in WIDGET_VIEW_FIELDS if field in view}
+                  for view in data["views"] if app_package in view["package"]]
+    }
+
+
+def iter_state_files(path, app_package=None, workers=None):
+    """
+    stream the states of a states directory, in any state file format, parsing them in a process pool for large runs,
+    or of a run store directory
+    :param app_package: if given, the states are reduced to the views of this package, see load_state_for_widgets
+    :param workers: number of parser processes, defaults to the number of CPUs
+    """
+    store = get_run_store(path)
+    if store is not None:
+        for key in store.keys(KIND_STATE):
+            data = store.get(KIND_STATE, key)
+            if app_package is not None:
+                data = reduce_state_for_widgets(data, app_package)
+            if data is not None:
+                yield data
+        return
+
+    json_files = list_state_files(path)
+    if app_package is None:
+        load = load_json_file
+        args = (json_files,)
+    else:
+        load = load_state_for_widgets
+        args = (json_files, [app_package] * len(json_files))
+
+    if len(json_files) < MIN_FILES_FOR_POOL or workers == 1:
+        results = map(load, *args)
+        for data in results:
+            if data is not None:
+                yield data
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for data in executor.map(load, *args, chunksize=16):
+            if data is not None:
+                yield data
+
+
+def load_all_json_file(path):
+    return list(iter_state_files(path))
 
 
 def get_widget_info(all_data, app_package,output_file):
+    """
+    collect the leaf widgets of the app per activity, deduplicated on (text, resource_id, content_description)
+    :param all_data: iterable of states, e.g. iter_state_files(state_dir_path, app_package)
+    """
     output = {}
+    seen = {}
     total_widgets = 0  
     for data in all_data:
         for view in data["views"]:
             if app_package in view["package"]:
                 activity = data["foreground_activity"].split(".")[-1]
-                if activity not in output.keys():
+                if activity not in output:
                     output[activity] = []
+                    seen[activity] = set()
                 
                 if view['child_count'] > 0:
                     continue
@@ -319,14 +1024,16 @@ def get_widget_info(all_data, app_package,output_file):
                     "bounds": view.get("bounds", [])  
                 }
                 
+                if data.get("screenshot_scale", 1.0) != 1.0:
+                    widget["screen_scale"] = data["screenshot_scale"]
+
                 if len(widget["bounds"]) == 2:
                     widget["bounds"] = [widget["bounds"][0][0], widget["bounds"][0][1],
                                         widget["bounds"][1][0], widget["bounds"][1][1]]
                 
-                if not any(existing_widget["text"] == widget["text"] and 
-                          existing_widget["resource_id"] == widget["resource_id"] and
-                          existing_widget["content_description"] == widget["content_description"]
-                          for existing_widget in output[activity]):
+                widget_key = (widget["text"], widget["resource_id"], widget["content_description"])
+                if widget_key not in seen[activity]:
+                    seen[activity].add(widget_key)
                     output[activity].append(widget)
                     total_widgets += 1  
   
@@ -348,12 +1055,20 @@ async def main():
     app_name = "omninotes"
     state_dir_path = "./Droidbot/droidbot/output/omninotes/6.1.0/states/"
 
-    widget_raw_data = load_all_json_file(state_dir_path)
     widgets_file_path = "output/omninotes/6.1.0.json"
-    get_widget_info(widget_raw_data,"omninotes",widgets_file_path)
+    get_widget_info(iter_state_files(state_dir_path, "omninotes"),"omninotes",widgets_file_path)
     output_file = "output/omninotes/annotation_" + os.path.basename(widgets_file_path)
     
-    output = await generate_widget_annotations(app_name, state_dir_path, widgets_file_path)
+    # shared across runs and app versions, so unchanged widgets are never re-annotated
+    cache_path = "output/annotation_cache.sqlite"
+
+    # results are streamed here while annotating, re-running resumes an interrupted run
+    progress_path = output_file.replace(".json", ".jsonl")
+
+    output = await generate_widget_annotations(app_name, state_dir_path, widgets_file_path, progress_path, cache_path)
+    if annotation_cache is not None:
+        annotation_cache.report()
+        annotation_cache.close()
     
     print(f"Generated annotations for {sum(len(v) for v in output.values())} widgets across {len(output)} activities.")
     # save results to json file
@@ -0,0 +1,289 @@
+"""
+local stand-in for the OpenAI compatible chat completions API, to run the iPBT pipelines offline
+
+record the responses of the real provider while running a pipeline:
+    python llm_backend.py record --cassette output/cassette.jsonl --upstream https://api.openai.com/v1
+replay them, with injected latency, errors and rate limiting:
+    python llm_backend.py replay --cassette output/cassette.jsonl --latency 0.8 --jitter 0.3 --rate-limit-rate 0.05
+or answer every request with a fixed response, without any cassette:
+    python llm_backend.py synthetic --content '{"semantic_label": "button", "functionality": "test"}'
+
+the pipelines are pointed at the server with LLM_BACKEND_URL=http://127.0.0.1:8765/v1
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# request fields that change the response, the cassette is keyed on them
+KEY_FIELDS = ("model", "messages", "temperature", "response_format", "max_tokens", "top_p")
+
+
+def backend_base_url(default=None):
+    """
+    the base url the pipelines send their requests to, LLM_BACKEND_URL overrides every provider
+    """
+    return os.environ.get("LLM_BACKEND_URL") or default
+
+
+def get_request_key(request):
+    key_inputs = {field: request.get(field) for field in KEY_FIELDS}
+    return hashlib.sha256(json.dumps(key_inputs, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class Cassette:
+    """
+    recorded responses, one json line {"key", "response"} per request
+    """
+    def __init__(self, path):
+        self.path = path
+        self.responses = {}
+        self.lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.responses[record["key"]] = record["response"]
+
+    def get(self, key):
+        return self.responses.get(key)
+
+    def put(self, key, response):
+        with self.lock:
+            self.responses[key] = response
+            dir_name = os.path.dirname(self.path)
+            if dir_name:
+                os.makedirs(dir_name, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"key": key, "response": response}, ensure_ascii=False) + "\n")
+
+
+class FaultInjector:
+    """
+    decides the latency and the injected failure of every request
+    :param latency: mean latency in seconds
+    :param jitter: the latency is uniform in [latency - jitter, latency + jitter]
+    :param error_rate: fraction of requests answered with a 500
+    :param rate_limit_rate: fraction of requests answered with a 429
+    :param requests_per_minute: requests over this limit in a sliding minute are answered with a 429
+    :param retry_after: seconds sent in the retry-after headers of the 429s
+    """
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, rate_limit_rate=0.0, requests_per_minute=None,
+                 retry_after=1.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.requests_per_minute = requests_per_minute
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.request_times = deque()
+        self.lock = threading.Lock()
+
+    def next(self):
+        """
+        :return: (latency, status), status is None if the request succeeds
+        """
+        with self.lock:
+            latency = max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+            if self.requests_per_minute:
+                now = time.monotonic()
+                while self.request_times and now - self.request_times[0] > 60:
+                    self.request_times.popleft()
+                if len(self.request_times) >= self.requests_per_minute:
+                    return 0.0, 429
+                self.request_times.append(now)
+            draw = self.random.random()
+            if draw < self.rate_limit_rate:
+                return 0.0, 429
+            if draw < self.rate_limit_rate + self.error_rate:
+                return latency, 500
+            return latency, None
+
+
+class BackendStats:
+    def __init__(self):
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def report(self):
+        print("Backend stats: " + ", ".join(f"{name} {count}" for name, count in sorted(self.counts.items())))
+
+
+def synthetic_response(request, content):
+    prompt_tokens = len(json.dumps(request.get("messages", []))) // 4
+    completion_tokens = len(content) // 4
+    return {
+        "id": "chatcmpl-" + get_request_key(request)[:24],
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": request.get("model"),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop",
+        }],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
+
+class BackendHandler(BaseHTTPRequestHandler):
+    # set by make_server
+    mode = None
+    cassette = None
+    upstream = None
+    content = None
+    faults = None
+    stats = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_error_json(self, status, message, headers=None):
+        self.send_json(status, {"error": {"message": message, "type": "backend_error", "code": status}}, headers)
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_error_json(404, f"unknown path {self.path}")
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        self.stats.count("requests")
+
+        latency, status = self.faults.next()
+        time.sleep(latency)
+        if status == 429:
+            self.stats.count("rate_limited")
+            retry_after = self.faults.retry_after
+            self.send_error_json(429, "Rate limit reached (injected)", {
+                "retry-after": str(max(1, round(retry_after))),
+                "retry-after-ms": str(int(retry_after * 1000)),
+            })
+            return
+        if status is not None:
+            self.stats.count("errors")
+            self.send_error_json(status, "Internal server error (injected)")
+            return
+
+        if self.mode == "synthetic":
+            self.send_json(200, synthetic_response(request, self.content))
+            return
+
+        key = get_request_key(request)
+        response = self.cassette.get(key)
+        if response is not None:
+            self.stats.count("replayed")
+            self.send_json(200, response)
+            return
+        if self.mode == "replay":
+            self.stats.count("missing")
+            self.send_error_json(404, f"request {key} is not in the cassette")
+            return
+        self.record(key, request)
+
+    def record(self, key, request):
+        upstream_request = urllib.request.Request(
+            self.upstream.rstrip("/") + "/chat/completions",
+            data=json.dumps(request).encode("utf-8"),
+            headers={"Content-Type": "application/json", "Authorization": self.headers.get("Authorization", "")},
+            method="POST",
+        )
+        try:
+            with urllib.request.urlopen(upstream_request) as upstream_response:
+                response = json.loads(upstream_response.read())
+        except urllib.error.HTTPError as e:
+            # pass the failures of the provider through without recording them
+            self.stats.count("upstream_errors")
+            headers = {name: e.headers[name] for name in ("retry-after", "retry-after-ms") if name in e.headers}
+            self.send_error_json(e.code, e.read().decode("utf-8", errors="replace"), headers)
+            return
+        except OSError as e:
+            # the provider is unreachable or timed out (URLError is an OSError)
+            self.stats.count("upstream_errors")
+            self.send_error_json(502, f"upstream request failed: {e}")
+            return
+        self.stats.count("recorded")
+        self.cassette.put(key, response)
+        self.send_json(200, response)
+
+
+def make_server(mode, host="127.0.0.1", port=8765, cassette_path=None, upstream=None, content="{}", faults=None):
+    """
+    create the backend server, serve it with serve_forever, e.g. in a daemon thread
+    :param mode: record (forward to upstream and save the responses), replay or synthetic
+    """
+    if mode in ("record", "replay") and not cassette_path:
+        raise ValueError(f"{mode} mode needs a cassette")
+    if mode == "record" and not upstream:
+        raise ValueError("record mode needs an upstream url")
+    handler = type("Handler", (BackendHandler,), {
+        "mode": mode,
+        "cassette": Cassette(cassette_path),
+        "upstream": upstream,
+        "content": content,
+        "faults": faults or FaultInjector(),
+        "stats": BackendStats(),
+    })
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Local OpenAI compatible backend for the iPBT pipelines")
+    parser.add_argument("mode", choices=["record", "replay", "synthetic"])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--cassette", help="jsonl file of the recorded responses")
+    parser.add_argument("--upstream", help="base url of the real provider, in record mode")
+    parser.add_argument("--content", default="{}", help="response content in synthetic mode")
+    parser.add_argument("--latency", type=float, default=0.0, help="mean latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="latency jitter in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests failing with a 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="fraction of requests failing with a 429")
+    parser.add_argument("--rpm", type=int, default=None, help="requests per minute before answering 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="retry-after of the 429s, in seconds")
+    parser.add_argument("--seed", type=int, default=None, help="seed of the injected latency and failures")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    faults = FaultInjector(args.latency, args.jitter, args.error_rate, args.rate_limit_rate, args.rpm,
+                           args.retry_after, args.seed)
+    server = make_server(args.mode, args.host, args.port, args.cassette, args.upstream, args.content, faults)
+    print(f"{args.mode} backend on http://{args.host}:{server.server_address[1]}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.RequestHandlerClass.stats.report()